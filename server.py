@@ -5,21 +5,32 @@ import gevent.socket
 
 from youtube import yt_app
 from youtube import util
+from youtube.segment_cache import segment_cache
+from youtube.image_cache import image_cache, get_ttl
+from youtube.read_ahead import read_ahead_buffer
 
 # these are just so the files get run - they import yt_app and add routes to it
 from youtube import watch, search, playlist, channel, local_playlist, comments, subscriptions
+from youtube import thumbnails
 
 import settings
 
-from gevent.pywsgi import WSGIServer
+from gevent.pywsgi import WSGIServer, WSGIHandler
 import urllib
 import urllib3
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.queue
+import collections
 import socket
 import socks, sockshandler
 import subprocess
 import re
 import sys
 import time
+import traceback
+import os
 
 
 
@@ -50,7 +61,34 @@ def parse_range(range_header, content_length):
         end_byte = int(end)
     return start_byte, end_byte
 
-def proxy_site(env, start_response, video=False):
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(?:\d+|\*)')
+def content_range_start(response):
+    '''Returns the byte position the response body starts at'''
+    if response.status != 206:
+        return 0
+    match = CONTENT_RANGE_RE.fullmatch(
+        (response.getheader('Content-Range') or '').strip())
+    if not match:
+        return None
+    return int(match.group(1))
+
+def get_video_use_tor(env):
+    params = urllib.parse.parse_qs(env['QUERY_STRING'])
+    params_use_tor = int(params.get('use_tor', '0')[0])
+    return (settings.route_tor == 2) or params_use_tor
+
+def get_upstream_url(env, video=False):
+    url = "https://" + env['SERVER_NAME'] + env['PATH_INFO']
+    # remove /name portion
+    if video and '/videoplayback/name/' in url:
+        url = url[0:url.rfind('/name/')]
+    if env['QUERY_STRING']:
+        url += '?' + env['QUERY_STRING']
+    return url
+
+def proxy_site(env, start_response, video=False, cache_entry=None):
+    '''When cache_entry is given, the bytes received are also written into
+    it'''
     send_headers = {
         'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
         'Accept': '*/*',
@@ -60,12 +98,7 @@ def proxy_site(env, start_response, video=False):
     if 'HTTP_RANGE' in env:
         send_headers['Range'] = env['HTTP_RANGE']
 
-    url = "https://" + env['SERVER_NAME'] + env['PATH_INFO']
-    # remove /name portion
-    if video and '/videoplayback/name/' in url:
-        url = url[0:url.rfind('/name/')]
-    if env['QUERY_STRING']:
-        url += '?' + env['QUERY_STRING']
+    url = get_upstream_url(env, video=video)
 
     try_num = 1
     first_attempt = True
@@ -75,9 +108,7 @@ def proxy_site(env, start_response, video=False):
             print('(Try %d)' % try_num, 'Trying with', send_headers['Range'])
 
         if video:
-            params = urllib.parse.parse_qs(env['QUERY_STRING'])
-            params_use_tor = int(params.get('use_tor', '0')[0])
-            use_tor = (settings.route_tor == 2) or params_use_tor
+            use_tor = get_video_use_tor(env)
             response, cleanup_func = util.fetch_url_response(url, send_headers,
                                                              use_tor=use_tor,
                                                              max_redirects=10)
@@ -100,6 +131,10 @@ def proxy_site(env, start_response, video=False):
             print('Error: Youtube returned "%d %s" while routing %s' % (
                 response.status, response.reason, url.split('?')[0]))
 
+        cache_position = None
+        if cache_entry is not None and response.status in (200, 206):
+            cache_position = content_range_start(response)
+
         total_received = 0
         retry = False
         while True:
@@ -146,8 +181,13 @@ def proxy_site(env, start_response, video=False):
                         try_num = 1
                         current_attempt_position = fail_byte
                 break
+            if cache_position is not None:
+                cache_entry.write(cache_position, content_part)
+                cache_position += len(content_part)
             yield content_part
         cleanup_func(response)
+        if cache_entry is not None:
+            segment_cache.commit(cache_entry)
         if retry:
             # Youtube will return 503 Service Unavailable if you do a bunch
             # of range requests too quickly.
@@ -159,17 +199,429 @@ def proxy_site(env, start_response, video=False):
         print('Error: Youtube closed the connection before',
               'providing all content. Retried three times:', url.split('?')[0])
 
+def fetch_video_range(url, start, end, use_tor, cache_entry=None):
+    '''Yields the bytes [start, end) of the video at url, writing them into
+    cache_entry if given. Stops early if Youtube returns an error. Retries a
+    given byte position three times if Youtube closes the connection early'''
+    send_headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+        'Accept': '*/*',
+    }
+    position = start
+    try_num = 1
+    while position < end and try_num <= 3:
+        attempt_start = position
+        send_headers['Range'] = 'bytes=%d-%d' % (position, end - 1)
+        response, cleanup_func = util.fetch_url_response(
+            url, send_headers, use_tor=use_tor, max_redirects=10)
+        try:
+            if (response.status != 206
+                    or content_range_start(response) != position):
+                print('Error: Youtube returned "%d %s" for range %s of %s' % (
+                    response.status, response.reason, send_headers['Range'],
+                    url.split('?')[0]))
+                return
+            while position < end:
+                content_part = response.read(min(32*8192, end - position))
+                if not content_part:
+                    break
+                if cache_entry is not None:
+                    cache_entry.write(position, content_part)
+                position += len(content_part)
+                yield content_part
+        finally:
+            cleanup_func(response)
+            if cache_entry is not None:
+                segment_cache.commit(cache_entry)
+
+        if position < end:
+            print('Warning: Youtube closed the connection before byte',
+                  str(position) + '.', 'Expected', end, 'bytes.')
+            if position == attempt_start:
+                try_num += 1
+            else:
+                try_num = 1
+            time.sleep(1)
+    if position < end:
+        print('Error: Youtube closed the connection before',
+              'providing all content. Retried three times:', url.split('?')[0])
+
+# Throughput of recent video streams downloaded over several connections
+# tuples of (bytes, seconds, connections)
+parallel_stream_stats = collections.deque(maxlen=100)
+
+def fetch_video_range_parallel(url, start, end, use_tor, cache_entry=None):
+    '''Like fetch_video_range, but splits the range into sub-ranges of
+    settings.video_parallel_chunk_size KiB which are downloaded over up to
+    settings.video_parallel_connections connections at once, and yields them
+    in order. A single connection is often throttled by googlevideo or
+    limited by the Tor circuit, so this can be much faster.
+
+    The first sub-range is passed on as it arrives so that playback can
+    start right away. At most video_parallel_connections sub-ranges are
+    downloading or waiting to be sent to the client at a time.'''
+    chunk_size = max(1, settings.video_parallel_chunk_size)*1024
+    connections = settings.video_parallel_connections
+    if connections <= 1 or end - start <= chunk_size:
+        yield from fetch_video_range(url, start, end, use_tor, cache_entry)
+        return
+
+    sub_ranges = [(position, min(position + chunk_size, end))
+                  for position in range(start, end, chunk_size)]
+    slots = gevent.lock.Semaphore(connections - 1)
+    task_queue = gevent.queue.Queue()
+    tasks = []
+
+    def fetch_sub_range(sub_start, sub_end):
+        return b''.join(fetch_video_range(url, sub_start, sub_end, use_tor,
+                                          cache_entry))
+
+    def spawn_tasks():
+        for sub_start, sub_end in sub_ranges[1:]:
+            slots.acquire()
+            task = gevent.spawn(fetch_sub_range, sub_start, sub_end)
+            tasks.append(task)
+            task_queue.put(task)
+
+    start_time = time.monotonic()
+    total_received = 0
+    dispatcher = gevent.spawn(spawn_tasks)
+    try:
+        first_start, first_end = sub_ranges[0]
+        for content_part in fetch_video_range(url, first_start, first_end,
+                                              use_tor, cache_entry):
+            total_received += len(content_part)
+            yield content_part
+        if total_received != first_end - first_start:
+            return
+
+        for sub_start, sub_end in sub_ranges[1:]:
+            task = task_queue.get()
+            task.join()
+            slots.release()
+            if not task.successful():
+                print('Error while fetching video range:', task.exception)
+                return
+            total_received += len(task.value)
+            yield task.value
+            if len(task.value) != sub_end - sub_start:
+                return
+    finally:
+        dispatcher.kill()
+        gevent.killall(tasks)
+        parallel_stream_stats.append(
+            (total_received, time.monotonic() - start_time, connections))
+
+def video_stream_report():
+    '''One row per recorded stream, most recent first, so that slow streams
+    stand out'''
+    rows = [('MiB', 'Seconds', 'MiB/s', 'Connections')]
+    for received, seconds, connections in reversed(parallel_stream_stats):
+        rows.append((
+            round(received/1024/1024, 1),
+            round(seconds, 1),
+            round(received/1024/1024/max(seconds, 0.001), 2),
+            connections,
+        ))
+    return rows
+util.add_status_reporter('Parallel video streams (last 100)',
+                         video_stream_report)
+
+util.add_status_reporter('Video read-ahead', lambda: [
+    ('Hits', 'Misses', 'Dropped by seeking', 'Skipped for memory limits',
+     'MiB buffered'),
+    (read_ahead_buffer.hits, read_ahead_buffer.misses,
+     read_ahead_buffer.seek_drops, read_ahead_buffer.limit_skips,
+     round(read_ahead_buffer.total_size()/1024/1024, 1)),
+])
+
+util.add_status_reporter('Caches', lambda: [
+    ('Cache', 'MiB used', 'Entries'),
+    ('Video', round(segment_cache.total_size()/1024/1024, 1),
+     len(segment_cache.entries)),
+    ('Image', round(image_cache.total_size/1024/1024, 1), ''),
+])
+
+def get_stream_info(query_string):
+    '''Returns (content_length, mime) from a googlevideo query string, or
+    (None, None) if missing'''
+    params = urllib.parse.parse_qs(query_string)
+    try:
+        return int(params['clen'][0]), params['mime'][0]
+    except (KeyError, ValueError):
+        return None, None
+
+def video_pieces_body(url, pieces, use_tor, cache_entry):
+    '''Yields the bytes of the given (start, end, is_cached) pieces, from
+    the cache or from Youtube'''
+    for piece_start, piece_end, is_cached in pieces:
+        if is_cached:
+            yield from cache_entry.read(piece_start, piece_end)
+        else:
+            yield from fetch_video_range_parallel(url, piece_start, piece_end,
+                                                  use_tor, cache_entry)
+
+def get_read_ahead_key(env):
+    params = urllib.parse.parse_qs(env['QUERY_STRING'])
+    return (env['REMOTE_ADDR'], params.get('id', [''])[0],
+            params.get('itag', [''])[0])
+
 def proxy_video(env, start_response):
-    yield from proxy_site(env, start_response, video=True)
+    cache_entry = segment_cache.get_entry(env['QUERY_STRING'])
+    if cache_entry is not None:
+        content_length, mime = cache_entry.content_length, cache_entry.mime
+    else:
+        content_length, mime = get_stream_info(env['QUERY_STRING'])
+    parallel = settings.video_parallel_connections > 1
+    read_ahead = settings.video_read_ahead and 'HTTP_RANGE' in env
+    if (content_length is None
+            or (cache_entry is None and not parallel and not read_ahead)):
+        yield from proxy_site(env, start_response, video=True)
+        return
+
+    if 'HTTP_RANGE' in env:
+        int_range = parse_range(env['HTTP_RANGE'], content_length)
+        if not int_range or int_range[0] >= content_length:
+            yield from proxy_site(env, start_response, video=True)
+            return
+        # parse_range gives an end past the file for bytes=200-
+        start, end = int_range[0], min(int_range[1] + 1, content_length)
+        if end <= start:
+            yield from proxy_site(env, start_response, video=True)
+            return
+        status = '206 Partial Content'
+    else:
+        start, end = 0, content_length
+        status = '200 OK'
+
+    response_headers = [
+        ('Content-Type', mime),
+        ('Content-Length', str(end - start)),
+        ('Accept-Ranges', 'bytes'),
+        ('Access-Control-Allow-Origin', '*'),
+    ]
+    if status.startswith('206'):
+        response_headers.append(('Content-Range', 'bytes %d-%d/%d' % (
+            start, end - 1, content_length)))
+
+    url = get_upstream_url(env, video=True)
+    use_tor = get_video_use_tor(env)
+    stream_key = None
+    prefetched = b''
+    if read_ahead:
+        stream_key = get_read_ahead_key(env)
+        prefetched = read_ahead_buffer.take(stream_key, start, end)
+
+    if cache_entry is not None:
+        pieces = cache_entry.split(start + len(prefetched), end)
+    else:
+        pieces = [(start + len(prefetched), end, False)]
+
+    try:
+        if prefetched:
+            start_response(status, response_headers)
+            yield prefetched
+            yield from video_pieces_body(url, pieces, use_tor, cache_entry)
+        elif not any(is_cached for _, _, is_cached in pieces):
+            if not parallel:
+                # Nothing to serve locally, so pass Youtube's response
+                # (including any error status) through unchanged while
+                # storing it
+                yield from proxy_site(env, start_response, video=True,
+                                      cache_entry=cache_entry)
+            else:
+                body = fetch_video_range_parallel(url, start, end, use_tor,
+                                                  cache_entry)
+                first_part = next(body, None)
+                if first_part is None:
+                    # Youtube returned an error. Request again the normal way
+                    # so the error gets passed on to the browser
+                    yield from proxy_site(env, start_response, video=True,
+                                          cache_entry=cache_entry)
+                    return
+                start_response(status, response_headers)
+                yield first_part
+                yield from body
+        else:
+            start_response(status, response_headers)
+            yield from video_pieces_body(url, pieces, use_tor, cache_entry)
+    finally:
+        if cache_entry is not None:
+            segment_cache.finish()
+
+    # Predict that the player will next ask for the following range of the
+    # same size
+    if stream_key is not None and end < content_length:
+        next_end = min(content_length, end + (end - start))
+        if cache_entry is not None and all(
+                is_cached for _, _, is_cached in cache_entry.split(end,
+                                                                   next_end)):
+            return
+        def fetch_function(fetch_start, fetch_end):
+            return b''.join(fetch_video_range_parallel(
+                url, fetch_start, fetch_end, use_tor, cache_entry))
+        read_ahead_buffer.prefetch(stream_key, env['REMOTE_ADDR'], end,
+                                   next_end, fetch_function)
+
+def serve_cached_image(env, start_response, image, content=None):
+    headers = [
+        ('ETag', image.local_etag()),
+        ('Cache-Control', 'public, max-age=%d' % max(
+            0, int(image.expire_time - time.time()))),
+    ]
+    if env.get('HTTP_IF_NONE_MATCH') == image.local_etag():
+        start_response('304 Not Modified', headers)
+        return
+    if content is None:
+        content = image_cache.read(image)
+        if content is None:  # deleted behind our back
+            yield from proxy_site(env, start_response)
+            return
+    headers += [
+        ('Content-Type', image.content_type or 'image/jpeg'),
+        ('Content-Length', str(len(content))),
+    ]
+    start_response('200 OK', headers)
+    yield content
+
+def proxy_image(env, start_response):
+    if (settings.image_cache_size <= 0
+            or env['REQUEST_METHOD'] != 'GET'
+            or 'HTTP_RANGE' in env):
+        yield from proxy_site(env, start_response)
+        return
+
+    url = get_upstream_url(env)
+    image = image_cache.lookup(url)
+    if image is not None and image.is_fresh():
+        yield from serve_cached_image(env, start_response, image)
+        return
+
+    send_headers = {
+        'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+        'Accept': '*/*',
+    }
+    if image is not None:
+        if image.etag:
+            send_headers['If-None-Match'] = image.etag
+        if image.last_modified:
+            send_headers['If-Modified-Since'] = image.last_modified
+
+    response, cleanup_func = util.fetch_url_response(url, send_headers)
+    try:
+        content = response.read()
+    finally:
+        cleanup_func(response)
+    ttl = get_ttl(response.getheader('Cache-Control'))
+
+    if response.status == 304 and image is not None:
+        image_cache.refresh(image, ttl or 0)
+        yield from serve_cached_image(env, start_response, image)
+        return
+
+    content = util.decode_content(
+        content, response.getheader('Content-Encoding', default='identity'))
+    if response.status != 200 or ttl is None:
+        response_headers = [
+            (key, value) for key, value in response.getheaders().items()
+            if key.lower() not in ('content-encoding', 'content-length',
+                                   'transfer-encoding', 'connection')
+        ]
+        response_headers.append(('Content-Length', str(len(content))))
+        start_response(str(response.status) + ' ' + response.reason,
+                       response_headers)
+        yield content
+        return
+
+    image = image_cache.store(
+        url, content, response.getheader('Content-Type'),
+        response.getheader('ETag'), response.getheader('Last-Modified'),
+        ttl)
+    yield from serve_cached_image(env, start_response, image, content)
+
+class StreamBroadcast:
+    '''Runs a proxy handler in its own greenlet and replays its status,
+    headers and body to every client subscribed to it, including clients
+    that subscribe after it has started. Since the handler doesn't run in
+    any client's greenlet, one client disconnecting doesn't cut off the
+    others.'''
+    def __init__(self, handler, env):
+        self.status = None
+        self.headers = None
+        self.chunks = []
+        self.finished = False
+        self.exception = None
+        self.changed = gevent.event.Event()
+        self.greenlet = gevent.spawn(self._run, handler, env)
+
+    def _start_response(self, status, headers, exc_info=None):
+        self.status = status
+        self.headers = list(headers)
+        self._notify()
+
+    def _notify(self):
+        self.changed.set()
+        self.changed = gevent.event.Event()
+
+    def _run(self, handler, env):
+        try:
+            for chunk in handler(env, self._start_response):
+                self.chunks.append(chunk)
+                self._notify()
+        except Exception as e:
+            self.exception = e
+            traceback.print_exc()
+        finally:
+            self.finished = True
+            self._notify()
+
+    def subscribe(self, start_response):
+        while self.status is None and not self.finished:
+            self.changed.wait()
+        if self.status is None:
+            raise self.exception or Exception('Proxy handler gave no response')
+        start_response(self.status, self.headers)
+
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.finished:
+                break
+            self.changed.wait()
+
+in_flight_proxies = {}
+def coalesce_proxy(handler):
+    '''Wraps a proxy handler so that identical concurrent requests for the
+    same url share one upstream request'''
+    def coalesced_handler(env, start_response):
+        if env['REQUEST_METHOD'] != 'GET':
+            yield from handler(env, start_response)
+            return
+        key = (
+            handler,
+            get_upstream_url(env),
+            env.get('HTTP_RANGE'),
+            env.get('HTTP_IF_NONE_MATCH'),
+        )
+        broadcast = in_flight_proxies.get(key)
+        if broadcast is None:
+            broadcast = StreamBroadcast(handler, env)
+            in_flight_proxies[key] = broadcast
+            broadcast.greenlet.link(lambda greenlet: in_flight_proxies.pop(
+                key, None))
+        yield from broadcast.subscribe(start_response)
+    return coalesced_handler
 
 site_handlers = {
     'youtube.com':yt_app,
     'youtube-nocookie.com':yt_app,
     'youtu.be':youtu_be,
-    'ytimg.com': proxy_site,
-    'ggpht.com': proxy_site,
-    'googleusercontent.com': proxy_site,
-    'sponsor.ajay.app': proxy_site,
+    'ytimg.com': coalesce_proxy(proxy_image),
+    'ggpht.com': coalesce_proxy(proxy_image),
+    'googleusercontent.com': coalesce_proxy(proxy_image),
+    'sponsor.ajay.app': coalesce_proxy(proxy_site),
     'googlevideo.com': proxy_video,
 }
 
@@ -255,10 +707,10 @@ class FilteredRequestLog:
     filter_re = re.compile(r'''(?x)
                             "GET\ /https://(
                             i[.]ytimg[.]com/|
-                            www[.]youtube[.]com/data/subscription_thumbnails/|
+                            www[.]youtube[.]com/data/(subscription_|playlist_)?thumbnails/|
                             yt3[.]ggpht[.]com/|
                             www[.]youtube[.]com/api/timedtext|
-                            [-\w]+[.]googlevideo[.]com/).*"\ (200|206)
+                            [-\w]+[.]googlevideo[.]com/).*"\ (200|206|304)
                             ''')
     def __init__(self):
         pass
@@ -266,13 +718,83 @@ class FilteredRequestLog:
         if not self.filter_re.search(s):
             sys.stderr.write(s)
 
+class SendfileWrapper:
+    '''wsgi.file_wrapper given by SendfileHandler. Iterating it gives the
+    wrapper itself, which passes through site_dispatch unchanged for
+    SendfileHandler to send'''
+    def __init__(self, file, block_size=8192):
+        self.file = file
+        self.block_size = block_size
+
+    def __iter__(self):
+        yield self
+
+    def read_blocks(self):
+        while True:
+            block = self.file.read(self.block_size)
+            if not block:
+                return
+            yield block
+
+    def close(self):
+        self.file.close()
+
+class SendfileHandler(WSGIHandler):
+    '''Sends files given to wsgi.file_wrapper (locally stored thumbnails)
+    with os.sendfile, so the kernel copies them to the socket instead of
+    them being read into Python in blocks'''
+    def get_environ(self):
+        environ = WSGIHandler.get_environ(self)
+        if hasattr(os, 'sendfile'):
+            environ['wsgi.file_wrapper'] = SendfileWrapper
+        return environ
+
+    def send_file(self, wrapper):
+        # sends the headers
+        self.write(b'')
+        if self.response_use_chunked:
+            for block in wrapper.read_blocks():
+                self.write(block)
+            return
+        socket_fd = self.socket.fileno()
+        file_fd = wrapper.file.fileno()
+        offset = wrapper.file.tell()
+        size = os.fstat(file_fd).st_size
+        while offset < size:
+            try:
+                sent = os.sendfile(socket_fd, file_fd, offset, size - offset)
+            except BlockingIOError:
+                gevent.socket.wait_write(socket_fd,
+                                         timeout=self.socket.gettimeout())
+                continue
+            if sent == 0:
+                break
+            offset += sent
+            self.response_length += sent
+
+    def process_result(self):
+        for data in self.result:
+            if isinstance(data, SendfileWrapper):
+                try:
+                    self.send_file(data)
+                finally:
+                    data.close()
+            elif data:
+                self.write(data)
+        if self.status and not self.headers_sent:
+            self.write(b'')
+        if self.response_use_chunked:
+            self._sendall(b'0\r\n\r\n')
+
 if __name__ == '__main__':
     if settings.allow_foreign_addresses:
         server = WSGIServer(('0.0.0.0', settings.port_number), site_dispatch,
-                            log=FilteredRequestLog())
+                            log=FilteredRequestLog(),
+                            handler_class=SendfileHandler)
     else:
         server = WSGIServer(('127.0.0.1', settings.port_number), site_dispatch,
-                            log=FilteredRequestLog())
+                            log=FilteredRequestLog(),
+                            handler_class=SendfileHandler)
     print('Started httpserver on port' , settings.port_number)
     server.serve_forever()
 
@@ -44,6 +44,48 @@ SETTINGS_INFO = collections.OrderedDict([
         'category': 'network',
     }),
 
+    ('connection_pool_size_api', {
+        'type': int,
+        'default': 10,
+        'comment': '''Number of connections kept open per host for pages and API requests to Youtube''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('connection_pool_size_image', {
+        'type': int,
+        'default': 10,
+        'comment': '''Number of connections kept open per host for images''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('connection_pool_size_video', {
+        'type': int,
+        'default': 10,
+        'comment': '''Number of connections kept open per host for video''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('response_cache_memory_size', {
+        'type': int,
+        'default': 16,
+        'comment': '''MiB of memory used to keep recently fetched playlist, channel and search
+pages so that going back or refreshing doesn't download them again''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('response_cache_disk_size', {
+        'type': int,
+        'default': 0,
+        'comment': '''MiB of disk space used to also keep recently fetched playlist, channel and
+search pages on disk. 0 disables the disk cache''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
     ('allow_foreign_addresses', {
         'type': bool,
         'default': True,
@@ -221,6 +263,120 @@ For security reasons, enabling this is not recommended.''',
         'category': 'network',
     }),
 
+    ('video_cache_size', {
+        'label': 'Video cache size (MiB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Disk space in MiB used to cache video data that has been routed through
+youtube-local, so that rewatching or seeking back does not download it again.
+0 disables the cache''',
+        'category': 'network',
+        'description': 'Disk space used to store watched video data so that rewatching or seeking back does not download it again. Set to 0 to disable. Note that the cache reveals which videos have been watched.',
+    }),
+
+    ('video_parallel_connections', {
+        'label': 'Connections per video stream',
+        'type': int,
+        'default': 1,
+        'comment': '''Number of connections used at once to download a routed video stream.
+Above 1, large requested ranges are split into pieces of
+video_parallel_chunk_size KiB which are downloaded in parallel''',
+        'category': 'network',
+        'description': 'Downloading routed video over several connections at once can be much faster when a single connection is throttled or routed over a slow Tor circuit.',
+    }),
+
+    ('video_parallel_chunk_size', {
+        'type': int,
+        'default': 1024,
+        'comment': '''Size in KiB of the pieces a video range is split into when video_parallel_connections is above 1''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('video_read_ahead', {
+        'label': 'Read ahead routed video',
+        'type': bool,
+        'default': False,
+        'comment': '''After a piece of a routed video has been sent to the player, download the
+following piece in the background so it is ready when the player asks for it''',
+        'category': 'network',
+    }),
+
+    ('video_read_ahead_client_limit', {
+        'type': int,
+        'default': 16,
+        'comment': '''Maximum MiB of read ahead video data kept in memory for each client''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('video_read_ahead_total_limit', {
+        'type': int,
+        'default': 64,
+        'comment': '''Maximum MiB of read ahead video data kept in memory in total''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('image_cache_size', {
+        'label': 'Image cache size (MiB)',
+        'type': int,
+        'default': 0,
+        'comment': '''Disk space in MiB used to cache routed images (thumbnails, avatars, etc.)
+Expired images are revalidated with Youtube rather than downloaded again.
+0 disables the cache''',
+        'category': 'network',
+        'description': 'Disk space used to store routed images such as thumbnails and avatars, so they are not downloaded again on every page view. Set to 0 to disable.',
+    }),
+
+    ('prefetch_videos', {
+        'label': 'Prefetch related videos',
+        'type': int,
+        'default': 0,
+        'comment': '''Number of related videos to load in the background while watching a video,
+so that they open faster. The next video in the playlist is also loaded
+unless this is 0. 0 disables prefetching''',
+        'category': 'network',
+        'description': 'Number of related videos loaded in the background so that clicking on them is faster. The next video of the playlist is loaded too. Set to 0 to disable.',
+    }),
+
+    ('prefetch_video_ranges', {
+        'label': 'Prefetch beginning of videos',
+        'type': bool,
+        'default': False,
+        'comment': '''Also download the headers (init and index ranges) of the default quality of
+prefetched videos into the video cache. Requires video_cache_size''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('prefetch_bandwidth_limit', {
+        'type': int,
+        'default': 8,
+        'comment': '''MiB of video data prefetching may download per minute''',
+        'hidden': True,
+        'category': 'network',
+    }),
+
+    ('extraction_processes', {
+        'label': 'Extraction processes',
+        'type': int,
+        'default': 0,
+        'comment': '''Number of worker processes used to parse large pages from Youtube, so that
+parsing doesn't make routed videos stutter. 0 parses everything in the main
+process''',
+        'category': 'other',
+        'description': 'Number of extra processes used to parse large pages such as the watch page, which otherwise briefly pauses routed videos. Set to 0 to disable.',
+    }),
+
+    ('extraction_offload_threshold', {
+        'type': int,
+        'default': 256,
+        'comment': '''Pages smaller than this many KiB are parsed in the main process''',
+        'hidden': True,
+        'category': 'other',
+    }),
+
     ('use_comments_js', {
         'label': 'Enable comments.js',
         'type': bool,
@@ -281,6 +437,24 @@ For security reasons, enabling this is not recommended.''',
         'default': 0,
         'comment': '',
     }),
+    ('subscription_check_workers', {
+        'type': int,
+        'default': 0,
+        'comment': '''Maximum number of channels checked at the same time. Workers are added
+while channels are waiting to be checked, and stop after a while without
+work. 0 uses connection_pool_size_api, the number of connections kept open
+to Youtube, so that checks don't open connections (and Tor circuits) which
+are thrown away afterwards''',
+        'hidden': True,
+    }),
+    ('feed_first_checking', {
+        'type': bool,
+        'default': True,
+        'comment': '''When checking a channel for new videos, first download only its small
+Atom feed, and only download the channel's video list if the feed shows
+videos that aren't in the database yet''',
+        'hidden': True,
+    }),
     ('include_shorts_in_channel', {
         'type': bool,
         'default': 1,
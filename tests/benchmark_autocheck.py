@@ -0,0 +1,343 @@
+'''Runs the subscription checking pipeline (autocheck_dispatcher,
+check_channels_queue and _get_upstream_videos) for many fake channels
+without contacting Youtube, on a virtual clock, to measure changes to the
+scheduling and rate limiting.
+
+Usage: python tests/benchmark_autocheck.py [--channels N] [--days N] [--json]
+
+Requests are answered by a stand-in for Youtube which serves Atom feeds
+(with ETags) and playlist JSON made from synthetic upload histories, the
+same as in simulate_upload_model.py. Virtual time only advances once every
+greenlet is waiting, so a day runs in however long the work in it takes.
+Reports requests per virtual hour, database write transactions, CPU time
+spent in the dispatcher, and memory.
+
+The database is created in a temporary directory and deleted afterwards.
+'''
+import io
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import resource
+import tempfile
+import contextlib
+import collections
+
+import gevent
+import gevent.event
+import greenlet
+import urllib3
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube import subscriptions, util, playlist
+import settings
+from simulate_upload_model import synthetic_history
+
+HOUR = 3600
+DAY = 24*HOUR
+START_TIME = 1700000000
+
+
+class VirtualClock:
+    '''Stands in for the time module. sleep and VirtualEvent.wait register
+    timers, which run_until fires in order once nothing else can run'''
+    def __init__(self, now):
+        self.now = now
+        self.timers = []
+        self.timer_count = 0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def add_timer(self, deadline, event):
+        # Like real timers, have a resolution, so that sleeping for tiny
+        # amounts (like the rate limiter can, from rounding errors) still
+        # moves the clock forward
+        deadline = max(deadline, self.now + 0.001)
+        self.timer_count += 1
+        heapq.heappush(self.timers, (deadline, self.timer_count, event))
+
+    def sleep(self, seconds=0):
+        if seconds <= 0:
+            gevent.sleep(0)
+            return
+        event = gevent.event.Event()
+        self.add_timer(self.now + seconds, event)
+        event.wait()
+
+    def run_until(self, end_time):
+        while True:
+            gevent.idle()
+            if not self.timers or self.timers[0][0] > end_time:
+                self.now = end_time
+                return
+            deadline, _, event = heapq.heappop(self.timers)
+            self.now = max(self.now, deadline)
+            event.set()
+
+
+class VirtualGevent:
+    '''Stands in for the gevent module in util, so the rate limiter sleeps
+    on the virtual clock'''
+    def __init__(self, clock):
+        self.sleep = clock.sleep
+
+    def __getattr__(self, name):
+        return getattr(gevent, name)
+
+
+class VirtualEvent(gevent.event.Event):
+    '''Event whose wait timeout is measured by the virtual clock'''
+    def __init__(self, clock):
+        gevent.event.Event.__init__(self)
+        self.clock = clock
+
+    def wait(self, timeout=None):
+        if timeout is None or self.is_set():
+            return gevent.event.Event.wait(self)
+        done = gevent.event.Event()
+        self.clock.add_timer(self.clock.now + timeout, done)
+        wake = lambda event: done.set()
+        self.rawlink(wake)
+        try:
+            done.wait()
+        finally:
+            self.unlink(wake)
+        return self.is_set()
+
+
+class FakeYoutube:
+    '''Answers requests to fetch_url_response from synthetic upload
+    histories, only showing the uploads before the virtual time'''
+    FEED_URL = 'https://www.youtube.com/feeds/videos.xml?channel_id='
+
+    def __init__(self, clock, channel_ids, histories):
+        self.clock = clock
+        self.uploads = dict(zip(channel_ids, histories))
+        self.index = {channel_id: i for i, channel_id in enumerate(channel_ids)}
+        # ctoken -> channel id, recorded when playlist.playlist_ctoken
+        # makes them
+        self.ctokens = {}
+        self.requests = collections.Counter()
+        self.requests_per_hour = collections.Counter()
+
+    def record_ctoken(self, playlist_ctoken):
+        def wrapper(playlist_id, offset, include_shorts=True):
+            ctoken = playlist_ctoken(playlist_id, offset, include_shorts)
+            self.ctokens[ctoken] = 'UC' + playlist_id[2:]
+            return ctoken
+        return wrapper
+
+    def latest_uploads(self, channel_id, number):
+        uploads = self.uploads[channel_id]
+        end = len(uploads)
+        while end > 0 and uploads[end - 1] > self.clock.now:
+            end -= 1
+        return [(self.video_id(channel_id, i), uploads[i])
+                for i in range(end - 1, max(end - number, 0) - 1, -1)]
+
+    def video_id(self, channel_id, upload_index):
+        return 'c%05dv%04d' % (self.index[channel_id], upload_index % 10000)
+
+    def feed(self, channel_id, headers):
+        latest = self.latest_uploads(channel_id, 15)
+        etag = '"%s"' % (latest[0][0] if latest else 'empty')
+        if headers.get('If-None-Match') == etag:
+            self.requests['feed not modified'] += 1
+            return 304, b'', {'ETag': etag}
+        self.requests['feed'] += 1
+        entries = ''.join(
+            '<entry><yt:videoId>%s</yt:videoId><published>%s</published>'
+            '</entry>' % (video_id, time.strftime(
+                '%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(time_published)))
+            for video_id, time_published in latest)
+        content = ('<feed xmlns="http://www.w3.org/2005/Atom" '
+                   'xmlns:yt="http://www.youtube.com/xml/schemas/2015">'
+                   + entries + '</feed>')
+        return 200, content.encode('utf-8'), {'ETag': etag}
+
+    def video_list(self, channel_id):
+        self.requests['video list'] += 1
+        items = []
+        for video_id, time_published in self.latest_uploads(channel_id, 100):
+            hours_ago = max(1, int(self.clock.now - time_published)//HOUR)
+            items.append({'playlistVideoRenderer': {
+                'videoId': video_id,
+                'title': {'simpleText': 'Video ' + video_id},
+                'lengthText': {'simpleText': '10:00'},
+                'publishedTimeText': {'simpleText': '%d hours ago'
+                                                    % hours_ago},
+            }})
+        response = {'responseContext': {}, 'continuationContents': {
+            'playlistVideoListContinuation': {'contents': items}}}
+        return 200, json.dumps([{}, {'response': response}]).encode(), {}
+
+    def fetch_url_response(self, url, headers=(), timeout=15, data=None,
+                           **kwargs):
+        self.requests_per_hour[int(self.clock.now - START_TIME)//HOUR] += 1
+        headers = dict(headers)
+        if url.startswith(self.FEED_URL):
+            status, content, response_headers = self.feed(
+                url[len(self.FEED_URL):], headers)
+        elif 'playlist?ctoken=' in url:
+            ctoken = url.split('ctoken=')[1].split('&')[0]
+            status, content, response_headers = self.video_list(
+                self.ctokens[ctoken])
+        else:
+            # channel tab, used when the video list is empty
+            self.requests['other'] += 1
+            status, content, response_headers = 200, b'{}', {}
+        response = urllib3.response.HTTPResponse(
+            body=io.BytesIO(content), headers=response_headers,
+            status=status, preload_content=False, decode_content=False)
+        return response, (lambda r: None)
+
+
+class TimedConnectionManager(subscriptions.ConnectionManager):
+    def __init__(self):
+        subscriptions.ConnectionManager.__init__(self)
+        self.write_count = 0
+        self.write_seconds = 0.0
+
+    @contextlib.contextmanager
+    def write_connection(self):
+        start_time = time.perf_counter()
+        with subscriptions.ConnectionManager.write_connection(self) as connection:
+            yield connection
+        self.write_count += 1
+        self.write_seconds += time.perf_counter() - start_time
+
+
+class GreenletCPUTimer:
+    '''Adds up the CPU time spent in a greenlet, using greenlet.settrace'''
+    def __init__(self):
+        self.target = None
+        self.seconds = 0.0
+        self.entered = None
+
+    def trace(self, event, args):
+        if event not in ('switch', 'throw'):
+            return
+        origin, target = args
+        now = time.process_time()
+        if origin is self.target and self.entered is not None:
+            self.seconds += now - self.entered
+            self.entered = None
+        if target is self.target:
+            self.entered = now
+
+
+def setup(directory, num_channels, clock):
+    '''Patches subscriptions and util to use the virtual clock, the stand-in
+    for Youtube and a database in directory. Returns the FakeYoutube'''
+    subscriptions.database_path = os.path.join(directory,
+                                               'subscriptions.sqlite')
+    subscriptions.thumbnails_directory = os.path.join(directory, 'thumbnails')
+    subscriptions.connection_manager = TimedConnectionManager()
+    subscriptions.time = clock
+    util.time = clock
+    util.gevent = VirtualGevent(clock)
+    subscriptions.check_channels_queue = util.AdaptiveRateLimitedQueue()
+    subscriptions.check_worker_pool = subscriptions.CheckWorkerPool()
+    subscriptions.autocheck_scheduler.wakeup = VirtualEvent(clock)
+    settings.autocheck_subscriptions = True
+    settings.feed_first_checking = True
+    settings.route_tor = 0
+
+    channel_ids = ['UC' + str(i).zfill(22) for i in range(num_channels)]
+    histories = synthetic_history(num_channels, START_TIME + 30*DAY,
+                                  random.Random(0))
+    fake_youtube = FakeYoutube(clock, channel_ids, histories)
+    util.fetch_url_response = fake_youtube.fetch_url_response
+    playlist.playlist_ctoken = fake_youtube.record_ctoken(
+        playlist.playlist_ctoken)
+
+    with subscriptions.open_database() as connection:
+        with connection as cursor:
+            cursor.executemany(
+                '''INSERT INTO subscribed_channels (yt_channel_id,
+                       channel_name) VALUES (?, ?)''',
+                [(channel_id, channel_id) for channel_id in channel_ids])
+    subscriptions.channel_names.update(
+        (channel_id, channel_id) for channel_id in channel_ids)
+    return fake_youtube
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--channels', type=int, default=10000)
+    parser.add_argument('--days', type=float, default=2)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON')
+    args = parser.parse_args()
+
+    clock = VirtualClock(START_TIME)
+    with tempfile.TemporaryDirectory() as directory:
+        fake_youtube = setup(directory, args.channels, clock)
+        manager = subscriptions.connection_manager
+        memory_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start_time = time.perf_counter()
+        start_cpu = time.process_time()
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull):
+                subscriptions.start_autocheck_system()
+                dispatcher_timer = GreenletCPUTimer()
+                dispatcher_timer.target = subscriptions.dispatcher_greenlet
+                greenlet.settrace(dispatcher_timer.trace)
+                try:
+                    clock.run_until(START_TIME + args.days*DAY)
+                finally:
+                    greenlet.settrace(None)
+                    subscriptions.stop_autocheck_system()
+        wall_seconds = time.perf_counter() - start_time
+        cpu_seconds = time.process_time() - start_cpu
+
+        with subscriptions.open_database(read_only=True) as connection:
+            videos = connection.execute(
+                'SELECT COUNT(*) FROM videos').fetchone()[0]
+        manager.close_all()
+
+    hours = args.days*24
+    total_requests = sum(fake_youtube.requests.values())
+    results = {
+        'channels': args.channels,
+        'virtual_days': args.days,
+        'videos_stored': videos,
+        'requests': dict(fake_youtube.requests),
+        'requests_per_hour': round(total_requests/hours, 1),
+        'peak_requests_per_hour': max(
+            fake_youtube.requests_per_hour.values(), default=0),
+        'final_check_rate': round(subscriptions.check_channels_queue.rate, 2),
+        'write_transactions': manager.write_count,
+        'write_seconds': round(manager.write_seconds, 2),
+        'write_transactions_per_second': round(
+            manager.write_count/max(manager.write_seconds, 1e-9), 1),
+        'dispatcher_cpu_seconds': round(dispatcher_timer.seconds, 3),
+        'total_cpu_seconds': round(cpu_seconds, 2),
+        'wall_seconds': round(wall_seconds, 2),
+        # KiB on Linux
+        'max_rss_mib': round(resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss/1024, 1),
+        'max_rss_growth_mib': round((resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss - memory_before)/1024, 1),
+    }
+    if args.json:
+        print(json.dumps(results))
+        return
+    for key, value in results.items():
+        print('%-32s %s' % (key, value))
+
+
+if __name__ == '__main__':
+    main()
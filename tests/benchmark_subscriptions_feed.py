@@ -0,0 +1,158 @@
+'''Measures how long subscriptions feed queries take on a large synthetic
+database, before and after the schema migrations are applied, and with
+page tokens instead of OFFSET.
+
+Usage: python tests/benchmark_subscriptions_feed.py [number of videos]
+
+Defaults to 1,000,000 videos across 8,000 channels. The database is created
+in a temporary directory and deleted afterwards.
+'''
+import os
+import sys
+import time
+import random
+import sqlite3
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube import subscriptions
+
+NUM_CHANNELS = 8000
+TAGS = ['music', 'news', 'science', 'gaming', 'cooking']
+REPEATS = 5
+
+
+def populate(connection, num_videos):
+    random.seed(0)
+    now = int(time.time())
+    with connection:
+        connection.executemany(
+            '''INSERT INTO subscribed_channels (yt_channel_id, channel_name,
+                   muted)
+               VALUES (?, ?, ?)''',
+            (('UC' + str(i).zfill(22), 'Channel ' + str(i),
+              int(random.random() < 0.05))
+             for i in range(NUM_CHANNELS)))
+        connection.executemany(
+            '''INSERT INTO tag_associations (tag, sql_channel_id)
+               VALUES (?, ?)''',
+            ((random.choice(TAGS), i) for i in range(1, NUM_CHANNELS + 1)
+             if random.random() < 0.3))
+        # A tag with few videos
+        connection.executemany(
+            '''INSERT INTO tag_associations (tag, sql_channel_id)
+               VALUES ('rare', ?)''', [(i,) for i in range(1, 4)])
+
+        def videos():
+            for i in range(num_videos):
+                time_published = now - random.randrange(10*365*24*3600)
+                yield (random.randrange(1, NUM_CHANNELS + 1),
+                       'v' + str(i).zfill(10), 'Video ' + str(i), '10:00',
+                       time_published, 0,
+                       time_published + random.randrange(24*3600),
+                       'Description of video ' + str(i))
+        connection.executemany(
+            '''INSERT INTO videos (sql_channel_id, video_id, title,
+                   duration, time_published, is_time_published_exact,
+                   time_noticed, description)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)''', videos())
+
+
+def measure(name, function):
+    times = []
+    for i in range(REPEATS):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    print('    %-34s %8.1f ms' % (name, min(times)*1000))
+
+
+# The feed queries from before migrations, paging with OFFSET
+LEGACY_FEED_QUERY = '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
+                         FROM videos
+                         INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                         WHERE muted = 0
+                         ORDER BY time_noticed DESC, time_published DESC
+                         LIMIT ? OFFSET ?'''
+LEGACY_TAG_FEED_QUERY = '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
+                             FROM videos
+                             INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                             INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
+                             WHERE tag = ? AND muted = 0
+                             ORDER BY time_noticed DESC, time_published DESC
+                             LIMIT ? OFFSET ?'''
+
+
+def run_legacy_queries(connection):
+    for page in (1, 10, 100):
+        measure('feed page ' + str(page), lambda: connection.execute(
+            LEGACY_FEED_QUERY, (540, (page - 1)*60)).fetchall())
+    for page in (1, 10):
+        measure('tag feed page ' + str(page), lambda: connection.execute(
+            LEGACY_TAG_FEED_QUERY, ('music', 540, (page - 1)*60)).fetchall())
+    measure('channel latest videos', lambda: latest_videos(connection))
+
+
+def get_page_token(connection, page, tag=None):
+    '''Follows the next page tokens to get the token of the given page'''
+    page_token = None
+    for i in range(page - 1):
+        page_token = subscriptions._get_videos(
+            connection, 60, i*60, tag, page_token=page_token)[2]
+    return page_token
+
+
+def run_queries(connection):
+    for page in (1, 10, 100):
+        measure('feed page ' + str(page), lambda: subscriptions._get_videos(
+            connection, 60, (page - 1)*60))
+        page_token = get_page_token(connection, page)
+        measure('feed page ' + str(page) + ' (page token)',
+                lambda: subscriptions._get_videos(
+                    connection, 60, (page - 1)*60, page_token=page_token))
+    for tag in ('music', 'rare'):
+        for page in (1, 10):
+            measure(tag + ' tag feed page ' + str(page),
+                    lambda: subscriptions._get_videos(
+                        connection, 60, (page - 1)*60, tag))
+    measure('channel latest videos', lambda: latest_videos(connection))
+
+
+def latest_videos(connection):
+    channel_id = connection.execute(
+        'SELECT yt_channel_id FROM subscribed_channels LIMIT 1').fetchone()[0]
+    return connection.execute(
+        '''SELECT video_id
+           FROM videos
+           INNER JOIN subscribed_channels
+               ON videos.sql_channel_id = subscribed_channels.id
+           WHERE yt_channel_id=?
+           ORDER BY time_published DESC
+           LIMIT 30''', [channel_id]).fetchall()
+
+
+def main():
+    num_videos = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    with tempfile.TemporaryDirectory() as directory:
+        connection = sqlite3.connect(os.path.join(directory, 'bench.sqlite'))
+        with connection:
+            subscriptions._create_tables(connection)
+        print('Creating database with', num_videos, 'videos')
+        populate(connection, num_videos)
+
+        print('Schema version 1 (no indexes):')
+        run_legacy_queries(connection)
+
+        start_time = time.perf_counter()
+        subscriptions._migrate(connection)
+        print('Migrations took %.1f s' % (time.perf_counter() - start_time))
+
+        print('Schema version', subscriptions.SCHEMA_VERSION, '(old queries):')
+        run_legacy_queries(connection)
+        print('Schema version', subscriptions.SCHEMA_VERSION, '(_get_videos):')
+        run_queries(connection)
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
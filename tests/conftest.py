@@ -4,6 +4,8 @@ import urllib
 import urllib.request
 import socket
 
+from youtube import thumbnails
+
 # https://realpython.com/pytest-python-testing/
 @pytest.fixture(autouse=True)
 def disable_network_calls(monkeypatch):
@@ -12,3 +14,14 @@ def disable_network_calls(monkeypatch):
     monkeypatch.setattr(urllib.request, 'Request', stunted_get)
     monkeypatch.setattr(urllib3.PoolManager, 'request', stunted_get)
     monkeypatch.setattr(socket, 'socket', stunted_get)
+
+
+@pytest.fixture(autouse=True)
+def temporary_thumbnail_store(monkeypatch, tmp_path):
+    monkeypatch.setattr(thumbnails, 'database_path',
+                        str(tmp_path / 'thumbnails.sqlite'))
+    monkeypatch.setattr(thumbnails, 'store_directory',
+                        str(tmp_path / 'thumbnails'))
+    thumbnails.close_database()
+    yield
+    thumbnails.close_database()
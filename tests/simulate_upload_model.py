@@ -0,0 +1,167 @@
+'''Replays the upload history in a subscriptions database to compare when
+channels would have been checked by upload_model and by the scheduling used
+before it, measuring requests per detected video and how long new videos
+took to be noticed.
+
+Usage: python tests/simulate_upload_model.py [options] [database path]
+
+The database defaults to the one in the data directory. Only videos with
+exact publish times are used. Each check counts as one request for the
+Atom feed, plus one for the channel's video list if it found new videos.
+With --synthetic, channels uploading on a weekly slot, daily, in bursts and
+rarely are generated instead.
+'''
+import os
+import sys
+import random
+import sqlite3
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from youtube import upload_model
+import settings
+
+DAY = 24*3600
+WEEK = 7*DAY
+
+
+def legacy_next_check_time(now, uploads, rng):
+    '''The scheduling from before upload_model: a tenth of the average time
+    between the last 5 uploads, rounded up to 4 hours and randomized'''
+    latest = uploads[-5:]
+    if len(latest) == 0:
+        average_upload_period = 4*WEEK
+    else:
+        average_upload_period = int((now - latest[0])/len(latest))
+    quantized_upload_period = (average_upload_period
+                               - (average_upload_period % (4*3600)) + 4*3600)
+    randomized_upload_period = quantized_upload_period*(
+        1 + rng.randrange(50)/50*0.5)
+    return int(now + randomized_upload_period/10)
+
+
+def simulate_channel(uploads, start_time, end_time, policy,
+                     checks_per_upload, rng):
+    '''uploads must be sorted. Returns (number of checks, number of
+    requests, list of detection delays) for the uploads after start_time'''
+    known = [t for t in uploads if t <= start_time]
+    upcoming = [t for t in uploads if start_time < t <= end_time]
+    model = upload_model.UploadModel(reference_time=start_time)
+    for time_published in known:
+        model.add_upload(time_published)
+
+    checks = requests = 0
+    delays = []
+    check_time = start_time
+    while True:
+        if policy == 'model':
+            check_time = model.next_check_time(check_time, checks_per_upload)
+        else:
+            check_time = legacy_next_check_time(check_time, known, rng)
+        if check_time > end_time:
+            break
+        checks += 1
+        requests += 1
+        found = False
+        while upcoming and upcoming[0] <= check_time:
+            time_published = upcoming.pop(0)
+            delays.append(check_time - time_published)
+            known.append(time_published)
+            model.add_upload(time_published)
+            found = True
+        if found:
+            requests += 1
+    return checks, requests, delays
+
+
+def load_history(path):
+    connection = sqlite3.connect('file:' + path + '?mode=ro', uri=True)
+    uploads = {}
+    for channel_id, time_published in connection.execute(
+            '''SELECT sql_channel_id, time_published
+               FROM videos
+               WHERE is_time_published_exact = 1
+               ORDER BY time_published'''):
+        uploads.setdefault(channel_id, []).append(time_published)
+    connection.close()
+    return list(uploads.values())
+
+
+def synthetic_history(num_channels, end_time, rng):
+    history = []
+    for i in range(num_channels):
+        kind = i % 4
+        uploads = []
+        if kind == 0:       # weekly slot, a few minutes late sometimes
+            slot = end_time - rng.randrange(WEEK)
+            uploads = [slot - week*WEEK + rng.randrange(1800)
+                       for week in range(52)]
+        elif kind == 1:     # daily at about the same time
+            slot = end_time - rng.randrange(DAY)
+            uploads = [slot - day*DAY + rng.randrange(3*3600)
+                       for day in range(365) if rng.random() < 0.8]
+        elif kind == 2:     # bursts of several videos a few times a month
+            for burst in range(40):
+                burst_time = end_time - rng.randrange(365*DAY)
+                uploads += [burst_time + rng.randrange(6*3600)
+                            for video in range(rng.randrange(2, 8))]
+        else:               # a few times a year, at any time
+            uploads = [end_time - rng.randrange(365*DAY)
+                       for video in range(rng.randrange(1, 6))]
+        history.append(sorted(t for t in uploads if t <= end_time))
+    return history
+
+
+def report(name, results):
+    checks = sum(result[0] for result in results)
+    requests = sum(result[1] for result in results)
+    delays = sorted(delay for result in results for delay in result[2])
+    print(name)
+    print('    checks:                  ', checks)
+    print('    requests:                ', requests)
+    print('    videos detected:         ', len(delays))
+    if delays:
+        print('    requests per video:       %.2f' % (requests/len(delays)))
+        print('    mean delay (hours):       %.2f'
+              % (statistics.mean(delays)/3600))
+        print('    median delay (hours):     %.2f'
+              % (statistics.median(delays)/3600))
+        print('    90th percentile (hours):  %.2f'
+              % (delays[int(len(delays)*0.9)]/3600))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('database', nargs='?', default=os.path.join(
+        settings.data_dir, 'subscriptions.sqlite'))
+    parser.add_argument('--days', type=int, default=90,
+                        help='Length of the replayed period, at the end of '
+                             'the history')
+    parser.add_argument('--checks-per-upload', type=float,
+                        default=upload_model.CHECKS_PER_UPLOAD)
+    parser.add_argument('--synthetic', type=int, metavar='CHANNELS',
+                        help='Generate this many channels instead of '
+                             'reading the database')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    if args.synthetic:
+        end_time = 1700000000
+        history = synthetic_history(args.synthetic, end_time, rng)
+    else:
+        history = load_history(args.database)
+        end_time = max((uploads[-1] for uploads in history if uploads),
+                       default=0)
+    start_time = end_time - args.days*DAY
+    print('Replaying', len(history), 'channels over', args.days, 'days')
+
+    for policy in ('legacy', 'model'):
+        results = [simulate_channel(uploads, start_time, end_time, policy,
+                                    args.checks_per_upload, rng)
+                   for uploads in history]
+        report(policy, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+from youtube import image_cache
+import settings
+import pytest
+import os
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(image_cache, 'cache_directory', str(tmp_path))
+    monkeypatch.setattr(image_cache, 'database_path',
+                        str(tmp_path / 'index.sqlite'))
+    monkeypatch.setattr(settings, 'image_cache_size', 1, raising=False)
+    return image_cache.ImageCache()
+
+
+@pytest.mark.parametrize('cache_control, expected', [
+    (None, image_cache.DEFAULT_TTL),
+    ('public, max-age=7200', 7200),
+    ('private, max-age=7200', None),
+    ('no-store', None),
+])
+def test_get_ttl(cache_control, expected):
+    assert image_cache.get_ttl(cache_control) == expected
+
+
+def test_store_and_lookup(cache):
+    assert cache.lookup('https://i.ytimg.com/a.jpg') is None
+    image = cache.store('https://i.ytimg.com/a.jpg', b'image', 'image/jpeg',
+                        '"upstream"', None, 60)
+    found = cache.lookup('https://i.ytimg.com/a.jpg')
+    assert found.is_fresh()
+    assert found.etag == '"upstream"'
+    assert found.local_etag() == image.local_etag()
+    assert cache.read(found) == b'image'
+
+
+def test_same_content_stored_once(cache):
+    first = cache.store('https://i.ytimg.com/a.jpg', b'image', 'image/jpeg',
+                        None, None, 60)
+    cache.store('https://yt3.ggpht.com/b.jpg', b'image', 'image/jpeg',
+                None, None, 60)
+    assert cache.total_size == len(b'image')
+
+    # replacing one url's content must not delete the shared image
+    cache.store('https://i.ytimg.com/a.jpg', b'other', 'image/jpeg',
+                None, None, 60)
+    assert os.path.exists(cache.blob_path(first.content_hash))
+    assert cache.read(cache.lookup('https://yt3.ggpht.com/b.jpg')) == b'image'
+
+
+def test_eviction(cache):
+    cache.store('https://i.ytimg.com/old.jpg', b'a'*(600*1024), 'image/jpeg',
+                None, None, 60)
+    old_hash = cache.lookup('https://i.ytimg.com/old.jpg').content_hash
+    cache.store('https://i.ytimg.com/new.jpg', b'b'*(600*1024), 'image/jpeg',
+                None, None, 60)
+    assert cache.lookup('https://i.ytimg.com/old.jpg') is None
+    assert not os.path.exists(cache.blob_path(old_hash))
+    assert cache.lookup('https://i.ytimg.com/new.jpg') is not None
+    assert cache.total_size == 600*1024
@@ -0,0 +1,121 @@
+from youtube import local_playlist, thumbnails
+import pytest
+import json
+import os
+
+
+@pytest.fixture
+def playlists(monkeypatch, tmp_path):
+    monkeypatch.setattr(local_playlist, 'database_path',
+                        str(tmp_path / 'playlists.sqlite'))
+    monkeypatch.setattr(local_playlist, 'playlists_directory',
+                        str(tmp_path / 'playlists'))
+    monkeypatch.setattr(local_playlist, 'thumbnails_directory',
+                        str(tmp_path / 'playlist_thumbnails'))
+    downloads = []
+    monkeypatch.setattr(local_playlist.util, 'download_thumbnails',
+                        lambda directory, ids: downloads.extend(ids))
+    local_playlist.close_database()
+    yield downloads
+    local_playlist.close_database()
+
+
+def video(video_id):
+    return json.dumps({'id': video_id, 'title': 'title ' + video_id})
+
+
+def test_add_and_remove(playlists):
+    local_playlist.add_to_playlist('a', [video('v1'), video('v2')])
+    local_playlist.add_to_playlist('a', [video('v2'), video('v3')])
+    # thumbnails only downloaded for videos that weren't there already
+    assert playlists == ['v1', 'v2', 'v3']
+    assert local_playlist.video_ids_in_playlist('a') == {'v1', 'v2', 'v3'}
+    assert local_playlist.video_ids_in_playlist('b') == set()
+
+    assert local_playlist.remove_from_playlist('a', [video('v2')]) == 2
+    assert local_playlist.video_ids_in_playlist('a') == {'v1', 'v3'}
+    assert [v['id'] for v in local_playlist.read_playlist('a')] == ['v1', 'v3']
+
+    local_playlist.add_to_playlist('b', [video('v1')])
+    assert list(local_playlist.get_playlist_names()) == ['a', 'b']
+    local_playlist.remove_playlist('a')
+    assert list(local_playlist.get_playlist_names()) == ['b']
+    assert local_playlist.read_playlist('a') == []
+
+
+def test_pages(playlists):
+    local_playlist.add_to_playlist('a', [video('v' + str(i))
+                                         for i in range(120)])
+    videos, total = local_playlist.get_local_playlist_videos(
+        'a', offset=100, amount=50, extra_info=False)
+    assert total == 120
+    assert [v['id'] for v in videos] == ['v' + str(i) for i in range(100, 120)]
+
+
+def test_import_text_playlists(playlists, tmp_path):
+    directory = tmp_path / 'playlists'
+    directory.mkdir()
+    (directory / 'old.txt').write_text(
+        video('v1') + '\n' + 'corrupt\n' + video('v2') + '\n' + video('v1')
+        + '\n', encoding='utf-8')
+    assert list(local_playlist.get_playlist_names()) == ['old']
+    assert [v['id'] for v in local_playlist.read_playlist('old')] == [
+        'v1', 'v2']
+    assert not (directory / 'old.txt').exists()
+    assert (directory / 'old.txt.imported').exists()
+
+    # files added later are imported too
+    (directory / 'new.txt').write_text(video('v3') + '\n', encoding='utf-8')
+    assert list(local_playlist.get_playlist_names()) == ['new', 'old']
+
+    # the imported file goes with the playlist
+    local_playlist.remove_playlist('old')
+    assert not (directory / 'old.txt.imported').exists()
+    assert (directory / 'new.txt.imported').exists()
+
+
+def test_catalog(playlists):
+    local_playlist.add_to_playlist('b', [video('v1'), video('v2')])
+    local_playlist.add_to_playlist('a', [video('v1')])
+    catalog = local_playlist.get_playlist_catalog()
+    assert [(p.name, p.video_count) for p in catalog] == [('a', 1), ('b', 2)]
+    assert catalog[0].time_modified > 0
+    # cached until something changes
+    assert local_playlist.get_playlist_catalog() is catalog
+
+    local_playlist.remove_from_playlist('b', [video('v1')])
+    assert local_playlist.get_playlist_catalog()[1].video_count == 1
+    local_playlist.remove_playlist('a')
+    assert local_playlist.get_playlist_names() == ['b']
+
+    # changes not made through this module are noticed by the mtime
+    with local_playlist.open_database() as connection:
+        with connection as cursor:
+            cursor.execute("INSERT INTO playlists (name) VALUES ('c')")
+    # in case the write landed within the filesystem's mtime resolution
+    os.utime(local_playlist.database_path, ns=(0, 0))
+    assert local_playlist.get_playlist_names() == ['b', 'c']
+
+
+def test_shared_thumbnails(playlists, tmp_path):
+    local_playlist.add_to_playlist('a', [video('v1'), video('v2')])
+    path = thumbnails.save('v1', b'image')
+    # already stored, so not downloaded again
+    local_playlist.add_to_playlist('b', [video('v1'), video('v3')])
+    assert playlists == ['v1', 'v2', 'v3']
+
+    local_playlist.remove_playlist('a')
+    assert os.path.exists(path)
+    local_playlist.remove_from_playlist('b', [video('v1')])
+    assert not os.path.exists(path)
+
+    # thumbnails saved for a playlist before the store are moved into it
+    legacy_path = tmp_path / 'playlist_thumbnails' / 'b' / 'v3.jpg'
+    legacy_path.parent.mkdir(parents=True)
+    legacy_path.write_bytes(b'image')
+    videos, total = local_playlist.get_local_playlist_videos('b')
+    assert videos[0]['thumbnail'].endswith('/data/thumbnails/v3.jpg')
+    assert thumbnails.find('v3') is not None
+    local_playlist.remove_playlist('b')
+    assert thumbnails.find('v3') is None
+    assert not legacy_path.parent.exists()
@@ -0,0 +1,63 @@
+from youtube import offload
+import settings
+import json
+import pytest
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(settings, 'extraction_processes', 1, raising=False)
+    monkeypatch.setattr(settings, 'extraction_offload_threshold', 1,
+                        raising=False)
+    yield
+    offload.shutdown_executor()
+
+
+def count_items(polymer_json, key):
+    return len(polymer_json[key])
+
+
+def test_small_payload_inline(enabled):
+    inline_count = offload.inline_count
+    assert offload.run(json.loads, '[1, 2]') == [1, 2]
+    assert offload.inline_count == inline_count + 1
+
+
+def test_offloaded(enabled):
+    offloaded_count = offload.offloaded_count
+    text = json.dumps({'items': list(range(1000))})
+    result = offload.run(offload.json_then, text, count_items, 'items')
+    assert result == 1000
+    assert offload.offloaded_count == offloaded_count + 1
+    # the time the hub spent unpickling the result isn't counted as saved
+    assert offload.unpickle_seconds > 0
+    assert offload.report()[0][2] == 'Unpickling seconds'
+
+
+def test_exception_propagates(enabled):
+    with pytest.raises(json.JSONDecodeError):
+        offload.run(json.loads, 'x'*2048)
+
+
+class OldExecutor:
+    '''Has the signature of shutdown before Python 3.9'''
+    def __init__(self):
+        self.shut_down = False
+
+    def shutdown(self, wait=True):
+        self.shut_down = True
+
+
+def test_setting_hook_shuts_down_executor(monkeypatch):
+    old_executor = OldExecutor()
+    monkeypatch.setattr(offload, 'executor', old_executor)
+    future = offload.concurrent.futures.Future()
+    offload.pending_futures.add(future)
+    try:
+        for hook in settings.hooks['extraction_processes']:
+            hook(1, 2)
+    finally:
+        offload.pending_futures.discard(future)
+    assert old_executor.shut_down
+    assert offload.executor is None
+    assert future.cancelled()
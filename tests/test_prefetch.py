@@ -0,0 +1,53 @@
+from youtube import prefetch
+import settings
+import gevent
+
+
+def test_runs_once_per_key():
+    prefetcher = prefetch.Prefetcher()
+    calls = []
+    prefetcher.schedule('a', calls.append, 1)
+    prefetcher.schedule('a', calls.append, 2)
+    gevent.sleep(0.05)
+    assert calls == [1]
+    assert prefetcher.completed == 1
+    assert prefetcher.in_flight == {}
+
+
+def test_waits_for_page_requests(monkeypatch):
+    monkeypatch.setattr(prefetch, 'page_requests_in_progress', 1)
+    monkeypatch.setattr(prefetch, 'IDLE_POLL_INTERVAL', 0.01)
+    prefetcher = prefetch.Prefetcher()
+    calls = []
+    prefetcher.schedule('a', calls.append, 1)
+    gevent.sleep(0.05)
+    assert calls == []
+
+    # the page requesting the same thing cancels the prefetch
+    prefetcher.wait('a')
+    assert prefetcher.in_flight == {}
+    prefetch.page_requests_in_progress = 0
+    gevent.sleep(0.05)
+    assert calls == []
+
+
+def test_wait_joins_running_job():
+    prefetcher = prefetch.Prefetcher()
+    calls = []
+    def job():
+        gevent.sleep(0.05)
+        calls.append(1)
+    prefetcher.schedule('a', job)
+    gevent.sleep(0.01)
+    prefetcher.wait('a')
+    assert calls == [1]
+
+
+def test_bandwidth_budget(monkeypatch):
+    monkeypatch.setattr(settings, 'prefetch_bandwidth_limit', 1,
+                        raising=False)
+    prefetcher = prefetch.Prefetcher()
+    assert prefetcher.use_bandwidth(700*1024)
+    assert not prefetcher.use_bandwidth(700*1024)
+    assert prefetcher.use_bandwidth(300*1024)
+    assert prefetcher.over_budget == 1
@@ -0,0 +1,61 @@
+from youtube import read_ahead
+import settings
+import pytest
+import gevent
+
+
+@pytest.fixture
+def buffer(monkeypatch):
+    monkeypatch.setattr(settings, 'video_read_ahead_client_limit', 1,
+                        raising=False)
+    monkeypatch.setattr(settings, 'video_read_ahead_total_limit', 2,
+                        raising=False)
+    return read_ahead.ReadAheadBuffer()
+
+
+def fake_fetch(start, end):
+    gevent.sleep(0.01)
+    return bytes(i % 256 for i in range(start, end))
+
+
+def test_sequential_hit(buffer):
+    buffer.prefetch('stream', 'client', 100, 200, fake_fetch)
+    assert buffer.take('stream', 100, 200) == fake_fetch(100, 200)
+    assert buffer.hits == 1
+    assert buffer.ranges == {}
+
+
+def test_larger_prefetch_is_kept_for_next_request(buffer):
+    buffer.prefetch('stream', 'client', 100, 200, fake_fetch)
+    assert buffer.take('stream', 100, 150) == fake_fetch(100, 150)
+    assert buffer.take('stream', 150, 250) == fake_fetch(150, 200)
+    assert buffer.hits == 2
+
+
+def test_seek_drops_data(buffer):
+    buffer.prefetch('stream', 'client', 100, 200, fake_fetch)
+    assert buffer.take('stream', 5000, 6000) == b''
+    assert buffer.seek_drops == 1
+    assert buffer.ranges == {}
+
+
+def test_memory_limits(buffer):
+    mib = 1024*1024
+    buffer.prefetch('stream1', 'client1', 0, mib, fake_fetch)
+    # over the per client limit
+    buffer.prefetch('stream2', 'client1', 0, 100, fake_fetch)
+    assert 'stream2' not in buffer.ranges
+    buffer.prefetch('stream3', 'client2', 0, mib, fake_fetch)
+    # over the total limit
+    buffer.prefetch('stream4', 'client3', 0, 100, fake_fetch)
+    assert 'stream4' not in buffer.ranges
+    assert buffer.limit_skips == 2
+    for stream_key in list(buffer.ranges):
+        buffer.discard(stream_key)
+
+
+def test_failed_fetch(buffer):
+    def failing_fetch(start, end):
+        raise OSError('connection failed')
+    buffer.prefetch('stream', 'client', 0, 100, failing_fetch)
+    assert buffer.take('stream', 0, 100) == b''
@@ -0,0 +1,54 @@
+from youtube import response_cache
+import settings
+import pytest
+import time
+
+
+@pytest.fixture
+def cache(monkeypatch, tmp_path):
+    monkeypatch.setattr(response_cache, 'cache_directory', str(tmp_path))
+    monkeypatch.setattr(settings, 'response_cache_memory_size', 1,
+                        raising=False)
+    monkeypatch.setattr(settings, 'response_cache_disk_size', 0,
+                        raising=False)
+    return response_cache.ResponseCache()
+
+
+def test_get_and_put(cache):
+    assert cache.get(('GET', 'a')) is None
+    cache.put(('GET', 'a'), b'content', 60)
+    assert cache.get(('GET', 'a')) == b'content'
+    assert cache.get(('POST', 'a')) is None
+    assert (cache.memory_hits, cache.misses) == (1, 2)
+
+
+def test_expiry(cache, monkeypatch):
+    cache.put('a', b'content', 60)
+    now = time.time()
+    monkeypatch.setattr(time, 'time', lambda: now + 61)
+    assert cache.get('a') is None
+    assert cache.memory_size == 0
+
+
+def test_memory_eviction(cache):
+    half = b'x'*(512*1024)
+    cache.put('a', half, 60)
+    cache.put('b', half, 60)
+    cache.get('a')
+    cache.put('c', half, 60)
+    assert cache.get('b') is None
+    assert cache.get('a') == half
+    assert cache.get('c') == half
+    assert cache.memory_size <= 1024*1024
+
+
+def test_disk(cache, monkeypatch):
+    monkeypatch.setattr(settings, 'response_cache_disk_size', 1)
+    cache.put('a', b'content', 60)
+
+    # a new instance, as after restarting, finds it on disk
+    restarted = response_cache.ResponseCache()
+    assert restarted.get('a') == b'content'
+    assert restarted.disk_hits == 1
+    assert restarted.get('a') == b'content'
+    assert restarted.memory_hits == 1
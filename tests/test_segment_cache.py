@@ -0,0 +1,84 @@
+from youtube import segment_cache
+import settings
+import pytest
+import os
+
+
+@pytest.mark.parametrize('extents, new, expected', [
+    ([], (0, 10), [[0, 10]]),
+    ([[0, 10]], (10, 20), [[0, 20]]),
+    ([[0, 10], [20, 30]], (5, 25), [[0, 30]]),
+    ([[0, 10], [20, 30]], (12, 15), [[0, 10], [12, 15], [20, 30]]),
+    ([[10, 20]], (0, 5), [[0, 5], [10, 20]]),
+    ([[0, 10], [20, 30], [40, 50]], (15, 45), [[0, 10], [15, 50]]),
+    ([[0, 10]], (3, 3), [[0, 10]]),
+])
+def test_add_extent(extents, new, expected):
+    segment_cache.add_extent(extents, *new)
+    assert extents == expected
+
+
+@pytest.mark.parametrize('extents, requested, expected', [
+    ([], (0, 10), [(0, 10, False)]),
+    ([[0, 10]], (2, 8), [(2, 8, True)]),
+    ([[0, 10], [20, 30]], (5, 25),
+        [(5, 10, True), (10, 20, False), (20, 25, True)]),
+    ([[10, 20]], (0, 30), [(0, 10, False), (10, 20, True), (20, 30, False)]),
+    ([[0, 10]], (10, 15), [(10, 15, False)]),
+])
+def test_split_range(extents, requested, expected):
+    assert segment_cache.split_range(extents, *requested) == expected
+
+
+def test_write_read_and_evict(monkeypatch, tmp_path):
+    monkeypatch.setattr(segment_cache, 'cache_directory', str(tmp_path))
+    monkeypatch.setattr(segment_cache, 'index_path',
+                        str(tmp_path / 'index.json'))
+    monkeypatch.setattr(settings, 'video_cache_size', 1, raising=False)
+    cache = segment_cache.SegmentCache()
+
+    query = 'id=abc&itag=18&clen=%d&mime=video%%2Fmp4' % (1024*1024)
+    entry = cache.get_entry(query)
+    entry.write(100, b'x'*50)
+    entry.write(150, b'y'*50)
+    assert entry.extents == [[100, 200]]
+    assert b''.join(entry.read(140, 160)) == b'x'*10 + b'y'*10
+    cache.commit(entry)
+    # the index isn't saved on every commit, only when the response ends
+    assert not (tmp_path / 'index.json').exists()
+    cache.finish()
+
+    # reloaded from the saved index
+    assert segment_cache.SegmentCache().entries[entry.key].extents == [
+        [100, 200]]
+
+    # filling a second stream past the 1 MiB budget evicts the first one
+    entry.last_access = 0
+    other_query = 'id=def&itag=18&clen=%d&mime=video%%2Fmp4' % (1024*1024)
+    other_entry = cache.get_entry(other_query)
+    other_entry.write(0, b'z'*(1024*1024))
+    cache.commit(other_entry)
+    assert entry.key not in cache.entries
+    assert not os.path.exists(entry.path)
+    assert other_entry.key in cache.entries
+    # saved on eviction
+    assert set(segment_cache.SegmentCache().entries) == {other_entry.key}
+
+
+def test_index_saved_periodically(monkeypatch, tmp_path):
+    monkeypatch.setattr(segment_cache, 'cache_directory', str(tmp_path))
+    monkeypatch.setattr(segment_cache, 'index_path',
+                        str(tmp_path / 'index.json'))
+    monkeypatch.setattr(settings, 'video_cache_size', 1, raising=False)
+    cache = segment_cache.SegmentCache()
+    entry = cache.get_entry('id=abc&itag=18&clen=1000&mime=video%2Fmp4')
+    entry.write(0, b'x'*100)
+    cache.commit(entry)
+    assert not (tmp_path / 'index.json').exists()
+
+    cache.index_save_time -= segment_cache.INDEX_SAVE_INTERVAL
+    entry.write(100, b'x'*100)
+    cache.commit(entry)
+    assert segment_cache.SegmentCache().entries[entry.key].extents == [
+        [0, 200]]
+    assert not cache.index_changed
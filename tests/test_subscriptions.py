@@ -0,0 +1,335 @@
+from youtube import subscriptions, thumbnails, yt_app
+import pytest
+import sqlite3
+import gevent
+import time
+
+
+def test_autocheck_scheduler_order():
+    scheduler = subscriptions.AutocheckScheduler()
+    scheduler.load([('UCa', 30), ('UCb', 10), ('UCc', 20)])
+    assert scheduler.peek() == (10, 'UCb')
+    scheduler.schedule('UCd', 5)
+    assert scheduler.pop() == (5, 'UCd')
+    assert scheduler.pop() == (10, 'UCb')
+    assert len(scheduler) == 2
+
+
+def test_autocheck_scheduler_reschedule_and_cancel():
+    scheduler = subscriptions.AutocheckScheduler()
+    scheduler.load([('UCa', 10), ('UCb', 20)])
+    scheduler.schedule('UCa', 30)
+    assert scheduler.peek() == (20, 'UCb')
+    scheduler.cancel('UCb')
+    assert scheduler.pop() == (30, 'UCa')
+    assert scheduler.peek() is None
+    assert len(scheduler) == 0
+
+
+def test_autocheck_scheduler_compacts():
+    scheduler = subscriptions.AutocheckScheduler()
+    for i in range(1000):
+        scheduler.schedule('UCa', i)
+    assert len(scheduler.heap) < 100
+    assert scheduler.pop() == (999, 'UCa')
+
+
+@pytest.fixture
+def manager(monkeypatch, tmp_path):
+    monkeypatch.setattr(subscriptions, 'database_path',
+                        str(tmp_path / 'subscriptions.sqlite'))
+    manager = subscriptions.ConnectionManager()
+    yield manager
+    manager.close_all()
+
+
+def test_connection_manager_reuses_connections(manager):
+    with manager.write_connection() as connection:
+        mode = connection.execute('PRAGMA journal_mode').fetchone()[0]
+        assert mode == 'wal'
+        writer = connection
+    with manager.write_connection() as connection:
+        assert connection is writer
+    with manager.read_connection() as connection:
+        reader = connection
+    with manager.read_connection() as connection:
+        assert connection is reader
+
+
+def test_connection_manager_reads_during_write(manager):
+    with manager.write_connection() as connection:
+        with connection as cursor:
+            cursor.execute('''INSERT INTO subscribed_channels
+                              (yt_channel_id, channel_name) VALUES (?, ?)''',
+                           ['UCa', 'a'])
+
+    with manager.write_connection() as connection:
+        connection.execute('''INSERT INTO subscribed_channels
+                              (yt_channel_id, channel_name) VALUES (?, ?)''',
+                           ['UCb', 'b'])
+        # uncommitted write doesn't block or show up in reads
+        with manager.read_connection() as reader:
+            count = reader.execute(
+                'SELECT COUNT(*) FROM subscribed_channels').fetchone()[0]
+            assert count == 1
+    # left uncommitted, so rolled back
+    with manager.read_connection() as reader:
+        count = reader.execute(
+            'SELECT COUNT(*) FROM subscribed_channels').fetchone()[0]
+        assert count == 1
+
+
+def test_connection_manager_readers_are_read_only(manager):
+    with manager.read_connection() as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute('DELETE FROM subscribed_channels')
+
+
+def test_migrations(tmp_path):
+    connection = sqlite3.connect(str(tmp_path / 'old.sqlite'))
+    # database from before migrations existed, with no row in db_info
+    with connection:
+        subscriptions._create_tables(connection)
+    subscriptions._migrate(connection)
+    version = connection.execute('SELECT version FROM db_info').fetchall()
+    assert version == [(subscriptions.SCHEMA_VERSION,)]
+    indexes = [row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")]
+    assert 'videos_feed' in indexes
+
+    # running again does nothing
+    subscriptions._migrate(connection)
+    version = connection.execute('SELECT version FROM db_info').fetchall()
+    assert version == [(subscriptions.SCHEMA_VERSION,)]
+    connection.close()
+
+
+def add_videos(connection, channels, videos_per_channel):
+    with connection as cursor:
+        for i, (channel_id, tag, muted) in enumerate(channels):
+            cursor.execute('''INSERT INTO subscribed_channels
+                              (yt_channel_id, channel_name, muted)
+                              VALUES (?, ?, ?)''', [channel_id, channel_id,
+                                                    muted])
+            if tag:
+                subscriptions._add_tags(cursor, [channel_id], [tag])
+            cursor.executemany(
+                '''INSERT INTO videos (sql_channel_id, video_id, title,
+                       time_published, time_noticed)
+                   VALUES ((SELECT id FROM subscribed_channels
+                            WHERE yt_channel_id = ?), ?, ?, ?, ?)''',
+                [(channel_id, channel_id + str(j), 'title', 1000 + j,
+                  1000 + j//2) for j in range(videos_per_channel)])
+
+
+def test_video_counts(manager):
+    with manager.write_connection() as connection:
+        add_videos(connection, [('UCa', 'music', 0), ('UCb', None, 0),
+                                ('UCc', 'music', 1)], 10)
+        assert subscriptions._count_videos(connection) == 20
+        assert subscriptions._count_videos(connection, 'music') == 10
+        with connection as cursor:
+            subscriptions._unsubscribe(cursor, ['UCa'])
+        assert subscriptions._count_videos(connection) == 10
+        assert subscriptions._count_videos(connection, 'music') == 0
+
+
+@pytest.mark.parametrize('tag', [None, 'music'])
+def test_page_tokens(manager, tag):
+    with manager.write_connection() as connection:
+        add_videos(connection, [('UCa', 'music', 0), ('UCb', 'music', 0),
+                                ('UCc', 'music', 1)], 25)
+        videos, total, next_token, previous_token = subscriptions._get_videos(
+            connection, 20, 0, tag)
+        assert total == 50
+        assert previous_token is None
+        pages = [videos]
+        while next_token:
+            videos, total, next_token, previous_token = (
+                subscriptions._get_videos(connection, 20, 0, tag,
+                                          page_token=next_token))
+            pages.append(videos)
+        assert [len(page) for page in pages] == [20, 20, 10]
+
+        # same pages as with offsets
+        for i, page in enumerate(pages):
+            assert page == subscriptions._get_videos(connection, 20, i*20,
+                                                     tag)[0]
+
+        # and going back
+        videos, total, next_token, previous_token = subscriptions._get_videos(
+            connection, 20, 40, tag, page_token=previous_token)
+        assert videos == pages[1]
+        videos, total, next_token, previous_token = subscriptions._get_videos(
+            connection, 20, 20, tag, page_token=previous_token)
+        assert videos == pages[0]
+        assert previous_token is None
+
+
+def test_invalid_page_token():
+    with pytest.raises(ValueError):
+        subscriptions.decode_page_token('not a token')
+
+
+def make_feed(video_ids):
+    entries = ''.join(
+        '''<entry><yt:videoId>%s</yt:videoId>
+           <published>2020-01-0%dT00:00:00+00:00</published></entry>'''
+        % (video_id, 9 - i) for i, video_id in enumerate(video_ids))
+    return ('<feed xmlns="http://www.w3.org/2005/Atom" '
+            'xmlns:yt="http://www.youtube.com/xml/schemas/2015">'
+            + entries + '</feed>')
+
+
+def make_channel_info(video_ids):
+    return {'error': None, 'items': [
+        {'id': video_id, 'title': 'title', 'duration': '1:00',
+         'time_published': '1 day ago', 'description': None}
+        for video_id in video_ids]}
+
+
+def test_feed_first_checking(manager, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'connection_manager', manager)
+    monkeypatch.setattr(subscriptions.settings, 'feed_first_checking', True)
+    monkeypatch.setattr(subscriptions.settings, 'autocheck_subscriptions',
+                        False)
+    monkeypatch.setattr(subscriptions, 'feed_videos_not_listed', {})
+    feed_ids = ['v2', 'short', 'v1']
+    list_ids = ['v2', 'v1']
+    list_downloads = []
+    monkeypatch.setattr(subscriptions, '_get_atoma_feed',
+                        lambda channel_id, validators: make_feed(feed_ids))
+
+    def get_video_list(channel_id, channel_status_name):
+        list_downloads.append(channel_id)
+        return make_channel_info(list_ids)
+    monkeypatch.setattr(subscriptions, '_get_channel_videos_first_page',
+                        get_video_list)
+    with manager.write_connection() as connection:
+        add_videos(connection, [('UCa', None, 0)], 0)
+
+    # first check always downloads the video list
+    assert not subscriptions._get_upstream_videos('UCa')
+    assert len(list_downloads) == 1
+    # the short isn't in the list, so it doesn't count as new later
+    assert subscriptions._get_upstream_videos('UCa')
+    assert len(list_downloads) == 1
+
+    feed_ids.insert(0, 'v3')
+    list_ids.insert(0, 'v3')
+    assert not subscriptions._get_upstream_videos('UCa')
+    assert len(list_downloads) == 2
+    assert subscriptions._get_upstream_videos('UCa')
+
+    # videos missing durations are downloaded again until they have one
+    with manager.write_connection() as connection:
+        with connection as cursor:
+            cursor.execute("UPDATE videos SET duration = NULL "
+                           "WHERE video_id = 'v3'")
+    assert not subscriptions._get_upstream_videos('UCa')
+    assert subscriptions._get_upstream_videos('UCa')
+    assert len(list_downloads) == 3
+
+    with manager.read_connection() as connection:
+        model = subscriptions._get_upload_model(connection, 'UCa')
+        next_check_time = connection.execute(
+            'SELECT next_check_time FROM subscribed_channels').fetchone()[0]
+    # built from the exact times in the feed
+    assert model.start_time == 1578355200    # v1, 2020-01-07
+    assert next_check_time > time.time()
+
+
+def test_feed_not_modified(manager, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'connection_manager', manager)
+    monkeypatch.setattr(subscriptions.settings, 'feed_first_checking', True)
+    monkeypatch.setattr(subscriptions.settings, 'autocheck_subscriptions',
+                        False)
+    sent_validators = []
+
+    def get_atoma_feed(channel_id, validators):
+        sent_validators.append(dict(validators))
+        if validators.get('etag') == 'v1':
+            return None
+        validators['etag'] = 'v1'
+        return make_feed(['v1'])
+    monkeypatch.setattr(subscriptions, '_get_atoma_feed', get_atoma_feed)
+    monkeypatch.setattr(subscriptions, '_get_channel_videos_first_page',
+                        lambda channel_id, channel_status_name:
+                            make_channel_info(['v1']))
+    with manager.write_connection() as connection:
+        add_videos(connection, [('UCa', None, 0)], 0)
+
+    assert subscriptions._get_upstream_videos('UCa') is None
+    assert sent_validators[0] == {}
+    assert subscriptions._get_upstream_videos('UCa') == 'not_modified'
+    assert sent_validators[1]['etag'] == 'v1'
+
+    # the whole feed is needed to see if missing durations are filled in
+    with manager.write_connection() as connection:
+        with connection as cursor:
+            cursor.execute("UPDATE videos SET duration = NULL")
+    assert subscriptions._get_upstream_videos('UCa') is None
+    assert sent_validators[2] == {}
+
+
+def test_check_worker_pool(monkeypatch):
+    monkeypatch.setattr(subscriptions, 'check_channels_queue',
+                        subscriptions.util.AdaptiveRateLimitedQueue(
+                            initial_rate=1000, burst=1000))
+    monkeypatch.setattr(subscriptions, 'check_worker_pool',
+                        subscriptions.CheckWorkerPool())
+    monkeypatch.setattr(subscriptions.CheckWorkerPool, 'IDLE_TIMEOUT', 0.1)
+    monkeypatch.setattr(subscriptions.settings, 'subscription_check_workers',
+                        3)
+    concurrent = []
+    running = set()
+
+    def get_upstream_videos(channel_id):
+        running.add(channel_id)
+        concurrent.append(len(running))
+        gevent.sleep(0.05)
+        running.remove(channel_id)
+    monkeypatch.setattr(subscriptions, '_get_upstream_videos',
+                        get_upstream_videos)
+
+    pool = subscriptions.check_worker_pool
+    subscriptions.check_channels_if_necessary(['UCa'])
+    assert len(pool.workers) == 1
+    subscriptions.check_channels_if_necessary(['UC' + str(i)
+                                               for i in range(10)])
+    assert len(pool.workers) == 3
+    while subscriptions.checking_channels:
+        gevent.sleep(0.01)
+    assert max(concurrent) == 3
+    assert subscriptions.check_rounds[-1].channels_checked == 11
+
+    # idle workers stop
+    gevent.sleep(0.3)
+    assert len(pool.workers) == 0
+    assert pool.idle_workers == 0
+
+
+def test_thumbnails_only_stored_for_feed_videos(manager, monkeypatch):
+    monkeypatch.setattr(subscriptions, 'connection_manager', manager)
+    monkeypatch.setattr(subscriptions.util, 'fetch_url',
+                        lambda url, report_text=None: b'image')
+    with manager.write_connection() as connection:
+        add_videos(connection, [('UCa', None, 0)], 1)
+    client = yt_app.test_client()
+
+    response = client.get('/data/subscription_thumbnails/UCa0.jpg')
+    assert response.data == b'image'
+    assert thumbnails.find('UCa0') is not None
+    assert thumbnails.has_reference(thumbnails.SUBSCRIPTIONS, 'UCa0')
+
+    # not in the feed, so passed through without being stored
+    response = client.get('/data/subscription_thumbnails/other.jpg')
+    assert response.data == b'image'
+    assert thumbnails.find('other') is None
+    assert not thumbnails.has_reference(thumbnails.SUBSCRIPTIONS, 'other')
+
+    with manager.write_connection() as connection:
+        with connection as cursor:
+            subscriptions._unsubscribe(cursor, ['UCa'])
+    gevent.sleep(0)
+    assert thumbnails.find('UCa0') is None
@@ -0,0 +1,62 @@
+from youtube import thumbnails, yt_app
+import os
+
+
+def test_references(tmp_path):
+    path = thumbnails.save('abcdefghijk', b'image')
+    assert path == os.path.join(thumbnails.store_directory, 'ab',
+                                'abcdefghijk.jpg')
+    thumbnails.add_references('playlist:a', ['abcdefghijk'])
+    thumbnails.add_references(thumbnails.SUBSCRIPTIONS, ['abcdefghijk'])
+    assert thumbnails.has_reference('playlist:a', 'abcdefghijk')
+
+    thumbnails.remove_references('playlist:a', ['abcdefghijk'])
+    assert not thumbnails.has_reference('playlist:a', 'abcdefghijk')
+    assert thumbnails.find('abcdefghijk') == path
+    # deleted once the last reference is gone
+    thumbnails.remove_references(thumbnails.SUBSCRIPTIONS, ['abcdefghijk'])
+    assert thumbnails.find('abcdefghijk') is None
+    assert not os.path.exists(path)
+
+
+def test_legacy_thumbnails(tmp_path):
+    legacy_path = tmp_path / 'old' / 'abcdefghijk.jpg'
+    legacy_path.parent.mkdir()
+    legacy_path.write_bytes(b'image')
+    assert thumbnails.find('abcdefghijk') is None
+    path = thumbnails.find('abcdefghijk', [str(tmp_path / 'missing.jpg'),
+                                           str(legacy_path)])
+    assert open(path, 'rb').read() == b'image'
+    assert not legacy_path.exists()
+
+
+def test_invalid_video_ids():
+    assert thumbnails.find('../../etc') is None
+    assert not thumbnails.is_valid_video_id('a/b')
+
+
+def test_conditional_serving():
+    thumbnails.save('abcdefghijk', b'image')
+    client = yt_app.test_client()
+    response = client.get('/data/thumbnails/abcdefghijk.jpg')
+    assert response.status_code == 200
+    assert response.data == b'image'
+    assert response.headers['Content-Length'] == '5'
+    assert 'immutable' in response.headers['Cache-Control']
+    etag = response.headers['ETag']
+    assert not etag.startswith('W/')
+
+    response = client.get('/data/thumbnails/abcdefghijk.jpg',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert response.headers['ETag'] == etag
+
+    # a new file has a new ETag
+    thumbnails.save('abcdefghijk', b'new image')
+    response = client.get('/data/thumbnails/abcdefghijk.jpg',
+                          headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == b'new image'
+
+    assert client.get('/data/thumbnails/missing.jpg').status_code == 404
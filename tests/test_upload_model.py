@@ -0,0 +1,51 @@
+from youtube import upload_model
+from youtube.upload_model import UploadModel, WEEK
+
+# A Friday at 18:00 UTC
+FRIDAY_EVENING = 1700244000
+
+
+def weekly_uploader(weeks):
+    model = UploadModel(reference_time=FRIDAY_EVENING)
+    for i in range(weeks):
+        model.add_upload(FRIDAY_EVENING - i*WEEK + 300)
+    return model
+
+
+def test_upload_rate():
+    model = weekly_uploader(20)
+    now = FRIDAY_EVENING + 3600
+    assert 0.8 < model.uploads_per_week(now) < 1.2
+    assert model.checks_per_week(now) == upload_model.CHECKS_PER_UPLOAD*(
+        model.uploads_per_week(now))
+    assert UploadModel().checks_per_week(now) == (
+        upload_model.MIN_CHECKS_PER_WEEK)
+
+
+def test_checks_follow_upload_times():
+    model = weekly_uploader(20)
+    check_time = FRIDAY_EVENING + 4*3600
+    check_times = []
+    while check_time < FRIDAY_EVENING + WEEK + 4*3600:
+        check_time = model.next_check_time(check_time, jitter=False)
+        check_times.append(check_time)
+    # most checks are around the usual upload time, none far from it
+    near_upload = [t for t in check_times
+                   if abs(t - (FRIDAY_EVENING + WEEK)) < 2*3600]
+    assert len(near_upload) >= len(check_times) - 2
+    assert len(check_times) <= upload_model.CHECKS_PER_UPLOAD + 1
+
+
+def test_channel_without_uploads_is_checked_evenly():
+    model = UploadModel()
+    delay = model.next_check_time(FRIDAY_EVENING, jitter=False) - (
+        FRIDAY_EVENING)
+    assert abs(delay - WEEK/upload_model.MIN_CHECKS_PER_WEEK) < 60
+
+
+def test_json():
+    model = weekly_uploader(3)
+    copy = UploadModel.from_json(model.to_json())
+    assert copy.start_time == model.start_time
+    assert copy.next_check_time(FRIDAY_EVENING, jitter=False) == (
+        model.next_check_time(FRIDAY_EVENING, jitter=False))
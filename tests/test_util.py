@@ -5,6 +5,8 @@ import urllib3
 import io
 import os
 import stem
+import time
+import gevent
 
 
 def load_test_page(name):
@@ -74,3 +76,167 @@ def test_exit_node_retry(monkeypatch, new_identities_till_success):
         with pytest.raises(util.FetchError) as excinfo:
             util.fetch_url('url')
         assert int(excinfo.value.code) == 429
+
+
+def test_single_flight():
+    import gevent
+    single_flight = util.SingleFlight()
+    calls = []
+
+    def slow_function(value):
+        calls.append(value)
+        gevent.sleep(0.05)
+        if value == 'fail':
+            raise ValueError(value)
+        return value
+
+    tasks = [gevent.spawn(single_flight.call, 'key', slow_function, 'a')
+             for i in range(4)]
+    gevent.joinall(tasks)
+    assert [task.value for task in tasks] == ['a']*4
+    assert calls == ['a']
+    assert single_flight.coalesced_count == 3
+
+    # finished calls are not reused
+    assert single_flight.call('key', slow_function, 'b') == 'b'
+
+    # exceptions are given to every waiting caller
+    tasks = [gevent.spawn(single_flight.call, 'other', slow_function, 'fail')
+             for i in range(3)]
+    gevent.joinall(tasks)
+    assert all(isinstance(task.exception, ValueError) for task in tasks)
+    assert single_flight.in_flight == {}
+
+    # a killed caller doesn't take the waiting callers with it
+    calls.clear()
+    tasks = [gevent.spawn(single_flight.call, 'killed', slow_function, 'c')
+             for i in range(3)]
+    gevent.sleep(0.01)
+    tasks[0].kill()
+    gevent.joinall(tasks)
+    assert [task.value for task in tasks[1:]] == ['c', 'c']
+    assert calls == ['c', 'c']
+    assert single_flight.in_flight == {}
+
+
+@pytest.mark.parametrize('url, traffic_class', [
+    ('https://www.youtube.com/watch?v=abc', 'api'),
+    ('https://i.ytimg.com/vi/abc/mqdefault.jpg', 'image'),
+    ('https://yt3.ggpht.com/abc', 'image'),
+    ('https://r4---sn-abc.googlevideo.com/videoplayback?id=1', 'video'),
+    ('https://notggpht.com/abc', 'api'),
+])
+def test_get_traffic_class(url, traffic_class):
+    assert util.get_traffic_class(url) == traffic_class
+
+
+def test_connection_counting(monkeypatch):
+    monkeypatch.setattr(util, 'connection_stats',
+                        util.collections.defaultdict(
+                            lambda: {'created': 0, 'reused': 0,
+                                     'discarded': 0}))
+    pool_class = util.make_counting_pool_class(
+        urllib3.HTTPConnectionPool, 'test')
+    pool = pool_class('example.com', maxsize=1)
+    conn1 = pool._get_conn()
+    conn2 = pool._get_conn()
+    pool._put_conn(conn1)
+    pool._put_conn(conn2)   # pool is full, so this one is thrown away
+    pool._get_conn()
+    assert util.connection_stats[('test', 'example.com')] == {
+        'created': 2, 'reused': 1, 'discarded': 1}
+
+
+def test_conditional_fetch(monkeypatch):
+    sent_headers = []
+
+    def fetch_url_response(url, headers=(), **kwargs):
+        headers = dict(headers)
+        sent_headers.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return MockResponse(body='', status=304), (lambda r: None)
+        return (MockResponse(headers={'ETag': '"v1"',
+                                      'Last-Modified': 'yesterday'}),
+                (lambda r: None))
+    monkeypatch.setattr(util, 'fetch_url_response', fetch_url_response)
+
+    validators = {}
+    assert util.fetch_url('url', validators=validators) == b'success'
+    assert 'If-None-Match' not in sent_headers[0]
+    assert validators == {'etag': '"v1"', 'last_modified': 'yesterday'}
+    assert util.fetch_url('url', validators=validators) is None
+    assert sent_headers[1]['If-Modified-Since'] == 'yesterday'
+    assert util.fetch_url('url') == b'success'
+
+
+def test_adaptive_rate_limited_queue(tmp_path):
+    state_path = str(tmp_path / 'rate.json')
+    queue = util.AdaptiveRateLimitedQueue(state_path=state_path,
+                                          initial_rate=2, burst=2)
+    # not adapting while not in use
+    queue.record_response(429)
+    assert queue.rate == 2
+
+    for i in range(3):
+        queue.put(i)
+    assert [queue.get() for i in range(2)] == [0, 1]
+    for i in range(10):
+        queue.record_response(200)
+    assert queue.rate > 2
+    rate = queue.rate
+
+    # errors from requests sent together only decrease the rate once
+    queue.record_response(429)
+    queue.record_response(503)
+    assert queue.rate == rate/2
+
+    # with no tokens left, the next item waits for the new rate
+    start_time = time.monotonic()
+    assert queue.get() == 2
+    assert time.monotonic() - start_time >= 0.9/queue.rate
+
+    queue.save()
+    assert util.AdaptiveRateLimitedQueue(state_path=state_path).rate == (
+        queue.rate)
+
+
+def test_thumbnail_downloader(monkeypatch, tmp_path):
+    monkeypatch.setattr(util.ThumbnailDownloader, 'RETRY_DELAY', 0.01)
+    requests = []
+    running = set()
+    concurrent = []
+
+    def fetch_url(url, report_text=None):
+        video_id = url.split('/')[-2]
+        requests.append(video_id)
+        running.add(video_id)
+        concurrent.append(len(running))
+        gevent.sleep(0.01)
+        running.remove(video_id)
+        if video_id == 'missing':
+            raise util.FetchError('404')
+        if video_id == 'flaky' and requests.count('flaky') < 3:
+            raise util.FetchError('503')
+        return b'image ' + video_id.encode()
+    monkeypatch.setattr(util, 'fetch_url', fetch_url)
+
+    downloader = util.ThumbnailDownloader(concurrency=2)
+    ids = ['a', 'b', 'c', 'flaky', 'missing']
+    downloader.add(str(tmp_path), ids)
+    downloader.add(str(tmp_path), ['a', 'b'])
+    assert downloader.duplicates == 2
+    assert len(downloader.queue) == 5
+    while downloader.pending:
+        gevent.sleep(0.01)
+
+    assert max(concurrent) == 2
+    assert requests.count('a') == 1
+    assert requests.count('flaky') == 3
+    assert requests.count('missing') == 1
+    assert downloader.downloaded == 4
+    assert downloader.failed == 1
+    assert downloader.retries == 2
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'a.jpg', 'b.jpg', 'c.jpg', 'flaky.jpg']
+    assert (tmp_path / 'flaky.jpg').read_bytes() == b'image flaky'
+    assert downloader.report()[1][3] == 4
@@ -0,0 +1,51 @@
+from youtube import watch
+import settings
+import time
+
+
+def make_info(expire_time, **kwargs):
+    info = {
+        'error': None,
+        'playability_error': None,
+        'live': False,
+        'urls_ready': True,
+        'formats': [
+            {'url': 'https://r1.googlevideo.com/videoplayback?itag=18'
+                    '&expire=' + str(expire_time)},
+            {'url': None},
+        ],
+        'related_videos': [],
+    }
+    info.update(kwargs)
+    return info
+
+
+def test_get_urls_expire_time():
+    assert watch.get_urls_expire_time(make_info(1234)) == 1234
+    assert watch.get_urls_expire_time({'formats': []}) is None
+
+
+def test_video_info_cache(monkeypatch):
+    monkeypatch.setattr(settings, 'route_tor', 0)
+    cache = watch.VideoInfoCache()
+    info = make_info(int(time.time()) + 6*3600)
+    cache.put('aaaaaaaaaaa', None, None, info)
+    info['related_videos'].append('modified by caller')
+    entry = cache.get('aaaaaaaaaaa', None, None)
+    assert entry.info['related_videos'] == []
+    assert cache.get('aaaaaaaaaaa', 'PL1', None) is None
+
+    # different routing gives different urls
+    monkeypatch.setattr(settings, 'route_tor', 2)
+    assert cache.get('aaaaaaaaaaa', None, None) is None
+
+
+def test_video_info_cache_skips():
+    cache = watch.VideoInfoCache()
+    # expires within the safety margin
+    cache.put('a', None, None, make_info(int(time.time()) + 60))
+    cache.put('b', None, None, make_info(int(time.time()) + 6*3600,
+                                         live=True))
+    cache.put('c', None, None, make_info(int(time.time()) + 6*3600,
+                                         playability_error='Unavailable'))
+    assert len(cache.entries) == 0
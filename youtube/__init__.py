@@ -1,4 +1,4 @@
-from youtube import util
+from youtube import util, prefetch
 import flask
 from flask import request
 import jinja2
@@ -21,6 +21,23 @@ def homepage():
     return flask.render_template('home.html', title="Youtube local")
 
 
+# Lets background prefetching wait until pages have finished loading
+@yt_app.before_request
+def count_request_start():
+    prefetch.page_requests_in_progress += 1
+
+@yt_app.teardown_request
+def count_request_end(exception):
+    prefetch.page_requests_in_progress -= 1
+
+
+@yt_app.route('/status')
+def status_page():
+    sections = [(name, reporter())
+                for name, reporter in util.status_reporters.items()]
+    return flask.render_template('statistics.html', sections=sections)
+
+
 theme_names = {
     0: 'light_theme',
     1: 'gray_theme',
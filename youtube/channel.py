@@ -1,6 +1,6 @@
 import base64
 from youtube import (util, yt_data_extract, local_playlist, subscriptions,
-                     playlist)
+                     playlist, offload)
 from youtube import yt_app
 import settings
 
@@ -235,7 +235,8 @@ def get_channel_tab(channel_id, page="1", sort=3, tab='videos', view=1,
     content_type_header = (('Content-Type', 'application/json'),)
     content = util.fetch_url(
         url, headers_desktop + content_type_header,
-        data=json.dumps(data), debug_name='channel_tab', report_text=message)
+        data=json.dumps(data), debug_name='channel_tab', report_text=message,
+        cache_ttl=util.RESPONSE_CACHE_TTLS['channel_tab'])
 
     return content
 
@@ -295,9 +296,9 @@ def get_metadata(channel_id):
                                   headers_desktop,
                                   debug_name='gen_channel_about',
                                   report_text='Retrieved channel metadata')
-    info = yt_data_extract.extract_channel_info(json.loads(polymer_json),
-                                                'about',
-                                                continuation=False)
+    info = offload.run(offload.json_then, polymer_json,
+                       yt_data_extract.extract_channel_info, 'about',
+                       continuation=False)
     return extract_metadata_for_caching(info)
 def set_cached_metadata(channel_id, metadata):
     @cachetools.cached(metadata_cache)
@@ -340,7 +341,8 @@ def get_channel_search_json(channel_id, query, page):
     content_type_header = (('Content-Type', 'application/json'),)
     polymer_json = util.fetch_url(
         url, headers_desktop + content_type_header,
-        data=json.dumps(data), debug_name='channel_search')
+        data=json.dumps(data), debug_name='channel_search',
+        cache_ttl=util.RESPONSE_CACHE_TTLS['search'])
 
     return polymer_json
 
@@ -357,11 +359,14 @@ def post_process_channel_info(info):
                 info['links'][i] = (text, util.prefix_url(url))
 
 
-def get_channel_first_page(base_url=None, tab='videos', channel_id=None):
+def get_channel_first_page(base_url=None, tab='videos', channel_id=None,
+                           use_cache=True):
     if channel_id:
         base_url = 'https://www.youtube.com/channel/' + channel_id
+    cache_ttl = util.RESPONSE_CACHE_TTLS['channel_tab'] if use_cache else None
     return util.fetch_url(base_url + '/' + tab + '?pbj=1&view=0',
-                          headers_desktop, debug_name='gen_channel_' + tab)
+                          headers_desktop, debug_name='gen_channel_' + tab,
+                          cache_ttl=cache_ttl)
 
 
 playlist_sort_codes = {'2': "da", '3': "dd", '4': "lad"}
@@ -405,8 +410,7 @@ def get_channel_page_general_url(base_url, tab, request, channel_id=None):
 
             # Ignore the metadata for now, it is cached and will be
             # recalled later
-            pl_json = tasks[0].value
-            pl_info = yt_data_extract.extract_playlist_info(pl_json)
+            pl_info = tasks[0].value
             number_of_videos = pl_info['metadata']['video_count']
             if number_of_videos is None:
                 number_of_videos = 1000
@@ -422,8 +426,7 @@ def get_channel_page_general_url(base_url, tab, request, channel_id=None):
             gevent.joinall(tasks)
             util.check_gevent_exceptions(*tasks)
 
-            pl_json = tasks[0].value
-            pl_info = yt_data_extract.extract_playlist_info(pl_json)
+            pl_info = tasks[0].value
             number_of_videos = tasks[2].value
         info = pl_info
         info['channel_id'] = channel_id
@@ -462,9 +465,11 @@ def get_channel_page_general_url(base_url, tab, request, channel_id=None):
         number_of_videos, polymer_json = tasks[0].value, tasks[1].value
 
     elif tab == 'about':
-        polymer_json = util.fetch_url(base_url + '/about?pbj=1', headers_desktop, debug_name='gen_channel_about')
+        polymer_json = util.fetch_url(base_url + '/about?pbj=1', headers_desktop, debug_name='gen_channel_about',
+                                      cache_ttl=util.RESPONSE_CACHE_TTLS['channel_about'])
     elif tab == 'playlists' and page_number == 1:
-        polymer_json = util.fetch_url(base_url+ '/playlists?pbj=1&view=1&sort=' + playlist_sort_codes[sort], headers_desktop, debug_name='gen_channel_playlists')
+        polymer_json = util.fetch_url(base_url+ '/playlists?pbj=1&view=1&sort=' + playlist_sort_codes[sort], headers_desktop, debug_name='gen_channel_playlists',
+                                      cache_ttl=util.RESPONSE_CACHE_TTLS['channel_tab'])
     elif tab == 'playlists':
         polymer_json = get_channel_tab(channel_id, page_number, sort,
                                        'playlists', view)
@@ -473,15 +478,18 @@ def get_channel_page_general_url(base_url, tab, request, channel_id=None):
         polymer_json = get_channel_search_json(channel_id, query, page_number)
     elif tab == 'search':
         url = base_url + '/search?pbj=1&query=' + urllib.parse.quote(query, safe='')
-        polymer_json = util.fetch_url(url, headers_desktop, debug_name='gen_channel_search')
+        polymer_json = util.fetch_url(url, headers_desktop, debug_name='gen_channel_search',
+                                      cache_ttl=util.RESPONSE_CACHE_TTLS['search'])
     elif tab == 'videos':
         pass
     else:
         flask.abort(404, 'Unknown channel tab: ' + tab)
 
     if polymer_json is not None:
-        info = yt_data_extract.extract_channel_info(
-            json.loads(polymer_json), tab, continuation=continuation
+        info = offload.run(
+            offload.json_then, polymer_json,
+            yt_data_extract.extract_channel_info, tab,
+            continuation=continuation
         )
 
     if channel_id:
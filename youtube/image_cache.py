@@ -0,0 +1,225 @@
+'''Disk cache for images routed through youtube-local (thumbnails, avatars,
+storyboards)
+
+Image bodies are stored once per distinct content under a name derived from
+their sha256 hash, so the same image served from several urls takes up space
+once. An SQLite index maps each url to its image along with the validators
+(ETag, Last-Modified) Youtube sent, so that expired images can be revalidated
+with a conditional request instead of downloaded again.
+
+Urls are evicted in least recently used order once the total size of the
+stored images exceeds settings.image_cache_size.
+'''
+import settings
+
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import traceback
+
+cache_directory = os.path.join(settings.data_dir, 'image_cache')
+database_path = os.path.join(cache_directory, 'index.sqlite')
+
+# Used when Youtube doesn't say how long the image may be cached
+DEFAULT_TTL = 24*3600
+MAX_AGE_RE = re.compile(r'max-age=(\d+)')
+
+
+def get_ttl(cache_control):
+    '''Returns how long a response may be cached given its Cache-Control
+    header, or None if it must not be cached'''
+    if not cache_control:
+        return DEFAULT_TTL
+    cache_control = cache_control.lower()
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    match = MAX_AGE_RE.search(cache_control)
+    if match:
+        return int(match.group(1))
+    return DEFAULT_TTL
+
+
+class CachedImage:
+    def __init__(self, url, content_hash, size, content_type, etag,
+                 last_modified, expire_time):
+        self.url = url
+        self.content_hash = content_hash
+        self.size = size
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        self.expire_time = expire_time
+
+    def is_fresh(self):
+        return time.time() < self.expire_time
+
+    def local_etag(self):
+        '''Strong ETag given to the browser, based on the content'''
+        return '"' + self.content_hash[0:32] + '"'
+
+
+class ImageCache:
+    def __init__(self):
+        self.connection = None
+        self.total_size = 0
+
+    def get_connection(self):
+        if self.connection is not None:
+            return self.connection
+        os.makedirs(cache_directory, exist_ok=True)
+        connection = sqlite3.connect(database_path, check_same_thread=False)
+        # It's a cache, so losing the most recent changes on power loss
+        # is fine
+        connection.execute('PRAGMA journal_mode = WAL')
+        connection.execute('PRAGMA synchronous = NORMAL')
+        connection.execute('''CREATE TABLE IF NOT EXISTS images (
+                                  url text PRIMARY KEY,
+                                  content_hash text NOT NULL,
+                                  size integer NOT NULL,
+                                  content_type text,
+                                  etag text,
+                                  last_modified text,
+                                  expire_time real NOT NULL,
+                                  last_access real NOT NULL
+                              )''')
+        connection.execute('''CREATE INDEX IF NOT EXISTS
+                              images_last_access ON images(last_access)''')
+        connection.execute('''CREATE INDEX IF NOT EXISTS
+                              images_content_hash ON images(content_hash)''')
+        connection.commit()
+        self.total_size = connection.execute(
+            '''SELECT COALESCE(SUM(size), 0) FROM (
+                   SELECT DISTINCT content_hash, size FROM images
+               )''').fetchone()[0]
+        self.connection = connection
+        return connection
+
+    def blob_path(self, content_hash):
+        return os.path.join(cache_directory, content_hash[0:2], content_hash)
+
+    def lookup(self, url):
+        '''Returns CachedImage for url, or None if not cached'''
+        connection = self.get_connection()
+        row = connection.execute(
+            '''SELECT content_hash, size, content_type, etag, last_modified,
+                      expire_time
+               FROM images WHERE url = ?''', (url,)).fetchone()
+        if row is None:
+            return None
+        if not os.path.exists(self.blob_path(row[0])):
+            self._delete_urls([url])
+            return None
+        with connection:
+            connection.execute(
+                'UPDATE images SET last_access = ? WHERE url = ?',
+                (time.time(), url))
+        return CachedImage(url, *row)
+
+    def read(self, image):
+        try:
+            with open(self.blob_path(image.content_hash), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            self._delete_urls([image.url])
+            return None
+
+    def refresh(self, image, ttl):
+        '''Called when Youtube confirmed the cached image is still valid'''
+        image.expire_time = time.time() + ttl
+        connection = self.get_connection()
+        with connection:
+            connection.execute(
+                'UPDATE images SET expire_time = ? WHERE url = ?',
+                (image.expire_time, image.url))
+
+    def store(self, url, content, content_type, etag, last_modified, ttl):
+        connection = self.get_connection()
+        content_hash = hashlib.sha256(content).hexdigest()
+        path = self.blob_path(content_hash)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = path + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(content)
+            os.replace(temp_path, path)
+            self.total_size += len(content)
+
+        old_row = connection.execute(
+            'SELECT content_hash FROM images WHERE url = ?',
+            (url,)).fetchone()
+        now = time.time()
+        image = CachedImage(url, content_hash, len(content), content_type,
+                            etag, last_modified, now + ttl)
+        with connection:
+            connection.execute(
+                '''INSERT OR REPLACE INTO images (url, content_hash, size,
+                       content_type, etag, last_modified, expire_time,
+                       last_access)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                (url, content_hash, len(content), content_type, etag,
+                 last_modified, image.expire_time, now))
+        if old_row is not None and old_row[0] != content_hash:
+            self._delete_unreferenced([old_row[0]])
+        self.evict()
+        return image
+
+    def evict(self):
+        budget = settings.image_cache_size*1024*1024
+        if self.total_size <= budget:
+            return
+        connection = self.get_connection()
+        # Remove the least recently used tenth at a time so this doesn't
+        # run on every store once the cache is full
+        target_size = budget*0.9
+        urls = []
+        hashes = set()
+        size_freed = 0
+        for url, content_hash, size in connection.execute(
+                '''SELECT url, content_hash, size FROM images
+                   ORDER BY last_access'''):
+            if self.total_size - size_freed <= target_size:
+                break
+            urls.append(url)
+            if content_hash not in hashes:
+                hashes.add(content_hash)
+                size_freed += size
+        self._delete_urls(urls)
+
+    def _delete_urls(self, urls):
+        connection = self.get_connection()
+        hashes = set()
+        for url in urls:
+            row = connection.execute(
+                'SELECT content_hash FROM images WHERE url = ?',
+                (url,)).fetchone()
+            if row:
+                hashes.add(row[0])
+        with connection:
+            connection.executemany('DELETE FROM images WHERE url = ?',
+                                   [(url,) for url in urls])
+        self._delete_unreferenced(hashes)
+
+    def _delete_unreferenced(self, hashes):
+        '''Deletes the stored images for the given hashes which no url
+        refers to anymore'''
+        connection = self.get_connection()
+        for content_hash in hashes:
+            still_used = connection.execute(
+                'SELECT EXISTS(SELECT 1 FROM images WHERE content_hash = ?)',
+                (content_hash,)).fetchone()[0]
+            if still_used:
+                continue
+            path = self.blob_path(content_hash)
+            try:
+                self.total_size -= os.path.getsize(path)
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                print('Failed to delete cached image: ' + path)
+                traceback.print_exc()
+
+
+image_cache = ImageCache()
@@ -1,133 +1,353 @@
-from youtube import util, yt_data_extract
+from youtube import util, yt_data_extract, thumbnails
 from youtube import yt_app
 import settings
 
 import os
 import json
 import html
+import time
 import gevent
+import gevent.lock
+import sqlite3
 import urllib
 import math
+import contextlib
+import collections
 
 import flask
 from flask import request
 
 playlists_directory = os.path.join(settings.data_dir, "playlists")
+# Thumbnails are kept in the thumbnails store, referenced by each playlist
+# with the video. They used to be saved per playlist in this directory, and
+# are moved into the store as they're shown
 thumbnails_directory = os.path.join(settings.data_dir, "playlist_thumbnails")
 
-def video_ids_in_playlist(name):
+# Playlists are stored in SQLite, so that showing a page of a playlist,
+# adding videos (skipping ones already in it, found with the unique index)
+# and removing videos don't have to read and parse every video in it.
+# Playlists in the old format, a .txt file of one json video per line in
+# playlists_directory, are imported automatically and the file renamed to
+# .txt.imported, which is deleted along with the playlist
+database_path = os.path.join(settings.data_dir, "playlists.sqlite")
+
+def _create_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS playlists (
+                          id integer PRIMARY KEY,
+                          name text UNIQUE NOT NULL,
+                          video_count integer NOT NULL DEFAULT 0,
+                          time_modified integer NOT NULL DEFAULT 0
+                      )''')
+    # id gives the order of the videos in the playlist
+    cursor.execute('''CREATE TABLE IF NOT EXISTS playlist_videos (
+                          id integer PRIMARY KEY,
+                          playlist_id integer NOT NULL REFERENCES playlists(id) ON DELETE CASCADE,
+                          video_id text NOT NULL,
+                          info text NOT NULL,
+                          UNIQUE(playlist_id, video_id)
+                      )''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS playlist_videos_order
+                      ON playlist_videos(playlist_id, id)''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS playlist_videos_count_insert
+                      AFTER INSERT ON playlist_videos
+                      BEGIN
+                          UPDATE playlists SET video_count = video_count + 1
+                          WHERE id = NEW.playlist_id;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS playlist_videos_count_delete
+                      AFTER DELETE ON playlist_videos
+                      BEGIN
+                          UPDATE playlists SET video_count = video_count - 1
+                          WHERE id = OLD.playlist_id;
+                      END''')
+
+connection = None
+connection_lock = gevent.lock.RLock()
+# st_mtime_ns of playlists_directory when it was last checked for .txt
+# playlists to import
+directory_mtime = None
+
+@contextlib.contextmanager
+def open_database():
+    '''Used as
+        with open_database() as connection:
+            with connection as cursor:
+                ...
+    The connection is shared, and used by one greenlet at a time'''
+    global connection
+    with connection_lock:
+        if connection is None:
+            os.makedirs(settings.data_dir, exist_ok=True)
+            new_connection = sqlite3.connect(database_path,
+                                             check_same_thread=False)
+            new_connection.execute('''PRAGMA foreign_keys = 1''')
+            with new_connection:
+                _create_tables(new_connection)
+            _add_thumbnail_references(new_connection)
+            connection = new_connection
+        _import_text_playlists(connection)
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+
+def close_database():
+    global connection, directory_mtime
+    with connection_lock:
+        if connection is not None:
+            connection.close()
+            connection = None
+        directory_mtime = None
+        invalidate_catalog()
+
+def _add_thumbnail_references(connection):
+    '''Adds the references to the thumbnails of the playlists stored before
+    the thumbnails store. user_version records that it's been done'''
+    if connection.execute('''PRAGMA user_version''').fetchone()[0] >= 1:
+        return
+    for playlist_id, name in connection.execute(
+            '''SELECT id, name FROM playlists''').fetchall():
+        thumbnails.add_references(thumbnails.playlist_owner(name), [
+            row[0] for row in connection.execute(
+                '''SELECT video_id FROM playlist_videos
+                   WHERE playlist_id = ?''', [playlist_id])])
+    connection.execute('''PRAGMA user_version = 1''')
+
+def _import_text_playlists(connection):
+    global directory_mtime
     try:
-        with open(os.path.join(playlists_directory, name + ".txt"), 'r', encoding='utf-8') as file:
-            videos = file.read()
-        return set(json.loads(video)['id'] for video in videos.splitlines())
+        mtime = os.stat(playlists_directory).st_mtime_ns
     except FileNotFoundError:
-        return set()
+        return
+    if mtime == directory_mtime:
+        return
+    for item in os.listdir(playlists_directory):
+        name, ext = os.path.splitext(item)
+        if ext != '.txt':
+            continue
+        path = os.path.join(playlists_directory, item)
+        with open(path, 'r', encoding='utf-8') as file:
+            video_info_list = file.read().splitlines()
+        with connection as cursor:
+            added = _add_videos(cursor, name, video_info_list,
+                                int(os.path.getmtime(path)))
+        thumbnails.add_references(thumbnails.playlist_owner(name), added)
+        os.replace(path, path + '.imported')
+        print('Imported playlist ' + name)
+    directory_mtime = os.stat(playlists_directory).st_mtime_ns
+
+def _get_playlist_id(cursor, name, create=False):
+    row = cursor.execute('''SELECT id FROM playlists WHERE name = ?''',
+                         [name]).fetchone()
+    if row is not None:
+        return row[0]
+    if not create:
+        return None
+    return cursor.execute('''INSERT INTO playlists (name) VALUES (?)''',
+                          [name]).lastrowid
+
+def _add_videos(cursor, name, video_info_list, time_modified=None):
+    '''Adds the videos (json strings) which aren't in the playlist yet, and
+    returns their ids'''
+    playlist_id = _get_playlist_id(cursor, name, create=True)
+    added = []
+    for info in video_info_list:
+        try:
+            video_id = json.loads(info)['id']
+        except (json.decoder.JSONDecodeError, KeyError, TypeError):
+            if not info.strip() == '':
+                print('Corrupt playlist video entry: ' + info)
+            continue
+        if cursor.execute('''INSERT OR IGNORE INTO playlist_videos
+                              (playlist_id, video_id, info)
+                              VALUES (?, ?, ?)''',
+                          [playlist_id, video_id, info]).rowcount:
+            added.append(video_id)
+    if time_modified is None:
+        time_modified = int(time.time())
+    cursor.execute('''UPDATE playlists SET time_modified = ? WHERE id = ?''',
+                   [time_modified, playlist_id])
+    return added
+
+def video_ids_in_playlist(name):
+    with open_database() as connection:
+        return set(row[0] for row in connection.execute(
+            '''SELECT video_id FROM playlist_videos
+               WHERE playlist_id = (SELECT id FROM playlists WHERE name = ?)''',
+            [name]))
 
 def add_to_playlist(name, video_info_list):
-    if not os.path.exists(playlists_directory):
-        os.makedirs(playlists_directory)
-    ids = video_ids_in_playlist(name)
-    missing_thumbnails = []
-    with open(os.path.join(playlists_directory, name + ".txt"), "a", encoding='utf-8') as file:
-        for info in video_info_list:
-            id = json.loads(info)['id']
-            if id not in ids:
-                file.write(info + "\n")
-                missing_thumbnails.append(id)
-    gevent.spawn(util.download_thumbnails, os.path.join(thumbnails_directory, name), missing_thumbnails)
+    with open_database() as connection:
+        with connection as cursor:
+            added = _add_videos(cursor, name, video_info_list)
+    invalidate_catalog()
+    thumbnails.add_references(thumbnails.playlist_owner(name), added)
+    thumbnails.download(added)
 
 
 def add_extra_info_to_videos(videos, playlist_name):
     '''Adds extra information necessary for rendering the video item HTML
 
     Downloads missing thumbnails'''
-    try:
-        thumbnails = set(os.listdir(os.path.join(thumbnails_directory,
-                                                 playlist_name)))
-    except FileNotFoundError:
-        thumbnails = set()
     missing_thumbnails = []
 
     for video in videos:
         video['type'] = 'video'
         util.add_extra_html_info(video)
-        if video['id'] + '.jpg' in thumbnails:
-            video['thumbnail'] = (
-                '/https://youtube.com/data/playlist_thumbnails/'
-                + playlist_name
-                + '/' + video['id'] + '.jpg')
+        legacy_path = os.path.join(thumbnails_directory, playlist_name,
+                                   video['id'] + '.jpg')
+        if thumbnails.find(video['id'], [legacy_path]):
+            video['thumbnail'] = (util.URL_ORIGIN + '/data/thumbnails/'
+                                  + video['id'] + '.jpg')
         else:
             video['thumbnail'] = util.get_thumbnail_url(video['id'])
             missing_thumbnails.append(video['id'])
 
-    gevent.spawn(util.download_thumbnails,
-                 os.path.join(thumbnails_directory, playlist_name),
-                 missing_thumbnails)
+    thumbnails.download(missing_thumbnails)
 
 
 def read_playlist(name):
     '''Returns a list of videos for the given playlist name'''
-    playlist_path = os.path.join(playlists_directory, name + '.txt')
-    with open(playlist_path, 'r', encoding='utf-8') as f:
-        data = f.read()
+    return get_local_playlist_videos(name, amount=None, extra_info=False)[0]
 
-    videos = []
-    videos_json = data.splitlines()
-    for video_json in videos_json:
-        try:
-            info = json.loads(video_json)
-            videos.append(info)
-        except json.decoder.JSONDecodeError:
-            if not video_json.strip() == '':
-                print('Corrupt playlist video entry: ' + video_json)
-    return videos
 
+def get_local_playlist_videos(name, offset=0, amount=50, extra_info=True):
+    '''Returns (videos, total number of videos). amount=None returns all
+    videos from offset onwards'''
+    with open_database() as connection:
+        row = connection.execute('''SELECT id, video_count FROM playlists
+                                    WHERE name = ?''', [name]).fetchone()
+        if row is None:
+            return [], 0
+        playlist_id, video_count = row
+        videos_json = connection.execute(
+            '''SELECT info FROM playlist_videos
+               WHERE playlist_id = ?
+               ORDER BY id
+               LIMIT ? OFFSET ?''',
+            [playlist_id, -1 if amount is None else amount, offset]
+        ).fetchall()
+    videos = [json.loads(video_json) for video_json, in videos_json]
+    if extra_info:
+        add_extra_info_to_videos(videos, name)
+    return videos, video_count
 
-def get_local_playlist_videos(name, offset=0, amount=50):
-    videos = read_playlist(name)
-    add_extra_info_to_videos(videos, name)
-    return videos[offset:offset+amount], len(videos)
 
+# Names, video counts and modification times of the playlists, sorted by
+# name. get_playlist_names is called for the header of nearly every page, so
+# this is kept in memory. Changes made here invalidate it, and changes to
+# the database or playlists directory from elsewhere are noticed by their
+# modification times
+PlaylistInfo = collections.namedtuple(
+    'PlaylistInfo', ['name', 'video_count', 'time_modified'])
+catalog = None
+catalog_mtimes = None
+
+def invalidate_catalog():
+    global catalog
+    catalog = None
+
+def _get_mtimes():
+    mtimes = []
+    for path in (database_path, playlists_directory):
+        try:
+            mtimes.append(os.stat(path).st_mtime_ns)
+        except FileNotFoundError:
+            mtimes.append(None)
+    return mtimes
+
+def get_playlist_catalog():
+    '''Returns a list of PlaylistInfo sorted by name'''
+    global catalog, catalog_mtimes
+    result = catalog
+    if result is not None and _get_mtimes() == catalog_mtimes:
+        return result
+    with open_database() as connection:
+        result = [PlaylistInfo(*row) for row in connection.execute(
+            '''SELECT name, video_count, time_modified
+               FROM playlists
+               ORDER BY name''')]
+        catalog_mtimes = _get_mtimes()
+    catalog = result
+    return result
 
 def get_playlist_names():
-    try:
-        items = os.listdir(playlists_directory)
-    except FileNotFoundError:
-        return
-    for item in items:
-        name, ext = os.path.splitext(item)
-        if ext == '.txt':
-            yield name
+    return [playlist.name for playlist in get_playlist_catalog()]
 
 def remove_from_playlist(name, video_info_list):
     ids = [json.loads(video)['id'] for video in video_info_list]
-    with open(os.path.join(playlists_directory, name + ".txt"), 'r', encoding='utf-8') as file:
-        videos = file.read()
-    videos_in = videos.splitlines()
-    videos_out = []
-    for video in videos_in:
-        if json.loads(video)['id'] not in ids:
-            videos_out.append(video)
-    with open(os.path.join(playlists_directory, name + ".txt"), 'w', encoding='utf-8') as file:
-        file.write("\n".join(videos_out) + "\n")
+    with open_database() as connection:
+        with connection as cursor:
+            playlist_id = _get_playlist_id(cursor, name)
+            if playlist_id is None:
+                return 0
+            cursor.execute(
+                '''DELETE FROM playlist_videos
+                   WHERE playlist_id = ? AND video_id IN (%s)'''
+                % ','.join('?'*len(ids)), [playlist_id] + ids)
+            cursor.execute('''UPDATE playlists SET time_modified = ?
+                              WHERE id = ?''', [int(time.time()), playlist_id])
+            number_remaining = cursor.execute(
+                '''SELECT video_count FROM playlists WHERE id = ?''',
+                [playlist_id]).fetchone()[0]
+    invalidate_catalog()
+
+    thumbnails.remove_references(thumbnails.playlist_owner(name), ids)
+    _remove_legacy_thumbnails(name, ids)
+
+    return number_remaining
+
 
+def _remove_legacy_thumbnails(name, ids):
+    for id in ids:
+        if not thumbnails.is_valid_video_id(id):
+            continue
+        try:
+            os.remove(os.path.join(thumbnails_directory, name, id + '.jpg'))
+        except FileNotFoundError:
+            pass
+    # only removed once empty
     try:
-        thumbnails = set(os.listdir(os.path.join(thumbnails_directory, name)))
-    except FileNotFoundError:
+        os.rmdir(os.path.join(thumbnails_directory, name))
+    except OSError:
         pass
-    else:
-        to_delete = thumbnails & set(id + ".jpg" for id in ids)
-        for file in to_delete:
-            os.remove(os.path.join(thumbnails_directory, name, file))
 
-    return len(videos_out)
+
+def remove_playlist(name):
+    with open_database() as connection:
+        with connection as cursor:
+            ids = [row[0] for row in cursor.execute(
+                '''SELECT video_id FROM playlist_videos
+                   WHERE playlist_id = (SELECT id FROM playlists
+                                        WHERE name = ?)''', [name])]
+            existed = cursor.execute(
+                '''DELETE FROM playlists WHERE name = ?''', [name]).rowcount
+    invalidate_catalog()
+    thumbnails.remove_references(thumbnails.playlist_owner(name), ids)
+    _remove_legacy_thumbnails(name, ids)
+
+    imported_path = os.path.join(playlists_directory, name + '.txt.imported')
+    if existed and os.path.dirname(imported_path) == playlists_directory:
+        try:
+            os.remove(imported_path)
+        except FileNotFoundError:
+            pass
 
 
 @yt_app.route('/playlists', methods=['GET'])
 @yt_app.route('/playlists/<playlist_name>', methods=['GET'])
 def get_local_playlist_page(playlist_name=None):
     if playlist_name is None:
-        playlists = [(name, util.URL_ORIGIN + '/playlists/' + name) for name in get_playlist_names()]
+        playlists = []
+        for playlist in get_playlist_catalog():
+            playlists.append({
+                'name': playlist.name,
+                'url': util.URL_ORIGIN + '/playlists/' + playlist.name,
+                'video_count': playlist.video_count,
+                'time_modified': time.strftime(
+                    '%Y-%m-%d', time.localtime(playlist.time_modified)),
+            })
         return flask.render_template('local_playlists_list.html', playlists=playlists)
     else:
         page = int(request.args.get('page', 1))
@@ -151,10 +371,7 @@ def path_edit_playlist(playlist_name):
         redirect_page_number = min(int(request.values.get('page', 1)), math.ceil(number_of_videos_remaining/50))
         return flask.redirect(util.URL_ORIGIN + request.path + '?page=' + str(redirect_page_number))
     elif request.values['action'] == 'remove_playlist':
-        try:
-            os.remove(os.path.join(playlists_directory, playlist_name + ".txt"))
-        except OSError:
-            pass
+        remove_playlist(playlist_name)
         return flask.redirect(util.URL_ORIGIN + '/playlists')
     elif request.values['action'] == 'export':
         videos = read_playlist(playlist_name)
@@ -193,5 +410,12 @@ def edit_playlist():
 
 @yt_app.route('/data/playlist_thumbnails/<playlist_name>/<thumbnail>')
 def serve_thumbnail(playlist_name, thumbnail):
-    # .. is necessary because flask always uses the application directory at ./youtube, not the working directory
-    return flask.send_from_directory(os.path.join('..', thumbnails_directory, playlist_name), thumbnail)
+    '''Old location of playlist thumbnails, now in the thumbnails store'''
+    video_id, ext = os.path.splitext(thumbnail)
+    if ext != '.jpg':
+        flask.abort(404)
+    legacy_paths = []
+    if playlist_name in get_playlist_names():
+        legacy_paths.append(os.path.join(thumbnails_directory, playlist_name,
+                                         thumbnail))
+    return thumbnails.send_thumbnail(video_id, legacy_paths)
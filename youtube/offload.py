@@ -0,0 +1,141 @@
+'''Runs CPU heavy parsing of Youtube responses in worker processes
+
+Parsing a large response (such as the ~1 MB html of a watch page) on the
+gevent hub blocks every other greenlet while it runs, so routed video
+streams stall whenever someone opens a heavy page. With
+settings.extraction_processes set, payloads of at least
+settings.extraction_offload_threshold KiB are parsed in a process pool
+instead, while the calling greenlet waits cooperatively. Smaller payloads
+are parsed inline, where the cost of sending them to another process would
+outweigh the benefit.
+
+Results are unpickled on the hub, which blocks it for about as long as
+parsing would have for a whole parsed json tree. So the extraction should
+be done in the worker as well (see json_then), leaving only a small result
+to send back.
+'''
+from youtube import util
+import settings
+
+import json
+import time
+import pickle
+import gevent
+import traceback
+import concurrent.futures
+import concurrent.futures.process
+
+executor = None
+# Futures submitted and not yet done, cancelled when the executor is shut
+# down
+pending_futures = set()
+
+# Statistics for the status page
+offloaded_count = 0
+# Time spent parsing in worker processes, less the time spent unpickling
+# the results on the hub, so the hub time actually saved
+offloaded_seconds = 0.0
+unpickle_seconds = 0.0
+# Time spent sending payloads to workers and results back
+transfer_seconds = 0.0
+inline_count = 0
+inline_seconds = 0.0
+
+
+def get_executor():
+    global executor
+    if executor is None:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=settings.extraction_processes)
+    return executor
+
+
+def shutdown_executor(old_value=None, value=None):
+    global executor
+    if executor is not None:
+        # shutdown's cancel_futures argument needs Python 3.9, so the
+        # futures not started yet are cancelled here instead
+        for future in list(pending_futures):
+            future.cancel()
+        executor.shutdown(wait=False)
+        executor = None
+settings.add_setting_changed_hook('extraction_processes', shutdown_executor)
+
+
+def json_then(text, extract_function, *args, **kwargs):
+    '''Parses the json text and passes the result to extract_function, so
+    both can be done in a worker without sending the parsed json back'''
+    return extract_function(json.loads(text), *args, **kwargs)
+
+
+def _timed_call(function, args, kwargs):
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def _worker_call(function, args, kwargs):
+    '''Runs in the worker. The result is pickled here so the parent can
+    time unpickling it, which holds the GIL and so blocks the hub. Send the
+    extraction to the worker with the parsing (see json_then), so that the
+    result is small'''
+    result, seconds = _timed_call(function, args, kwargs)
+    return pickle.dumps(result, pickle.HIGHEST_PROTOCOL), seconds
+
+
+def run(function, payload, *args, **kwargs):
+    '''Returns function(payload, *args, **kwargs), computing it in a worker
+    process if payload (str or bytes) is large enough and offloading is
+    enabled. function and its arguments must be picklable, so it has to be
+    a module level function'''
+    global offloaded_count, offloaded_seconds, transfer_seconds
+    global unpickle_seconds
+    global inline_count, inline_seconds
+    if (settings.extraction_processes > 0
+            and len(payload) >= settings.extraction_offload_threshold*1024):
+        start_time = time.perf_counter()
+        try:
+            future = get_executor().submit(_worker_call, function,
+                                           (payload,) + args, kwargs)
+            pending_futures.add(future)
+            try:
+                # Wait in a native thread so the hub keeps running
+                pickled_result, worker_seconds = (
+                    gevent.get_hub().threadpool.apply(future.result))
+            finally:
+                pending_futures.discard(future)
+        except concurrent.futures.CancelledError:
+            # The executor was shut down by a change of settings
+            pass
+        except concurrent.futures.process.BrokenProcessPool:
+            print('Extraction process pool broke, parsing inline')
+            traceback.print_exc()
+            shutdown_executor()
+        else:
+            unpickle_start = time.perf_counter()
+            result = pickle.loads(pickled_result)
+            unpickle_time = time.perf_counter() - unpickle_start
+            offloaded_count += 1
+            offloaded_seconds += max(0.0, worker_seconds - unpickle_time)
+            unpickle_seconds += unpickle_time
+            transfer_seconds += (unpickle_start - start_time
+                                 - worker_seconds)
+            return result
+
+    result, seconds = _timed_call(function, (payload,) + args, kwargs)
+    inline_count += 1
+    inline_seconds += seconds
+    return result
+
+
+def report():
+    return [
+        ('Offloaded', 'Hub seconds saved', 'Unpickling seconds',
+         'Transfer seconds', 'Inline', 'Inline seconds'),
+        (offloaded_count, round(offloaded_seconds, 2),
+         round(unpickle_seconds, 2), round(transfer_seconds, 2),
+         inline_count, round(inline_seconds, 2)),
+    ]
+
+
+util.add_status_reporter('Extraction offloading', report)
@@ -1,10 +1,9 @@
-from youtube import util, yt_data_extract, proto, local_playlist
+from youtube import util, yt_data_extract, proto, local_playlist, offload
 from youtube import yt_app
 import settings
 
 import base64
 import urllib
-import json
 import string
 import gevent
 import math
@@ -29,27 +28,37 @@ def playlist_ctoken(playlist_id, offset, include_shorts=True):
 
 
 def playlist_first_page(playlist_id, report_text="Retrieved playlist",
-                        use_mobile=False):
+                        use_mobile=False, use_cache=True,
+                        extract_function=yt_data_extract.extract_playlist_info):
+    '''Returns extract_function applied to the first page. It runs in the
+    extraction worker together with parsing the json, so only its result
+    has to be sent back'''
+    cache_ttl = util.RESPONSE_CACHE_TTLS['playlist'] if use_cache else None
     if use_mobile:
         url = 'https://m.youtube.com/playlist?list=' + playlist_id + '&pbj=1'
         content = util.fetch_url(
             url, util.mobile_xhr_headers,
-            report_text=report_text, debug_name='playlist_first_page'
+            report_text=report_text, debug_name='playlist_first_page',
+            cache_ttl=cache_ttl
         )
-        content = json.loads(content.decode('utf-8'))
     else:
         url = 'https://www.youtube.com/playlist?list=' + playlist_id + '&pbj=1'
         content = util.fetch_url(
             url, util.desktop_xhr_headers,
-            report_text=report_text, debug_name='playlist_first_page'
+            report_text=report_text, debug_name='playlist_first_page',
+            cache_ttl=cache_ttl
         )
-        content = json.loads(content.decode('utf-8'))
 
-    return content
+    return offload.run(offload.json_then, content.decode('utf-8'),
+                       extract_function)
 
 
-def get_videos(playlist_id, page, include_shorts=True, use_mobile=False,
-               report_text='Retrieved playlist'):
+def get_videos_content(playlist_id, page, include_shorts=True,
+                       use_mobile=False, report_text='Retrieved playlist',
+                       use_cache=True):
+    '''Returns the undecoded response of get_videos.
+    use_cache=False always fetches the latest videos, such as when
+    checking for new uploads'''
     # mobile requests return 20 videos per page
     if use_mobile:
         page_size = 20
@@ -65,11 +74,19 @@ def get_videos(playlist_id, page, include_shorts=True, use_mobile=False,
     url += "&pbj=1"
     content = util.fetch_url(
         url, headers, report_text=report_text,
-        debug_name='playlist_videos'
+        debug_name='playlist_videos',
+        cache_ttl=util.RESPONSE_CACHE_TTLS['playlist'] if use_cache else None
     )
+    return content
 
-    info = json.loads(content.decode('utf-8'))
-    return info
+
+def get_videos(playlist_id, page, include_shorts=True, use_mobile=False,
+               report_text='Retrieved playlist', use_cache=True):
+    '''Returns the extracted playlist info of the page'''
+    content = get_videos_content(playlist_id, page, include_shorts,
+                                 use_mobile, report_text, use_cache)
+    return offload.run(offload.json_then, content.decode('utf-8'),
+                       yt_data_extract.extract_playlist_info)
 
 
 @yt_app.route('/playlist')
@@ -81,26 +98,26 @@ def get_playlist_page():
     page = request.args.get('page', '1')
 
     if page == '1':
-        first_page_json = playlist_first_page(playlist_id)
-        this_page_json = first_page_json
+        info = playlist_first_page(playlist_id)
+        metadata = None
     else:
         tasks = (
             gevent.spawn(
                 playlist_first_page, playlist_id,
-                report_text="Retrieved playlist info", use_mobile=True
+                report_text="Retrieved playlist info", use_mobile=True,
+                extract_function=yt_data_extract.extract_playlist_metadata
             ),
             gevent.spawn(get_videos, playlist_id, page)
         )
         gevent.joinall(tasks)
         util.check_gevent_exceptions(*tasks)
-        first_page_json, this_page_json = tasks[0].value, tasks[1].value
+        metadata, info = tasks[0].value, tasks[1].value
 
-    info = yt_data_extract.extract_playlist_info(this_page_json)
     if info['error']:
         return flask.render_template('error.html', error_message = info['error'])
 
-    if page != '1':
-        info['metadata'] = yt_data_extract.extract_playlist_metadata(first_page_json)
+    if metadata is not None:
+        info['metadata'] = metadata
 
     util.prefix_urls(info['metadata'])
     for item in info.get('items', ()):
@@ -0,0 +1,109 @@
+'''Background loading of things the user is likely to open next, such as
+the related videos of the video being watched
+
+Prefetch jobs run a few at a time, and only start once no pages are being
+loaded, so they don't compete with requests the user is waiting on. Jobs
+which download video data also count against a bandwidth budget of
+settings.prefetch_bandwidth_limit MiB per minute.
+'''
+import settings
+
+import time
+import gevent
+import gevent.lock
+import collections
+import traceback
+
+# Number of yt_app page requests currently being handled
+page_requests_in_progress = 0
+
+IDLE_POLL_INTERVAL = 0.2
+# Jobs still waiting for pages to finish loading after this long are dropped
+MAX_IDLE_WAIT = 30
+MAX_QUEUED = 16
+
+
+class Prefetcher:
+    def __init__(self, concurrency=2):
+        self.semaphore = gevent.lock.BoundedSemaphore(concurrency)
+        # key -> greenlet, for jobs waiting or running
+        self.in_flight = {}
+        self.running = set()
+        # (time, number of bytes) of recent downloads
+        self.recent_downloads = collections.deque()
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.over_budget = 0
+
+    def schedule(self, key, function, *args, **kwargs):
+        '''Runs function(*args, **kwargs) in the background unless a job
+        with the same key is already waiting or running'''
+        if key in self.in_flight:
+            return
+        if len(self.in_flight) >= MAX_QUEUED:
+            self.dropped += 1
+            return
+        self.in_flight[key] = gevent.spawn(self._run, key, function, args,
+                                           kwargs)
+
+    def wait(self, key):
+        '''Called before doing the work of the job with the given key in the
+        foreground. Waits for it if it's already running, otherwise cancels
+        it since the caller is about to do the same work'''
+        greenlet = self.in_flight.get(key)
+        if greenlet is None:
+            return
+        if key in self.running:
+            greenlet.join()
+        else:
+            greenlet.kill()
+            self.in_flight.pop(key, None)
+
+    def _wait_for_idle(self):
+        waited = 0
+        while page_requests_in_progress > 0:
+            if waited >= MAX_IDLE_WAIT:
+                return False
+            gevent.sleep(IDLE_POLL_INTERVAL)
+            waited += IDLE_POLL_INTERVAL
+        return True
+
+    def _run(self, key, function, args, kwargs):
+        try:
+            with self.semaphore:
+                if not self._wait_for_idle():
+                    self.dropped += 1
+                    return
+                self.running.add(key)
+                function(*args, **kwargs)
+                self.completed += 1
+        except Exception:
+            self.failed += 1
+            print('Error while prefetching', key)
+            traceback.print_exc()
+        finally:
+            self.running.discard(key)
+            if self.in_flight.get(key) is gevent.getcurrent():
+                del self.in_flight[key]
+
+    def use_bandwidth(self, num_bytes):
+        '''Returns whether num_bytes may be downloaded without going over
+        the bandwidth budget, counting them if so'''
+        now = time.monotonic()
+        while self.recent_downloads and self.recent_downloads[0][0] < now - 60:
+            self.recent_downloads.popleft()
+        used = sum(size for _, size in self.recent_downloads)
+        if used + num_bytes > settings.prefetch_bandwidth_limit*1024*1024:
+            self.over_budget += 1
+            return False
+        self.recent_downloads.append((now, num_bytes))
+        return True
+
+    def report(self):
+        return [
+            ('Waiting or running', 'Completed', 'Failed', 'Dropped',
+             'Skipped for bandwidth'),
+            (len(self.in_flight), self.completed, self.failed, self.dropped,
+             self.over_budget),
+        ]
@@ -0,0 +1,126 @@
+'''Read-ahead for routed video streams
+
+The av-merge player requests DASH segments one at a time, with each request
+waiting for the full upstream latency before its first byte. After a range
+of a stream has been sent to a client, the following range of the same size
+is downloaded in the background so the player's next request can be
+answered right away.
+
+Prefetched data is kept in memory, limited per client and in total. It is
+thrown away when the client requests a different position (seeking) or
+doesn't ask for it within STALE_TIME seconds.
+'''
+import settings
+
+import time
+import gevent
+
+STALE_TIME = 60
+
+
+class PrefetchedRange:
+    '''Bytes [start, end) of a stream, either being downloaded by greenlet
+    or already available as data'''
+    def __init__(self, client, start, end, greenlet=None, data=None):
+        self.client = client
+        self.start = start
+        self.end = end
+        self.greenlet = greenlet
+        self.data = data
+        self.time_created = time.monotonic()
+
+    def size(self):
+        return self.end - self.start
+
+    def get_data(self):
+        '''Waits for the download if necessary. Returns b'' if it failed'''
+        if self.data is None:
+            self.greenlet.join()
+            if self.greenlet.successful() and self.greenlet.value:
+                self.data = self.greenlet.value
+            else:
+                self.data = b''
+        return self.data
+
+    def cancel(self):
+        if self.greenlet is not None:
+            self.greenlet.kill(block=False)
+
+
+class ReadAheadBuffer:
+    def __init__(self):
+        # stream key -> PrefetchedRange
+        self.ranges = {}
+        self.hits = 0
+        self.misses = 0
+        self.seek_drops = 0
+        self.limit_skips = 0
+
+    def total_size(self):
+        return sum(prefetched.size() for prefetched in self.ranges.values())
+
+    def client_size(self, client):
+        return sum(prefetched.size() for prefetched in self.ranges.values()
+                   if prefetched.client == client)
+
+    def discard(self, stream_key):
+        prefetched = self.ranges.pop(stream_key, None)
+        if prefetched is not None:
+            prefetched.cancel()
+
+    def discard_stale(self):
+        now = time.monotonic()
+        for stream_key, prefetched in list(self.ranges.items()):
+            if now - prefetched.time_created > STALE_TIME:
+                self.discard(stream_key)
+
+    def take(self, stream_key, start, end):
+        '''Returns the prefetched bytes of the stream beginning at start, at
+        most end - start of them, or b'' if they weren't prefetched. Waits
+        for the download if it is still in progress. Any prefetched bytes
+        past end are kept for the next request.'''
+        prefetched = self.ranges.pop(stream_key, None)
+        if prefetched is None:
+            self.misses += 1
+            return b''
+        if prefetched.start != start:
+            prefetched.cancel()
+            self.seek_drops += 1
+            return b''
+
+        data = prefetched.get_data()
+        if not data:
+            self.misses += 1
+            return b''
+        self.hits += 1
+        if len(data) > end - start:
+            self.ranges[stream_key] = PrefetchedRange(
+                prefetched.client, end, start + len(data),
+                data=data[end - start:])
+        return data[0:end - start]
+
+    def prefetch(self, stream_key, client, start, end, fetch_function):
+        '''Starts downloading [start, end) of the stream in the background
+        with fetch_function(start, end), which returns the bytes, unless
+        that would go over the memory limits'''
+        existing = self.ranges.get(stream_key)
+        if existing is not None and existing.start == start:
+            # left over from a larger prefetch
+            return
+        self.discard(stream_key)
+        self.discard_stale()
+        size = end - start
+        if size <= 0:
+            return
+        client_limit = settings.video_read_ahead_client_limit*1024*1024
+        total_limit = settings.video_read_ahead_total_limit*1024*1024
+        if (self.client_size(client) + size > client_limit
+                or self.total_size() + size > total_limit):
+            self.limit_skips += 1
+            return
+        greenlet = gevent.spawn(fetch_function, start, end)
+        self.ranges[stream_key] = PrefetchedRange(client, start, end,
+                                                  greenlet)
+
+
+read_ahead_buffer = ReadAheadBuffer()
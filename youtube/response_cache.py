@@ -0,0 +1,160 @@
+'''Cache for responses fetched with util.fetch_url
+
+Only used by call sites which opt in by passing cache_ttl to fetch_url,
+such as playlist and channel pages or search results, which are otherwise
+downloaded again on every back/forward navigation or page refresh.
+
+Decompressed response bodies are kept in memory, limited to
+settings.response_cache_memory_size MiB, and optionally also on disk,
+limited to settings.response_cache_disk_size MiB. Least recently used
+responses are dropped first.
+'''
+import settings
+
+import os
+import time
+import hashlib
+import collections
+import traceback
+
+cache_directory = os.path.join(settings.data_dir, 'response_cache')
+
+
+class ResponseCache:
+    def __init__(self):
+        # key hash -> (expire_time, content)
+        self.memory = collections.OrderedDict()
+        self.memory_size = 0
+        # key hash -> size, in least recently used order. Loaded lazily
+        self.disk = None
+        self.disk_size = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def hash_key(key):
+        return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        '''Returns the cached content for key, or None'''
+        key_hash = self.hash_key(key)
+        now = time.time()
+        if key_hash in self.memory:
+            expire_time, content = self.memory[key_hash]
+            if now < expire_time:
+                self.memory.move_to_end(key_hash)
+                self.memory_hits += 1
+                return content
+            self._remove_from_memory(key_hash)
+
+        if settings.response_cache_disk_size > 0:
+            result = self._read_from_disk(key_hash)
+            if result is not None:
+                expire_time, content = result
+                if now < expire_time:
+                    self.disk_hits += 1
+                    self._add_to_memory(key_hash, expire_time, content)
+                    return content
+                self._remove_from_disk(key_hash)
+
+        self.misses += 1
+        return None
+
+    def put(self, key, content, ttl):
+        key_hash = self.hash_key(key)
+        expire_time = time.time() + ttl
+        self._add_to_memory(key_hash, expire_time, content)
+        if settings.response_cache_disk_size > 0:
+            self._write_to_disk(key_hash, expire_time, content)
+
+    def _add_to_memory(self, key_hash, expire_time, content):
+        budget = settings.response_cache_memory_size*1024*1024
+        if len(content) > budget:
+            return
+        if key_hash in self.memory:
+            self._remove_from_memory(key_hash)
+        self.memory[key_hash] = (expire_time, content)
+        self.memory_size += len(content)
+        while self.memory_size > budget:
+            self._remove_from_memory(next(iter(self.memory)))
+
+    def _remove_from_memory(self, key_hash):
+        expire_time, content = self.memory.pop(key_hash)
+        self.memory_size -= len(content)
+
+    # Disk tier. Each response is a file named by the key hash, containing
+    # the expire time on the first line followed by the content
+    def _load_disk_index(self):
+        self.disk = collections.OrderedDict()
+        self.disk_size = 0
+        try:
+            names = os.listdir(cache_directory)
+        except FileNotFoundError:
+            return
+        files = []
+        for name in names:
+            if name.endswith('.tmp'):
+                continue
+            path = os.path.join(cache_directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(files):
+            self.disk[name] = size
+            self.disk_size += size
+
+    def _read_from_disk(self, key_hash):
+        if self.disk is None:
+            self._load_disk_index()
+        if key_hash not in self.disk:
+            return None
+        try:
+            with open(os.path.join(cache_directory, key_hash), 'rb') as f:
+                expire_time = float(f.readline())
+                content = f.read()
+        except (OSError, ValueError):
+            traceback.print_exc()
+            self._remove_from_disk(key_hash)
+            return None
+        self.disk.move_to_end(key_hash)
+        return expire_time, content
+
+    def _write_to_disk(self, key_hash, expire_time, content):
+        if self.disk is None:
+            self._load_disk_index()
+        budget = settings.response_cache_disk_size*1024*1024
+        data = (repr(expire_time) + '\n').encode('ascii') + content
+        if len(data) > budget:
+            return
+        path = os.path.join(cache_directory, key_hash)
+        try:
+            os.makedirs(cache_directory, exist_ok=True)
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            os.replace(path + '.tmp', path)
+        except OSError:
+            traceback.print_exc()
+            return
+        if key_hash in self.disk:
+            self.disk_size -= self.disk.pop(key_hash)
+        self.disk[key_hash] = len(data)
+        self.disk_size += len(data)
+        while self.disk_size > budget:
+            self._remove_from_disk(next(iter(self.disk)))
+
+    def _remove_from_disk(self, key_hash):
+        size = self.disk.pop(key_hash, None)
+        if size is not None:
+            self.disk_size -= size
+        try:
+            os.remove(os.path.join(cache_directory, key_hash))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            traceback.print_exc()
+
+
+response_cache = ResponseCache()
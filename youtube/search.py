@@ -1,8 +1,7 @@
-from youtube import util, yt_data_extract, proto, local_playlist
+from youtube import util, yt_data_extract, proto, local_playlist, offload
 from youtube import yt_app
 import settings
 
-import json
 import urllib
 import base64
 import mimetypes
@@ -42,7 +41,7 @@ def page_number_to_sp_parameter(page, autocorrect, sort, filters):
     result = proto.uint(1, sort) + filters_enc + autocorrect + proto.uint(9, offset) + proto.string(61, b'')
     return base64.urlsafe_b64encode(result).decode('ascii')
 
-def get_search_json(query, page, autocorrect, sort, filters):
+def get_search_info(query, page, autocorrect, sort, filters):
     url = "https://www.youtube.com/results?search_query=" + urllib.parse.quote_plus(query)
     headers = {
         'Host': 'www.youtube.com',
@@ -53,9 +52,10 @@ def get_search_json(query, page, autocorrect, sort, filters):
         'X-YouTube-Client-Version': '2.20180418',
     }
     url += "&pbj=1&sp=" + page_number_to_sp_parameter(page, autocorrect, sort, filters).replace("=", "%3D")
-    content = util.fetch_url(url, headers=headers, report_text="Got search results", debug_name='search_results')
-    info = json.loads(content)
-    return info
+    content = util.fetch_url(url, headers=headers, report_text="Got search results", debug_name='search_results',
+                             cache_ttl=util.RESPONSE_CACHE_TTLS['search'])
+    return offload.run(offload.json_then, content,
+                       yt_data_extract.extract_search_info)
 
 
 @yt_app.route('/results')
@@ -74,9 +74,7 @@ def get_search_page():
     filters['time'] = int(request.args.get("time", "0"))
     filters['type'] = int(request.args.get("type", "0"))
     filters['duration'] = int(request.args.get("duration", "0"))
-    polymer_json = get_search_json(query, page, autocorrect, sort, filters)
-
-    search_info = yt_data_extract.extract_search_info(polymer_json)
+    search_info = get_search_info(query, page, autocorrect, sort, filters)
     if search_info['error']:
         return flask.render_template('error.html', error_message = search_info['error'])
 
@@ -0,0 +1,239 @@
+'''Disk cache for byte ranges of proxied googlevideo streams
+
+Each cached stream is identified by the (id, itag, clen) parameters of its
+googlevideo url, which stay the same across the different urls Youtube gives
+out for the same video format. The bytes are written into a sparse file at
+their actual positions, and the ranges which have been filled in so far
+("extents") are tracked in an index, so that a Range request can be answered
+partly from disk and partly from Youtube.
+
+Whole streams are evicted in least recently used order once the total size
+of cached data exceeds settings.video_cache_size.
+
+Data is added about once per MiB streamed, so the index isn't saved every
+time. It's saved when streams are evicted, when a response ends, and at
+most INDEX_SAVE_INTERVAL seconds apart while streaming. An index older than
+the files only loses track of some cached data, which is fetched again.
+'''
+import settings
+
+import os
+import re
+import json
+import time
+import bisect
+import urllib.parse
+import traceback
+import gevent.lock
+
+cache_directory = os.path.join(settings.data_dir, 'video_cache')
+index_path = os.path.join(cache_directory, 'index.json')
+
+KEY_PART_RE = re.compile(r'[-\w.]+')
+INDEX_SAVE_INTERVAL = 60
+
+
+def add_extent(extents, start, end):
+    '''Adds the range [start, end) to the sorted list of non-overlapping
+    [start, end) pairs, merging it with any ranges it touches'''
+    if start >= end:
+        return
+    # index of first extent which ends at or after start
+    i = bisect.bisect_left([extent[1] for extent in extents], start)
+    j = i
+    while j < len(extents) and extents[j][0] <= end:
+        start = min(start, extents[j][0])
+        end = max(end, extents[j][1])
+        j += 1
+    extents[i:j] = [[start, end]]
+
+
+def split_range(extents, start, end):
+    '''Splits [start, end) into a list of (start, end, is_cached) pieces
+    according to which parts are covered by extents'''
+    pieces = []
+    position = start
+    i = bisect.bisect_right([extent[1] for extent in extents], start)
+    while position < end:
+        if i < len(extents) and extents[i][0] <= position:
+            piece_end = min(end, extents[i][1])
+            pieces.append((position, piece_end, True))
+            i += 1
+        else:
+            if i < len(extents):
+                piece_end = min(end, extents[i][0])
+            else:
+                piece_end = end
+            pieces.append((position, piece_end, False))
+        position = piece_end
+    return pieces
+
+
+def extents_size(extents):
+    return sum(end - start for start, end in extents)
+
+
+class CacheEntry:
+    def __init__(self, key, content_length, mime, extents=None,
+                 last_access=0):
+        self.key = key
+        self.content_length = content_length
+        self.mime = mime
+        self.extents = extents or []
+        self.last_access = last_access
+        self.path = os.path.join(cache_directory, key + '.bin')
+        self.evicted = False
+        self.lock = gevent.lock.BoundedSemaphore(1)
+
+    def size(self):
+        return extents_size(self.extents)
+
+    def split(self, start, end):
+        return split_range(self.extents, start, end)
+
+    def write(self, position, data):
+        '''Writes data at position in the sparse file and marks it as
+        cached'''
+        if self.evicted or position + len(data) > self.content_length:
+            return
+        with self.lock:
+            try:
+                f = open(self.path, 'r+b')
+            except FileNotFoundError:
+                os.makedirs(cache_directory, exist_ok=True)
+                f = open(self.path, 'w+b')
+            with f:
+                f.seek(position)
+                f.write(data)
+            add_extent(self.extents, position, position + len(data))
+
+    def read(self, start, end, chunk_size=32*8192):
+        '''Generator which yields the cached bytes in [start, end)'''
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            position = start
+            while position < end:
+                data = f.read(min(chunk_size, end - position))
+                if not data:
+                    raise EOFError('Cache file %s shorter than its index'
+                                   % self.path)
+                position += len(data)
+                yield data
+
+    def to_json(self):
+        return {
+            'content_length': self.content_length,
+            'mime': self.mime,
+            'extents': self.extents,
+            'last_access': self.last_access,
+        }
+
+
+class SegmentCache:
+    def __init__(self):
+        self.entries = {}
+        self.index_lock = gevent.lock.BoundedSemaphore(1)
+        self.index_changed = False
+        self.index_save_time = time.monotonic()
+        try:
+            with open(index_path, 'r', encoding='utf-8') as f:
+                index = json.loads(f.read())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            print('Error reading video cache index, starting with empty cache')
+            traceback.print_exc()
+            return
+        for key, info in index.get('entries', {}).items():
+            entry = CacheEntry(key, info['content_length'], info['mime'],
+                               info['extents'], info['last_access'])
+            if os.path.exists(entry.path):
+                self.entries[key] = entry
+
+    def total_size(self):
+        return sum(entry.size() for entry in self.entries.values())
+
+    def get_entry(self, query_string):
+        '''Returns the CacheEntry for the googlevideo url with the given
+        query string, or None if caching is disabled or the url lacks the
+        information needed to identify the stream'''
+        if settings.video_cache_size <= 0:
+            return None
+        params = urllib.parse.parse_qs(query_string)
+        try:
+            video_id = params['id'][0]
+            itag = params['itag'][0]
+            content_length = int(params['clen'][0])
+            mime = params['mime'][0]
+        except (KeyError, ValueError):
+            return None
+        if not all(KEY_PART_RE.fullmatch(part) for part in (video_id, itag)):
+            return None
+        if content_length <= 0:
+            return None
+
+        key = video_id + '_' + itag + '_' + str(content_length)
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = CacheEntry(key, content_length, mime)
+            self.entries[key] = entry
+        entry.last_access = time.time()
+        return entry
+
+    def commit(self, entry):
+        '''Called after data has been added to entry. Evicts least recently
+        used streams if over the size budget, and saves the index if streams
+        were evicted or it hasn't been saved for INDEX_SAVE_INTERVAL'''
+        self.index_changed = True
+        budget = settings.video_cache_size*1024*1024
+        total_size = self.total_size()
+        if total_size > budget:
+            by_age = sorted(self.entries.values(),
+                            key=lambda e: e.last_access)
+            for old_entry in by_age:
+                if total_size <= budget:
+                    break
+                if old_entry is entry:
+                    continue
+                total_size -= old_entry.size()
+                self.remove(old_entry)
+            self.save_index()
+        elif (time.monotonic() - self.index_save_time
+                >= INDEX_SAVE_INTERVAL):
+            self.save_index()
+
+    def finish(self):
+        '''Called when a response using the cache ends. Saves the index if
+        data has been added since it was last saved'''
+        if self.index_changed:
+            self.save_index()
+
+    def remove(self, entry):
+        del self.entries[entry.key]
+        entry.evicted = True
+        try:
+            os.remove(entry.path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            print('Failed to delete video cache file: ' + entry.path)
+            traceback.print_exc()
+
+    def save_index(self):
+        with self.index_lock:
+            self.index_changed = False
+            self.index_save_time = time.monotonic()
+            index = {
+                'version': 1,
+                'entries': {key: entry.to_json()
+                            for key, entry in self.entries.items()
+                            if entry.extents},
+            }
+            os.makedirs(cache_directory, exist_ok=True)
+            temp_path = index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(json.dumps(index))
+            os.replace(temp_path, index_path)
+
+
+segment_cache = SegmentCache()
@@ -1,4 +1,5 @@
 from youtube import util, yt_data_extract, channel, local_playlist, playlist
+from youtube import offload, upload_model, thumbnails
 from youtube import yt_app
 import settings
 
@@ -13,6 +14,12 @@ import defusedxml.ElementTree
 import urllib
 import math
 import secrets
+import base64
+import binascii
+import heapq
+import gevent.event
+import gevent.queue
+import gevent.lock
 import collections
 import calendar # bullshit! https://bugs.python.org/issue6280
 import csv
@@ -22,59 +29,231 @@ import flask
 from flask import request
 
 
+# Thumbnails are kept in the thumbnails store. They used to be saved in this
+# directory, and are moved into the store as they're shown
 thumbnails_directory = os.path.join(settings.data_dir, "subscription_thumbnails")
 
 # https://stackabuse.com/a-sqlite-tutorial-with-python/
 
 database_path = os.path.join(settings.data_dir, "subscriptions.sqlite")
 
-def open_database():
-    if not os.path.exists(settings.data_dir):
-        os.makedirs(settings.data_dir)
-    connection = sqlite3.connect(database_path, check_same_thread=False)
-
-    try:
-        cursor = connection.cursor()
-        cursor.execute('''PRAGMA foreign_keys = 1''')
-        # Create tables if they don't exist
-        cursor.execute('''CREATE TABLE IF NOT EXISTS subscribed_channels (
-                              id integer PRIMARY KEY,
-                              yt_channel_id text UNIQUE NOT NULL,
-                              channel_name text NOT NULL,
-                              time_last_checked integer DEFAULT 0,
-                              next_check_time integer DEFAULT 0,
-                              muted integer DEFAULT 0
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS videos (
-                              id integer PRIMARY KEY,
-                              sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                              video_id text UNIQUE NOT NULL,
-                              title text NOT NULL,
-                              duration text,
-                              time_published integer NOT NULL,
-                              is_time_published_exact integer DEFAULT 0,
-                              time_noticed integer NOT NULL,
-                              description text,
-                              watched integer default 0
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS tag_associations (
-                              id integer PRIMARY KEY,
-                              tag text NOT NULL,
-                              sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
-                              UNIQUE(tag, sql_channel_id)
-                          )''')
-        cursor.execute('''CREATE TABLE IF NOT EXISTS db_info (
-                              version integer DEFAULT 1
-                          )''')
-
-        connection.commit()
-    except:
-        connection.rollback()
-        connection.close()
-        raise
-
-    # https://stackoverflow.com/questions/19522505/using-sqlite3-in-python-with-with-keyword
-    return contextlib.closing(connection)
+def _create_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS subscribed_channels (
+                          id integer PRIMARY KEY,
+                          yt_channel_id text UNIQUE NOT NULL,
+                          channel_name text NOT NULL,
+                          time_last_checked integer DEFAULT 0,
+                          next_check_time integer DEFAULT 0,
+                          muted integer DEFAULT 0
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS videos (
+                          id integer PRIMARY KEY,
+                          sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
+                          video_id text UNIQUE NOT NULL,
+                          title text NOT NULL,
+                          duration text,
+                          time_published integer NOT NULL,
+                          is_time_published_exact integer DEFAULT 0,
+                          time_noticed integer NOT NULL,
+                          description text,
+                          watched integer default 0
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tag_associations (
+                          id integer PRIMARY KEY,
+                          tag text NOT NULL,
+                          sql_channel_id integer NOT NULL REFERENCES subscribed_channels(id) ON UPDATE CASCADE ON DELETE CASCADE,
+                          UNIQUE(tag, sql_channel_id)
+                      )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS db_info (
+                          version integer DEFAULT 1
+                      )''')
+
+
+# --- Schema migrations ---
+# MIGRATIONS[i] upgrades the database from version i + 1 to version i + 2.
+# The current version is stored in db_info. Only ever append to this list
+def _add_feed_indexes(cursor):
+    # Subscriptions feed: ORDER BY time_noticed DESC, time_published DESC
+    cursor.execute('''CREATE INDEX IF NOT EXISTS videos_time_noticed
+                      ON videos(time_noticed DESC, time_published DESC,
+                                sql_channel_id)''')
+    # Tag feed and channel checks: the videos of a given channel by time.
+    # Also needed for deleting a channel's videos when unsubscribing
+    cursor.execute('''CREATE INDEX IF NOT EXISTS videos_channel_time_published
+                      ON videos(sql_channel_id, time_published DESC)''')
+    # (tag, sql_channel_id) is already indexed by its UNIQUE constraint.
+    # This one is for joining and deleting by channel
+    cursor.execute('''CREATE INDEX IF NOT EXISTS tag_associations_channel
+                      ON tag_associations(sql_channel_id, tag)''')
+    cursor.execute('''ANALYZE''')
+
+def _add_video_counts(cursor):
+    # Number of videos of each channel, kept up to date by triggers, so the
+    # size of the feed is known without counting the videos table
+    cursor.execute('''ALTER TABLE subscribed_channels
+                      ADD COLUMN video_count integer NOT NULL DEFAULT 0''')
+    cursor.execute('''UPDATE subscribed_channels
+                      SET video_count = (
+                          SELECT COUNT(*) FROM videos
+                          WHERE sql_channel_id = subscribed_channels.id
+                      )''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS videos_count_insert
+                      AFTER INSERT ON videos
+                      BEGIN
+                          UPDATE subscribed_channels
+                          SET video_count = video_count + 1
+                          WHERE id = NEW.sql_channel_id;
+                      END''')
+    cursor.execute('''CREATE TRIGGER IF NOT EXISTS videos_count_delete
+                      AFTER DELETE ON videos
+                      BEGIN
+                          UPDATE subscribed_channels
+                          SET video_count = video_count - 1
+                          WHERE id = OLD.sql_channel_id;
+                      END''')
+    # Feed pages are found by (time_noticed, time_published, id) of the last
+    # video of the previous page, so the id needs to be in the index too
+    cursor.execute('''DROP INDEX IF EXISTS videos_time_noticed''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS videos_feed
+                      ON videos(time_noticed, time_published, id)''')
+    cursor.execute('''ANALYZE''')
+
+def _add_feed_validators(cursor):
+    # ETag and Last-Modified of the last Atom feed response, to ask for the
+    # feed only if it changed
+    cursor.execute('''ALTER TABLE subscribed_channels
+                      ADD COLUMN feed_etag text''')
+    cursor.execute('''ALTER TABLE subscribed_channels
+                      ADD COLUMN feed_last_modified text''')
+
+def _add_upload_models(cursor):
+    # JSON of the channel's upload_model.UploadModel, built from its videos
+    # the next time it's checked
+    cursor.execute('''ALTER TABLE subscribed_channels
+                      ADD COLUMN upload_model text''')
+
+MIGRATIONS = [
+    _add_feed_indexes,
+    _add_video_counts,
+    _add_feed_validators,
+    _add_upload_models,
+]
+SCHEMA_VERSION = len(MIGRATIONS) + 1
+
+def _get_schema_version(cursor):
+    row = cursor.execute('''SELECT version FROM db_info''').fetchone()
+    if row is None:
+        cursor.execute('''INSERT INTO db_info (version) VALUES (1)''')
+        return 1
+    return row[0]
+
+def _migrate(connection):
+    '''Brings the database up to SCHEMA_VERSION, committing after each
+    migration'''
+    with connection:
+        version = _get_schema_version(connection)
+    if version > SCHEMA_VERSION:
+        print('Warning: subscriptions database is from a newer version ('
+              + str(version) + ')')
+    while version < SCHEMA_VERSION:
+        print('Upgrading subscriptions database to version '
+              + str(version + 1))
+        with connection:
+            MIGRATIONS[version - 1](connection)
+            version += 1
+            connection.execute('''UPDATE db_info SET version = ?''',
+                               [version])
+
+
+class ConnectionManager:
+    '''Long-lived connections to the subscriptions database, shared between
+    greenlets: a single writer connection, used by one greenlet at a time,
+    and a pool of read-only connections. The database is in WAL mode, so
+    reads such as rendering the subscriptions feed don't wait for channel
+    checks writing new videos.'''
+    MAX_IDLE_READERS = 4
+
+    def __init__(self):
+        self.writer = None
+        self.write_lock = gevent.lock.RLock()
+        self.idle_readers = []
+
+    def _connect(self):
+        if not os.path.exists(settings.data_dir):
+            os.makedirs(settings.data_dir)
+        connection = sqlite3.connect(database_path, check_same_thread=False)
+        connection.execute('''PRAGMA foreign_keys = 1''')
+        connection.execute('''PRAGMA synchronous = NORMAL''')
+        connection.execute('''PRAGMA busy_timeout = 5000''')
+        connection.execute('''PRAGMA cache_size = -16000''')    # 16 MiB
+        connection.execute('''PRAGMA mmap_size = 67108864''')   # 64 MiB
+        return connection
+
+    def _get_writer(self):
+        if self.writer is None:
+            connection = self._connect()
+            try:
+                connection.execute('''PRAGMA journal_mode = WAL''')
+                with connection:
+                    _create_tables(connection)
+                _migrate(connection)
+            except:
+                connection.close()
+                raise
+            self.writer = connection
+        return self.writer
+
+    @contextlib.contextmanager
+    def write_connection(self):
+        with self.write_lock:
+            connection = self._get_writer()
+            try:
+                yield connection
+            finally:
+                if connection.in_transaction:
+                    connection.rollback()
+
+    @contextlib.contextmanager
+    def read_connection(self):
+        if self.idle_readers:
+            connection = self.idle_readers.pop()
+        else:
+            # Make sure the tables exist before reading from them
+            with self.write_lock:
+                self._get_writer()
+            connection = self._connect()
+            connection.execute('''PRAGMA query_only = 1''')
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+            if len(self.idle_readers) < self.MAX_IDLE_READERS:
+                self.idle_readers.append(connection)
+            else:
+                connection.close()
+
+    def close_all(self):
+        with self.write_lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+        for connection in self.idle_readers:
+            connection.close()
+        self.idle_readers = []
+
+connection_manager = ConnectionManager()
+
+def open_database(read_only=False):
+    '''Used as
+        with open_database() as connection:
+            with connection as cursor:
+                ...
+    The inner with statement commits the changes, or rolls them back on
+    an exception'''
+    if read_only:
+        return connection_manager.read_connection()
+    return connection_manager.write_connection()
 
 def with_open_db(function, *args, **kwargs):
     with open_database() as connection:
@@ -94,7 +273,8 @@ def is_subscribed(channel_id):
     if not os.path.exists(database_path):
         return False
 
-    return with_open_db(_is_subscribed, channel_id)
+    with open_database(read_only=True) as connection:
+        return _is_subscribed(connection, channel_id)
 
 def _subscribe(channels):
     ''' channels is a list of (channel_id, channel_name) '''
@@ -113,15 +293,15 @@ def _subscribe(channels):
         channel_names.update(channels)
         check_channels_if_necessary(channel_ids_to_check)
 
-def delete_thumbnails(to_delete):
-    for thumbnail in to_delete:
+def delete_thumbnails(video_ids):
+    thumbnails.remove_references(thumbnails.SUBSCRIPTIONS, video_ids)
+    for video_id in video_ids:
         try:
-            video_id = thumbnail[0:-4]
-            if video_id in existing_thumbnails:
-                os.remove(os.path.join(thumbnails_directory, thumbnail))
-                existing_thumbnails.remove(video_id)
+            os.remove(os.path.join(thumbnails_directory, video_id + '.jpg'))
+        except FileNotFoundError:
+            pass
         except Exception:
-            print('Failed to delete thumbnail: ' + thumbnail)
+            print('Failed to delete thumbnail: ' + video_id)
             traceback.print_exc()
 
 def _unsubscribe(cursor, channel_ids):
@@ -135,41 +315,114 @@ def _unsubscribe(cursor, channel_ids):
                                      FROM subscribed_channels
                                      WHERE yt_channel_id=?
                                  )''', (channel_id,)).fetchall()
-        to_delete += [row[0] + '.jpg' for row in rows]
+        to_delete += [row[0] for row in rows]
 
     gevent.spawn(delete_thumbnails, to_delete)
     cursor.executemany("DELETE FROM subscribed_channels WHERE yt_channel_id=?", ((channel_id, ) for channel_id in channel_ids))
 
-def _get_videos(cursor, number_per_page, offset, tag = None):
-    '''Returns a full page of videos with an offset, and a value good enough to be used as the total number of videos'''
-    # We ask for the next 9 pages from the database
-    # Then the actual length of the results tell us if there are more than 9 pages left, and if not, how many there actually are
-    # This is done since there are only 9 page buttons on display at a time
-    # If there are more than 9 pages left, we give a fake value in place of the real number of results if the entire database was queried without limit
-    # This fake value is sufficient to get the page button generation macro to display 9 page buttons
-    # If we wish to display more buttons this logic must change
-    # We cannot use tricks with the sql id for the video since we frequently have filters and other restrictions in place on the results anyway
-    # TODO: This is probably not the ideal solution
-    if tag is not None:
-        db_videos = cursor.execute('''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
-                                      FROM videos
-                                      INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
-                                      INNER JOIN tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
-                                      WHERE tag = ? AND muted = 0
-                                      ORDER BY time_noticed DESC, time_published DESC
-                                      LIMIT ? OFFSET ?''', (tag, number_per_page*9, offset)).fetchall()
-    else:
-        db_videos = cursor.execute('''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id
-                                      FROM videos
-                                      INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
-                                      WHERE muted = 0
-                                      ORDER BY time_noticed DESC, time_published DESC
-                                      LIMIT ? OFFSET ?''', (number_per_page*9, offset)).fetchall()
+def encode_page_token(direction, row):
+    '''Token for the page after (direction 'n') or before (direction 'p')
+    the video with the given (time_noticed, time_published, id)'''
+    token = direction + '_'.join(str(int(part)) for part in row)
+    return base64.urlsafe_b64encode(token.encode('ascii')).decode('ascii')
 
-    pseudo_number_of_videos = offset + len(db_videos)
+def decode_page_token(page_token):
+    '''Inverse of encode_page_token. Raises ValueError for invalid tokens'''
+    try:
+        token = base64.urlsafe_b64decode(page_token.encode('ascii'))
+        token = token.decode('ascii')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('Invalid page token')
+    direction, parts = token[0:1], token[1:].split('_')
+    if direction not in ('n', 'p') or len(parts) != 3:
+        raise ValueError('Invalid page token')
+    return direction, tuple(int(part) for part in parts)
+
+def _count_videos(cursor, tag=None):
+    '''Number of videos in the feed, or in the feed for the tag'''
+    if tag is None:
+        return cursor.execute('''SELECT COALESCE(SUM(video_count), 0)
+                                  FROM subscribed_channels
+                                  WHERE muted = 0''').fetchone()[0]
+    return cursor.execute('''SELECT COALESCE(SUM(video_count), 0)
+                              FROM subscribed_channels
+                              INNER JOIN tag_associations
+                                  ON subscribed_channels.id = tag_associations.sql_channel_id
+                              WHERE tag = ? AND muted = 0''', [tag]).fetchone()[0]
+
+# Past this many videos, scanning the whole feed in order to find the videos
+# for a tag is slower than gathering the tag's videos and sorting them
+MAX_TAG_FEED_SCAN = 20000
+
+def _get_videos(cursor, number_per_page, offset, tag=None, page_token=None):
+    '''Returns a page of the feed as (videos, total number of videos,
+    token of the next page, token of the previous page). The tokens are
+    None if there is no such page.
+
+    With a page_token, the page is found from where the previous one ended,
+    so deep pages are as fast as the first. Otherwise offset videos are
+    skipped. offset is also used as an estimate of the position of
+    page_token'''
+    number_of_videos = _count_videos(cursor)
+    select = '''SELECT video_id, title, duration, time_published, is_time_published_exact, channel_name, yt_channel_id, time_noticed, videos.id\n'''
+    if tag is None:
+        statement = select + '''FROM videos
+                                INNER JOIN subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                WHERE muted = 0'''
+        parameters = []
+    else:
+        number_of_tag_videos = _count_videos(cursor, tag)
+        rows_to_scan = ((offset + number_per_page)*number_of_videos
+                        / max(number_of_tag_videos, 1))
+        # CROSS JOIN makes SQLite go through videos first, in feed order,
+        # rather than through the tag's channels
+        join = 'CROSS JOIN' if rows_to_scan <= MAX_TAG_FEED_SCAN else 'INNER JOIN'
+        statement = select + '''FROM videos
+                                {join} subscribed_channels on videos.sql_channel_id = subscribed_channels.id
+                                {join} tag_associations on videos.sql_channel_id = tag_associations.sql_channel_id
+                                WHERE tag = ? AND muted = 0'''.format(join=join)
+        parameters = [tag]
+        number_of_videos = number_of_tag_videos
+
+    direction = 'n'
+    if page_token:
+        direction, key = decode_page_token(page_token)
+        if direction == 'n':
+            statement += '''\nAND (time_noticed, time_published, videos.id) < (?, ?, ?)'''
+        else:
+            statement += '''\nAND (time_noticed, time_published, videos.id) > (?, ?, ?)'''
+        parameters += key
+    order = 'DESC' if direction == 'n' else 'ASC'
+    statement += '''\nORDER BY time_noticed {0}, time_published {0}, videos.id {0}
+                     LIMIT ?'''.format(order)
+    # One more to find out if there is another page
+    parameters.append(number_per_page + 1)
+    if not page_token:
+        statement += ''' OFFSET ?'''
+        parameters.append(offset)
+    db_videos = cursor.execute(statement, parameters).fetchall()
+
+    more_pages = len(db_videos) > number_per_page
+    db_videos = db_videos[0:number_per_page]
+    if direction == 'n':
+        has_next_page = more_pages
+        has_previous_page = bool(page_token) or offset > 0
+    else:
+        db_videos.reverse()
+        has_next_page = True
+        has_previous_page = more_pages
+
+    def page_key(db_video):
+        # (time_noticed, time_published, id)
+        return db_video[7], db_video[3], db_video[8]
+    next_page_token = previous_page_token = None
+    if db_videos and has_next_page:
+        next_page_token = encode_page_token('n', page_key(db_videos[-1]))
+    if db_videos and has_previous_page:
+        previous_page_token = encode_page_token('p', page_key(db_videos[0]))
 
     videos = []
-    for db_video in db_videos[0:number_per_page]:
+    for db_video in db_videos:
         videos.append({
             'id':   db_video[0],
             'title':    db_video[1],
@@ -180,9 +433,7 @@ def _get_videos(cursor, number_per_page, offset, tag = None):
             'author_url': '/https://www.youtube.com/channel/' + db_video[6],
         })
 
-    return videos, pseudo_number_of_videos
-
-
+    return videos, number_of_videos, next_page_token, previous_page_token
 
 
 def _get_subscribed_channels(cursor):
@@ -301,108 +552,306 @@ def exact_timestamp(posix_time):
         return result[1:]
     return result
 
-try:
-    existing_thumbnails = set(os.path.splitext(name)[0] for name in os.listdir(thumbnails_directory))
-except FileNotFoundError:
-    existing_thumbnails = set()
 
 
 # --- Manual checking system. Rate limited in order to support very large numbers of channels to be checked ---
 # Auto checking system plugs into this for convenience, though it doesn't really need the rate limiting
 
-check_channels_queue = util.RateLimitedQueue()
+check_channels_queue = util.AdaptiveRateLimitedQueue(
+    state_path=os.path.join(settings.data_dir, 'subscription_check_rate.json'))
 checking_channels = set()
 
+def _record_check_response(url, status):
+    # Checks only make requests to Youtube itself, not for images or videos
+    if util.get_traffic_class(url) == 'api':
+        check_channels_queue.record_response(status)
+util.add_response_listener(_record_check_response)
+
+def report_check_rate():
+    header, row = check_channels_queue.report()
+    return [header + ('Channels queued or being checked', 'Workers',
+                      'Idle workers'),
+            row + (len(checking_channels), len(check_worker_pool.workers),
+                   check_worker_pool.idle_workers)]
+util.add_status_reporter('Subscription check rate', report_check_rate)
+
 # Just to use for printing channel checking status to console without opening database
 channel_names = dict()
 
-def check_channel_worker():
-    while True:
-        channel_id = check_channels_queue.get()
+class CheckRound:
+    '''Statistics of a check round. A round starts when channels are queued
+    while none are being checked, and ends once all of them are checked'''
+    def __init__(self):
+        self.start_time = time.time()
+        self.channels_checked = 0
+        # Checks where the Atom feed showed nothing new, so the channel's
+        # video list wasn't downloaded
+        self.feed_only_checks = 0
+        # Of those, checks where the feed itself hadn't changed
+        self.feed_not_modified = 0
+        self.check_seconds = 0.0
+        self.slowest_check_seconds = 0.0
+        self.most_workers = 0
+
+    def estimated_bytes_saved(self):
+        if video_list_count == 0:
+            return 0
+        return self.feed_only_checks*video_list_bytes//video_list_count
+
+check_rounds = collections.deque(maxlen=5)
+# Total size of the video lists downloaded so far, to estimate how much
+# was saved by not downloading them
+video_list_bytes = 0
+video_list_count = 0
+
+def _queue_channel_check(channel_id):
+    if not checking_channels:
+        check_rounds.append(CheckRound())
+    checking_channels.add(channel_id)
+    check_channels_queue.put(channel_id)
+    check_worker_pool.grow()
+
+def _check_channel(channel_id):
+    check_round = check_rounds[-1]
+    check_round.most_workers = max(check_round.most_workers,
+                                   len(check_worker_pool.workers))
+    start_time = time.monotonic()
+    try:
+        result = _get_upstream_videos(channel_id)
+        if result in ('feed_only', 'not_modified'):
+            check_round.feed_only_checks += 1
+        if result == 'not_modified':
+            check_round.feed_not_modified += 1
+    except Exception:
+        traceback.print_exc()
+    finally:
+        seconds = time.monotonic() - start_time
+        print('Checked %s in %.2f s' % (channel_names.get(channel_id,
+                                                          channel_id),
+                                        seconds))
+        check_round.check_seconds += seconds
+        check_round.slowest_check_seconds = max(
+            check_round.slowest_check_seconds, seconds)
+        check_round.channels_checked += 1
+        checking_channels.remove(channel_id)
+        if not checking_channels and check_round.channels_checked > 1:
+            print('Finished checking %d channels in %d s with up to %d'
+                  ' workers. %d needed only the feed, saving %d requests'
+                  ' and about %d KiB'
+                  % (check_round.channels_checked,
+                     time.time() - check_round.start_time,
+                     check_round.most_workers,
+                     check_round.feed_only_checks,
+                     check_round.feed_only_checks,
+                     check_round.estimated_bytes_saved()//1024))
+
+def max_check_workers():
+    if settings.subscription_check_workers > 0:
+        return settings.subscription_check_workers
+    return max(1, settings.connection_pool_size_api)
+
+class CheckWorkerPool:
+    '''Greenlets which take channels off check_channels_queue and check
+    them. Workers are added while there are more channels waiting than
+    idle workers, up to max_check_workers(), and stop after IDLE_TIMEOUT
+    seconds without work or when there are too many after the maximum is
+    lowered'''
+    IDLE_TIMEOUT = 30
+
+    def __init__(self):
+        self.workers = set()
+        self.idle_workers = 0
+
+    def grow(self):
+        while (len(self.workers) < max_check_workers()
+               and check_channels_queue.qsize() > self.idle_workers):
+            # counts as idle until it starts waiting for a channel
+            self.idle_workers += 1
+            self.workers.add(gevent.spawn(self._work))
+
+    def _work(self):
         try:
-            _get_upstream_videos(channel_id)
-        except Exception:
-            traceback.print_exc()
+            while len(self.workers) <= max_check_workers():
+                try:
+                    channel_id = check_channels_queue.get(
+                        timeout=self.IDLE_TIMEOUT)
+                except gevent.queue.Empty:
+                    break
+                self.idle_workers -= 1
+                try:
+                    _check_channel(channel_id)
+                finally:
+                    self.idle_workers += 1
         finally:
-            checking_channels.remove(channel_id)
-
-for i in range(0,5):
-    gevent.spawn(check_channel_worker)
+            self.idle_workers -= 1
+            self.workers.discard(gevent.getcurrent())
+
+check_worker_pool = CheckWorkerPool()
+
+def report_check_rounds():
+    rows = [('Round started', 'Channels checked', 'Most workers',
+             'Average seconds per check', 'Slowest check',
+             'Feed only checks', 'Feed not modified', 'Requests saved',
+             'KiB saved (estimated)')]
+    for check_round in reversed(check_rounds):
+        rows.append((
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(check_round.start_time)),
+            check_round.channels_checked,
+            check_round.most_workers,
+            round(check_round.check_seconds
+                  / max(1, check_round.channels_checked), 2),
+            round(check_round.slowest_check_seconds, 2),
+            check_round.feed_only_checks,
+            check_round.feed_not_modified,
+            check_round.feed_only_checks,
+            check_round.estimated_bytes_saved()//1024,
+        ))
+    return rows
+
+util.add_status_reporter('Subscription check rounds', report_check_rounds)
 # ----------------------------
 
 
 
-# --- Auto checking system - Spaghetti code ---
+# --- Auto checking system ---
+def random_time_within_hour():
+    return time.time() + 3600*secrets.randbelow(60)/60
+
+class AutocheckScheduler:
+    '''When each channel is next due to be checked, as a heap of
+    (next_check_time, channel_id). Rescheduling or cancelling a channel
+    doesn't remove its old heap entry; entries which don't match
+    self.next_check_times are skipped when they reach the top.'''
+    def __init__(self):
+        self.heap = []
+        # channel_id -> next_check_time, for channels currently scheduled
+        self.next_check_times = {}
+        # Set when a job is added, so the dispatcher can recompute how long
+        # to sleep
+        self.wakeup = gevent.event.Event()
+
+    def __len__(self):
+        return len(self.next_check_times)
+
+    def load(self, jobs):
+        '''Replaces the schedule with jobs, an iterable of
+        (channel_id, next_check_time)'''
+        self.next_check_times = dict(jobs)
+        self.heap = [(next_check_time, channel_id) for channel_id,
+                     next_check_time in self.next_check_times.items()]
+        heapq.heapify(self.heap)
+        self.wakeup.set()
+
+    def schedule(self, channel_id, next_check_time):
+        self.next_check_times[channel_id] = next_check_time
+        heapq.heappush(self.heap, (next_check_time, channel_id))
+        # Stale entries pile up if channels are rescheduled a lot
+        if len(self.heap) > 2*len(self.next_check_times) + 64:
+            self.load(list(self.next_check_times.items()))
+        self.wakeup.set()
+
+    def cancel(self, channel_id):
+        self.next_check_times.pop(channel_id, None)
+
+    def peek(self):
+        '''Returns (next_check_time, channel_id) of the earliest job, or
+        None'''
+        while self.heap:
+            next_check_time, channel_id = self.heap[0]
+            if self.next_check_times.get(channel_id) == next_check_time:
+                return next_check_time, channel_id
+            heapq.heappop(self.heap)
+        return None
+
+    def pop(self):
+        next_check_time, channel_id = self.peek()
+        heapq.heappop(self.heap)
+        del self.next_check_times[channel_id]
+        return next_check_time, channel_id
+
+autocheck_scheduler = AutocheckScheduler()
+
 def autocheck_dispatcher():
-    '''Scans the auto_check_list. Sleeps until the earliest job is due, then adds that channel to the checking queue above. Can be sent a new job through autocheck_job_application'''
+    '''Sleeps until the earliest job of autocheck_scheduler is due, then adds
+    that channel to the checking queue above. Woken up early when a new job
+    is scheduled'''
     while True:
-        if len(autocheck_jobs) == 0:
-            new_job = autocheck_job_application.get()
-            autocheck_jobs.append(new_job)
-        else:
-            earliest_job_index = min(range(0, len(autocheck_jobs)), key=lambda index: autocheck_jobs[index]['next_check_time']) # https://stackoverflow.com/a/11825864
-            earliest_job = autocheck_jobs[earliest_job_index]
-            time_until_earliest_job = earliest_job['next_check_time'] - time.time()
-
-            if time_until_earliest_job <= -5:   # should not happen unless we're running extremely slow
-                print('ERROR: autocheck_dispatcher got job scheduled in the past, skipping and rescheduling: ' + earliest_job['channel_id'] + ', ' + earliest_job['channel_name'] + ', ' + str(earliest_job['next_check_time']))
-                next_check_time = time.time() + 3600*secrets.randbelow(60)/60
-                with_open_db(_schedule_checking, earliest_job['channel_id'], next_check_time)
-                autocheck_jobs[earliest_job_index]['next_check_time'] = next_check_time
-                continue
-
-            # make sure it's not muted
-            if with_open_db(_is_muted, earliest_job['channel_id']):
-                del autocheck_jobs[earliest_job_index]
-                continue
-
-            if time_until_earliest_job > 0: # it can become less than zero (in the past) when it's set to go off while the dispatcher is doing something else at that moment
-                try:
-                    new_job = autocheck_job_application.get(timeout = time_until_earliest_job)  # sleep for time_until_earliest_job time, but allow to be interrupted by new jobs
-                except gevent.queue.Empty: # no new jobs
-                    pass
-                else: # new job, add it to the list
-                    autocheck_jobs.append(new_job)
-                    continue
+        autocheck_scheduler.wakeup.clear()
+        job = autocheck_scheduler.peek()
+        if job is None:
+            autocheck_scheduler.wakeup.wait()
+            continue
+        next_check_time, channel_id = job
+        time_until_job = next_check_time - time.time()
+
+        if time_until_job <= -5:   # should not happen unless we're running extremely slow
+            print('ERROR: autocheck_dispatcher got job scheduled in the past, skipping and rescheduling: ' + channel_id + ', ' + channel_names.get(channel_id, '') + ', ' + str(next_check_time))
+            next_check_time = random_time_within_hour()
+            with_open_db(_schedule_checking, channel_id, next_check_time)
+            autocheck_scheduler.schedule(channel_id, next_check_time)
+            continue
+
+        if time_until_job > 0:
+            # sleep until the job is due, but allow to be interrupted by new
+            # jobs which may be earlier
+            autocheck_scheduler.wakeup.wait(timeout=time_until_job)
+            continue
+
+        autocheck_scheduler.pop()
+        if channel_id not in checking_channels:
+            _queue_channel_check(channel_id)
+
+def _load_autocheck_jobs(cursor, channel_ids=None):
+    '''Returns (channel_id, next_check_time) of the unmuted channels, or
+    of the given ones among them. Checks which are past due are moved to a
+    random time within the next hour'''
+    statement = '''SELECT yt_channel_id, channel_name, next_check_time
+                   FROM subscribed_channels WHERE muted != 1'''
+    if channel_ids is None:
+        rows = cursor.execute(statement).fetchall()
+    else:
+        rows = []
+        for channel_id in channel_ids:
+            rows += cursor.execute(statement + ''' AND yt_channel_id = ?''',
+                                   [channel_id]).fetchall()
+    jobs = []
+    rescheduled = []
+    now = time.time()
+    for channel_id, channel_name, next_check_time in rows:
+        channel_names[channel_id] = channel_name
+        # expired, check randomly within the next hour
+        # note: even if it isn't scheduled in the past right now, it might end up being if it's due soon and we dont start dispatching by then, see autocheck_dispatcher where time_until_job is negative
+        if next_check_time is None or next_check_time < now:
+            next_check_time = random_time_within_hour()
+            rescheduled.append((int(next_check_time), channel_id))
+        jobs.append((channel_id, next_check_time))
+    cursor.executemany('''UPDATE subscribed_channels SET next_check_time = ?
+                          WHERE yt_channel_id = ?''', rescheduled)
+    return jobs
+
+def unmute_autocheck(cursor, channel_ids):
+    if settings.autocheck_subscriptions:
+        for channel_id, next_check_time in _load_autocheck_jobs(cursor,
+                                                                channel_ids):
+            autocheck_scheduler.schedule(channel_id, next_check_time)
 
-            # no new jobs, time to execute the earliest job
-            channel_names[earliest_job['channel_id']] = earliest_job['channel_name']
-            checking_channels.add(earliest_job['channel_id'])
-            check_channels_queue.put(earliest_job['channel_id'])
-            del autocheck_jobs[earliest_job_index]
+def cancel_autocheck(channel_ids):
+    for channel_id in channel_ids:
+        autocheck_scheduler.cancel(channel_id)
 
 dispatcher_greenlet = None
 def start_autocheck_system():
-    global autocheck_job_application
-    global autocheck_jobs
     global dispatcher_greenlet
-
-    # job application format: dict with keys (channel_id, channel_name, next_check_time)
-    autocheck_job_application = gevent.queue.Queue() # only really meant to hold 1 item, just reusing gevent's wait and timeout machinery
-
-    autocheck_jobs = [] # list of dicts with the keys (channel_id, channel_name, next_check_time). Stores all the channels that need to be autochecked and when to check them
     with open_database() as connection:
         with connection as cursor:
-            now = time.time()
-            for row in cursor.execute('''SELECT yt_channel_id, channel_name, next_check_time FROM subscribed_channels WHERE muted != 1''').fetchall():
-
-                if row[2] is None:
-                    next_check_time = 0
-                else:
-                    next_check_time = row[2]
-
-                # expired, check randomly within the next hour
-                # note: even if it isn't scheduled in the past right now, it might end up being if it's due soon and we dont start dispatching by then, see below where time_until_earliest_job is negative
-                if next_check_time < now:
-                    next_check_time = now + 3600*secrets.randbelow(60)/60
-                    row = (row[0], row[1], next_check_time)
-                    _schedule_checking(cursor, row[0], next_check_time)
-                autocheck_jobs.append({'channel_id': row[0], 'channel_name': row[1], 'next_check_time': next_check_time})
+            autocheck_scheduler.load(_load_autocheck_jobs(cursor))
     dispatcher_greenlet = gevent.spawn(autocheck_dispatcher)
 
 def stop_autocheck_system():
     if dispatcher_greenlet is not None:
         dispatcher_greenlet.kill()
+    autocheck_scheduler.load(())
 
 def autocheck_setting_changed(old_value, new_value):
     if new_value:
@@ -421,13 +870,16 @@ if settings.autocheck_subscriptions:
 def check_channels_if_necessary(channel_ids):
     for channel_id in channel_ids:
         if channel_id not in checking_channels:
-            checking_channels.add(channel_id)
-            check_channels_queue.put(channel_id)
+            _queue_channel_check(channel_id)
 
-def _get_atoma_feed(channel_id):
+def _get_atoma_feed(channel_id, validators=None):
+    '''Returns None if validators are given and the feed hasn't changed'''
     url = 'https://www.youtube.com/feeds/videos.xml?channel_id=' + channel_id
     try:
-        return util.fetch_url(url).decode('utf-8')
+        content = util.fetch_url(url, validators=validators)
+        if content is None:
+            return None
+        return content.decode('utf-8')
     except util.FetchError as e:
         # 404 is expected for terminated channels
         if e.code in ('404', '429'):
@@ -437,21 +889,27 @@ def _get_atoma_feed(channel_id):
         raise
 
 def _get_channel_videos_first_page(channel_id, channel_status_name):
+    global video_list_bytes, video_list_count
     try:
         # First try the playlist method
-        pl_json = playlist.get_videos(
+        content = playlist.get_videos_content(
             'UU' + channel_id[2:],
             1,
             include_shorts=settings.include_shorts_in_subscriptions,
-            report_text=None
+            report_text=None,
+            use_cache=False
         )
-        pl_info = yt_data_extract.extract_playlist_info(pl_json)
+        video_list_bytes += len(content)
+        video_list_count += 1
+        pl_info = offload.run(offload.json_then, content.decode('utf-8'),
+                              yt_data_extract.extract_playlist_info)
         if pl_info.get('items'):
             pl_info['items'] = pl_info['items'][0:30]
             return pl_info
 
         # Try the channel api method
-        channel_json = channel.get_channel_first_page(channel_id=channel_id)
+        channel_json = channel.get_channel_first_page(channel_id=channel_id,
+                                                      use_cache=False)
         channel_info = yt_data_extract.extract_channel_info(
             json.loads(channel_json), 'videos'
         )
@@ -471,26 +929,9 @@ def _get_channel_videos_first_page(channel_id, channel_status_name):
             return None
         raise
 
-def _get_upstream_videos(channel_id):
-    try:
-        channel_status_name = channel_names[channel_id]
-    except KeyError:
-        channel_status_name = channel_id
-
-    print("Checking channel: " + channel_status_name)
-
-    tasks = (
-        # channel page, need for video duration
-        gevent.spawn(_get_channel_videos_first_page, channel_id,
-                     channel_status_name),
-        # need atoma feed for exact published time
-        gevent.spawn(_get_atoma_feed, channel_id)
-    )
-    gevent.joinall(tasks)
-
-    channel_info, feed = tasks[0].value, tasks[1].value
-
-    # extract published times from atoma feed
+def _read_atoma_feed(feed, channel_status_name):
+    '''Returns {video_id: time_published} for the videos in the feed, newest
+    first, or None if the feed couldn't be read'''
     times_published = {}
     try:
         def remove_bullshit(tag):
@@ -523,8 +964,161 @@ def _get_upstream_videos(channel_id):
     except AssertionError:
         print('Failed to read atoma feed for ' + channel_status_name)
         traceback.print_exc()
+        return None
     except defusedxml.ElementTree.ParseError:
         print('Failed to read atoma feed for ' + channel_status_name)
+        return None
+    return times_published
+
+# channel_id -> ids of videos in its feed which weren't in its video list
+# at the last full check, such as shorts when they're excluded from
+# subscriptions. These would otherwise look new on every check
+feed_videos_not_listed = {}
+
+def _feed_has_new_videos(cursor, channel_id, times_published):
+    '''Whether the feed shows videos which aren't in the database yet, or
+    which are missing their duration (such as upcoming videos), meaning the
+    channel's video list needs to be downloaded'''
+    time_last_checked = cursor.execute(
+        '''SELECT time_last_checked FROM subscribed_channels
+           WHERE yt_channel_id=?''', [channel_id]).fetchone()
+    if time_last_checked is None or time_last_checked[0] in (None, 0):
+        return True
+    # An empty feed doesn't necessarily mean the channel has no videos
+    if not times_published:
+        return True
+    not_listed = feed_videos_not_listed.get(channel_id, ())
+    video_ids = [video_id for video_id in times_published
+                 if video_id not in not_listed]
+    if not video_ids:
+        return False
+    number_with_duration = cursor.execute(
+        '''SELECT COUNT(*)
+           FROM videos
+           WHERE duration IS NOT NULL AND duration != ''
+               AND video_id IN (%s)'''
+        % ','.join('?'*len(video_ids)), video_ids).fetchone()[0]
+    return number_with_duration < len(video_ids)
+
+def _get_upload_model(cursor, channel_id):
+    '''Returns the channel's UploadModel, building it from its stored videos
+    if it doesn't have one yet'''
+    row = cursor.execute('''SELECT upload_model FROM subscribed_channels
+                            WHERE yt_channel_id = ?''', [channel_id]).fetchone()
+    if row is not None and row[0]:
+        return upload_model.UploadModel.from_json(row[0])
+    model = upload_model.UploadModel(reference_time=int(time.time()))
+    # Only exact times say which hour a video was uploaded in
+    for (time_published,) in cursor.execute(
+            '''SELECT time_published
+               FROM videos
+               WHERE sql_channel_id = (
+                   SELECT id FROM subscribed_channels WHERE yt_channel_id = ?
+               ) AND is_time_published_exact = 1''', [channel_id]):
+        model.add_upload(time_published)
+    return model
+
+def _get_feed_validators(cursor, channel_id):
+    '''Returns the validators to make the feed request conditional with, or
+    an empty dict if the whole feed is needed: on the first check, or when
+    some of the latest videos are missing their duration, which the feed
+    wouldn't show'''
+    row = cursor.execute(
+        '''SELECT time_last_checked, feed_etag, feed_last_modified, (
+               SELECT EXISTS(
+                   SELECT 1 FROM (
+                       SELECT duration
+                       FROM videos
+                       WHERE sql_channel_id = subscribed_channels.id
+                       ORDER BY time_published DESC
+                       LIMIT 15
+                   )
+                   WHERE duration IS NULL OR duration = ''
+               )
+           )
+           FROM subscribed_channels
+           WHERE yt_channel_id = ?''', [channel_id]).fetchone()
+    if row is None or row[0] in (None, 0) or row[3]:
+        return {}
+    return {'etag': row[1], 'last_modified': row[2]}
+
+def _record_check(cursor, channel_id, model, validators=None):
+    '''Saves the channel's upload model and schedules its next check with
+    it. validators are saved only once the check succeeded, since a later
+    conditional request would skip the videos of a failed one'''
+    now = int(time.time())
+    next_check_time = model.next_check_time(now)
+    cursor.execute('''UPDATE subscribed_channels
+                      SET time_last_checked = ?, next_check_time = ?,
+                          upload_model = ?
+                      WHERE yt_channel_id=?''', [now, next_check_time, model.to_json(), channel_id])
+    if validators is not None:
+        cursor.execute('''UPDATE subscribed_channels
+                          SET feed_etag = ?, feed_last_modified = ?
+                          WHERE yt_channel_id = ?''',
+                       [validators.get('etag'),
+                        validators.get('last_modified'), channel_id])
+
+    if settings.autocheck_subscriptions:
+        if not _is_muted(cursor, channel_id):
+            autocheck_scheduler.schedule(channel_id, next_check_time)
+
+def _finish_feed_only_check(channel_id, validators=None):
+    with open_database() as connection:
+        with connection as cursor:
+            _record_check(cursor, channel_id,
+                          _get_upload_model(cursor, channel_id), validators)
+
+def _get_upstream_videos(channel_id):
+    '''Checks the channel for new videos and adds them to the database.
+    With settings.feed_first_checking, the small Atom feed is downloaded
+    first (only if it changed since the last check), and the channel's
+    video list only if the feed shows something new. Returns 'not_modified'
+    or 'feed_only' if the video list wasn't needed'''
+    try:
+        channel_status_name = channel_names[channel_id]
+    except KeyError:
+        channel_status_name = channel_id
+
+    print("Checking channel: " + channel_status_name)
+
+    validators = None
+    if settings.feed_first_checking:
+        with open_database(read_only=True) as connection:
+            validators = _get_feed_validators(connection, channel_id)
+        feed = _get_atoma_feed(channel_id, validators)
+        if feed is None:
+            _finish_feed_only_check(channel_id)
+            print('No new videos from ' + channel_status_name
+                  + ' (feed not modified)')
+            return 'not_modified'
+        times_published = _read_atoma_feed(feed, channel_status_name)
+        if times_published is not None:
+            with open_database(read_only=True) as connection:
+                has_new_videos = _feed_has_new_videos(connection, channel_id,
+                                                      times_published)
+            if not has_new_videos:
+                _finish_feed_only_check(channel_id, validators)
+                print('No new videos from ' + channel_status_name)
+                return 'feed_only'
+        # need channel page for video duration
+        channel_info = _get_channel_videos_first_page(channel_id,
+                                                      channel_status_name)
+    else:
+        tasks = (
+            # channel page, need for video duration
+            gevent.spawn(_get_channel_videos_first_page, channel_id,
+                         channel_status_name),
+            # need atoma feed for exact published time
+            gevent.spawn(_get_atoma_feed, channel_id)
+        )
+        gevent.joinall(tasks)
+
+        channel_info = tasks[0].value
+        times_published = _read_atoma_feed(tasks[1].value,
+                                           channel_status_name)
+    if times_published is None:
+        times_published = {}
 
     if channel_info is None: # there was an error
         return
@@ -552,19 +1146,15 @@ def _get_upstream_videos(channel_id):
         video_item['channel_id'] = channel_id
 
 
-    if len(videos) == 0:
-        average_upload_period = 4*7*24*3600 # assume 1 month for channel with no videos
-    elif len(videos) < 5:
-        average_upload_period = int((time.time() - videos[len(videos)-1]['time_published'])/len(videos))
-    else:
-        average_upload_period = int((time.time() - videos[4]['time_published'])/5) # equivalent to averaging the time between videos for the last 5 videos
-
-    # calculate when to check next for auto checking
-    # add some quantization and randomness to make pattern analysis by Youtube slightly harder
-    quantized_upload_period = average_upload_period - (average_upload_period % (4*3600)) + 4*3600   # round up to nearest 4 hours
-    randomized_upload_period = quantized_upload_period*(1 + secrets.randbelow(50)/50*0.5) # randomly between 1x and 1.5x
-    next_check_delay = randomized_upload_period/10    # check at 10x the channel posting rate. might want to fine tune this number
-    next_check_time = int(time.time() + next_check_delay)
+    # Feed videos which are older than the newest listed video but aren't
+    # listed themselves won't show up in the list later. Newer ones might
+    # just not be listed yet
+    if videos:
+        newest_listed = max(video['time_published'] for video in videos)
+        listed = set(video['id'] for video in videos)
+        feed_videos_not_listed[channel_id] = set(
+            video_id for video_id, time_published in times_published.items()
+            if video_id not in listed and time_published <= newest_listed)
 
     with open_database() as connection:
         with connection as cursor:
@@ -579,6 +1169,14 @@ def _get_upstream_videos(channel_id):
                    ORDER BY time_published DESC
                    LIMIT 30''', [channel_id]).fetchall())
 
+            # loaded before the new videos are stored, so that if it's built
+            # from the stored ones, they aren't counted twice
+            model = _get_upload_model(cursor, channel_id)
+            for video in videos:
+                if (video['id'] not in existing_vids
+                        and video['is_time_published_exact']):
+                    model.add_upload(video['time_published'])
+
             # new videos the channel has uploaded since last time we checked
             number_of_new_videos = 0
             for video in videos:
@@ -627,13 +1225,15 @@ def _get_upstream_videos(channel_id):
                                       description
                                   )
                                   VALUES ((SELECT id FROM subscribed_channels WHERE yt_channel_id=?), ?, ?, ?, ?, ?, ?, ?)''', rows)
-            cursor.execute('''UPDATE subscribed_channels
-                              SET time_last_checked = ?, next_check_time = ?
-                              WHERE yt_channel_id=?''', [int(time.time()), next_check_time, channel_id])
-
-            if settings.autocheck_subscriptions:
-                if not _is_muted(cursor, channel_id):
-                    autocheck_job_application.put({'channel_id': channel_id, 'channel_name': channel_names[channel_id], 'next_check_time': next_check_time})
+            # fill in durations which were missing, such as for videos
+            # which were upcoming at the last check
+            cursor.executemany('''UPDATE videos
+                                  SET duration = ?
+                                  WHERE video_id = ?
+                                      AND (duration IS NULL OR duration = '')''',
+                               [(video['duration'], video['id'])
+                                for video in videos if video['duration']])
+            _record_check(cursor, channel_id, model, validators)
 
     if number_of_new_videos == 0:
         print('No new videos from ' + channel_status_name)
@@ -645,7 +1245,7 @@ def _get_upstream_videos(channel_id):
 
 
 def check_all_channels():
-    with open_database() as connection:
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             channel_id_name_list = cursor.execute('''SELECT yt_channel_id, channel_name
                                                      FROM subscribed_channels
@@ -657,7 +1257,7 @@ def check_all_channels():
 
 def check_tags(tags):
     channel_id_name_list = []
-    with open_database() as connection:
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             for tag in tags:
                 channel_id_name_list += _channels_with_tag(cursor, tag, exclude_muted=True)
@@ -667,7 +1267,7 @@ def check_tags(tags):
 
 
 def check_specific_channels(channel_ids):
-    with open_database() as connection:
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             channel_id_name_list = []
             for channel_id in channel_ids:
@@ -776,7 +1376,7 @@ def import_subscriptions():
 @yt_app.route('/export_subscriptions', methods=['POST'])
 def export_subscriptions():
     include_muted = request.values.get('include_muted') == 'on'
-    with open_database() as connection:
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             sub_list = []
             for channel_name, channel_id, muted in (
@@ -837,7 +1437,7 @@ def export_subscriptions():
 @yt_app.route('/subscription_manager', methods=['GET'])
 def get_subscription_manager_page():
     group_by_tags = request.args.get('group_by_tags', '0') == '1'
-    with open_database() as connection:
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             if group_by_tags:
                 tag_groups = []
@@ -915,6 +1515,7 @@ def post_subscription_manager_page():
                 _remove_tags(cursor, request.values.getlist('channel_ids'), [tag.lower() for tag in list_from_comma_separated_tags(request.values['tags'])])
             elif action == 'unsubscribe':
                 _unsubscribe(cursor, request.values.getlist('channel_ids'))
+                cancel_autocheck(request.values.getlist('channel_ids'))
             elif action == 'unsubscribe_verify':
                 unsubscribe_list = _get_channel_names(cursor, request.values.getlist('channel_ids'))
                 return flask.render_template('unsubscribe_verify.html', unsubscribe_list = unsubscribe_list)
@@ -923,10 +1524,12 @@ def post_subscription_manager_page():
                 cursor.executemany('''UPDATE subscribed_channels
                                       SET muted = 1
                                       WHERE yt_channel_id = ?''', [(ci,) for ci in request.values.getlist('channel_ids')])
+                cancel_autocheck(request.values.getlist('channel_ids'))
             elif action == 'unmute':
                 cursor.executemany('''UPDATE subscribed_channels
                                       SET muted = 0
                                       WHERE yt_channel_id = ?''', [(ci,) for ci in request.values.getlist('channel_ids')])
+                unmute_autocheck(cursor, request.values.getlist('channel_ids'))
             else:
                 flask.abort(400)
 
@@ -936,10 +1539,16 @@ def post_subscription_manager_page():
 @yt_app.route('/feed/subscriptions', methods=['GET'])
 def get_subscriptions_page():
     page = int(request.args.get('page', 1))
-    with open_database() as connection:
+    page_token = request.args.get('page_token')
+    with open_database(read_only=True) as connection:
         with connection as cursor:
             tag = request.args.get('tag', None)
-            videos, number_of_videos_in_db = _get_videos(cursor, 60, (page - 1)*60, tag)
+            try:
+                (videos, number_of_videos_in_db, next_page_token,
+                 previous_page_token) = _get_videos(
+                    cursor, 60, (page - 1)*60, tag, page_token=page_token)
+            except ValueError:
+                flask.abort(400, 'Invalid page token')
             for video in videos:
                 video['thumbnail'] = util.URL_ORIGIN + '/data/subscription_thumbnails/' + video['id'] + '.jpg'
                 video['type'] = 'video'
@@ -958,11 +1567,18 @@ def get_subscriptions_page():
                     'muted': muted,
                 })
 
+    # Page number buttons go to the page by offset
+    page_number_parameters = request.args.copy()
+    page_number_parameters.pop('page_token', None)
+
     return flask.render_template('subscriptions.html',
         header_playlist_names = local_playlist.get_playlist_names(),
         videos = videos,
         num_pages = math.ceil(number_of_videos_in_db/60),
         parameters_dictionary = request.args,
+        next_page_token = next_page_token,
+        previous_page_token = previous_page_token,
+        page_number_parameters = page_number_parameters,
         tags = tags,
         current_tag = tag,
         subscription_list = subscription_list,
@@ -979,6 +1595,7 @@ def post_subscriptions_page():
 
     elif action == 'unsubscribe':
         with_open_db(_unsubscribe, request.values.getlist('channel_id'))
+        cancel_autocheck(request.values.getlist('channel_id'))
 
     elif action == 'refresh':
         type = request.values['type']
@@ -998,37 +1615,38 @@ def post_subscriptions_page():
 
 @yt_app.route('/data/subscription_thumbnails/<thumbnail>')
 def serve_subscription_thumbnail(thumbnail):
-    '''Serves thumbnail from disk if it's been saved already. If not, downloads the thumbnail, saves to disk, and serves it.'''
-    assert thumbnail[-4:] == '.jpg'
-    video_id = thumbnail[0:-4]
-    thumbnail_path = os.path.join(thumbnails_directory, thumbnail)
-
-    if video_id in existing_thumbnails:
+    '''Serves thumbnail from disk if it's been saved already. If not, downloads the thumbnail, saves to disk, and serves it.
+
+    Only thumbnails of videos in the subscriptions feed are saved, with a
+    reference which is removed when the channel is unsubscribed from.
+    Others are passed through, so they can't fill up the store'''
+    video_id, ext = os.path.splitext(thumbnail)
+    if ext != '.jpg' or not thumbnails.is_valid_video_id(video_id):
+        flask.abort(404)
+    with open_database(read_only=True) as connection:
+        in_feed = connection.execute(
+            '''SELECT EXISTS(SELECT 1 FROM videos WHERE video_id = ?)''',
+            [video_id]).fetchone()[0] == 1
+
+    legacy_paths = []
+    if in_feed:
+        legacy_paths.append(os.path.join(thumbnails_directory, thumbnail))
+    thumbnail_path = thumbnails.find(video_id, legacy_paths)
+    if thumbnail_path is None:
+        url = "https://i.ytimg.com/vi/" + video_id + "/mqdefault.jpg"
         try:
-            f = open(thumbnail_path, 'rb')
-        except FileNotFoundError:
-            existing_thumbnails.remove(video_id)
-        else:
-            image = f.read()
-            f.close()
+            image = util.fetch_url(url, report_text="Saved thumbnail: " + video_id)
+        except util.FetchError as e:
+            print("Failed to download thumbnail for " + video_id + ": " + str(e))
+            flask.abort(int(e.code) if e.code.isdigit() else 502)
+        if not in_feed:
             return flask.Response(image, mimetype='image/jpeg')
+        thumbnail_path = thumbnails.save(video_id, image)
+    if in_feed and not thumbnails.has_reference(thumbnails.SUBSCRIPTIONS,
+                                                video_id):
+        thumbnails.add_references(thumbnails.SUBSCRIPTIONS, [video_id])
 
-    url = "https://i.ytimg.com/vi/" + video_id + "/mqdefault.jpg"
-    try:
-        image = util.fetch_url(url, report_text="Saved thumbnail: " + video_id)
-    except urllib.error.HTTPError as e:
-        print("Failed to download thumbnail for " + video_id + ": " + str(e))
-        abort(e.code)
-    try:
-        f = open(thumbnail_path, 'wb')
-    except FileNotFoundError:
-        os.makedirs(thumbnails_directory, exist_ok = True)
-        f = open(thumbnail_path, 'wb')
-    f.write(image)
-    f.close()
-    existing_thumbnails.add(video_id)
-
-    return flask.Response(image, mimetype='image/jpeg')
+    return thumbnails.thumbnail_response(thumbnail_path)
 
 
 
@@ -0,0 +1,223 @@
+'''Store for the thumbnails saved for local playlists and the subscriptions
+feed, keyed by video id, so a video in several playlists and the feed is
+downloaded and stored once
+
+Thumbnails are stored in store_directory/<first 2 characters of the id>/,
+so no directory grows to hold every thumbnail, and whether one is stored
+is a stat of its path rather than a lookup in a listing of the directory.
+
+Each user of a thumbnail holds a reference to it, named by an owner string
+such as 'subscriptions' or 'playlist:<name>'. When the last reference to a
+thumbnail is removed, the thumbnail is deleted.
+
+Thumbnails saved in the per-playlist and subscriptions directories used
+before are moved into the store when they're first looked up.
+'''
+from youtube import util
+from youtube import yt_app
+import settings
+
+import os
+import re
+import sqlite3
+import contextlib
+import gevent.lock
+
+import flask
+from flask import request
+import werkzeug.wsgi
+
+store_directory = os.path.join(settings.data_dir, 'thumbnails')
+database_path = os.path.join(settings.data_dir, 'thumbnails.sqlite')
+
+SUBSCRIPTIONS = 'subscriptions'
+
+# A stored thumbnail isn't changed, so browsers can keep it without asking
+# again, and revalidate with the ETag once they've dropped it
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def playlist_owner(name):
+    return 'playlist:' + name
+
+
+def _create_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS thumbnail_references (
+                          video_id text NOT NULL,
+                          owner text NOT NULL,
+                          PRIMARY KEY(video_id, owner)
+                      ) WITHOUT ROWID''')
+    cursor.execute('''CREATE INDEX IF NOT EXISTS thumbnail_references_owner
+                      ON thumbnail_references(owner)''')
+
+connection = None
+connection_lock = gevent.lock.RLock()
+deleted_count = 0
+
+@contextlib.contextmanager
+def open_database():
+    '''Used as
+        with open_database() as connection:
+            with connection as cursor:
+                ...
+    The connection is shared, and used by one greenlet at a time'''
+    global connection
+    with connection_lock:
+        if connection is None:
+            os.makedirs(settings.data_dir, exist_ok=True)
+            new_connection = sqlite3.connect(database_path,
+                                             check_same_thread=False)
+            with new_connection:
+                _create_tables(new_connection)
+            connection = new_connection
+        try:
+            yield connection
+        finally:
+            if connection.in_transaction:
+                connection.rollback()
+
+def close_database():
+    global connection
+    with connection_lock:
+        if connection is not None:
+            connection.close()
+            connection = None
+
+
+def is_valid_video_id(video_id):
+    return re.fullmatch(r'[\w-]+', video_id) is not None
+
+def thumbnail_directory(video_id):
+    if not is_valid_video_id(video_id):
+        raise ValueError('Invalid video id: ' + video_id)
+    return os.path.join(store_directory, video_id[0:2])
+
+def thumbnail_path(video_id):
+    return os.path.join(thumbnail_directory(video_id), video_id + '.jpg')
+
+def find(video_id, legacy_paths=()):
+    '''Returns the path of the stored thumbnail, or None if it isn't stored.
+    A thumbnail at one of legacy_paths is moved into the store'''
+    if not is_valid_video_id(video_id):
+        return None
+    path = thumbnail_path(video_id)
+    if os.path.exists(path):
+        return path
+    for legacy_path in legacy_paths:
+        try:
+            os.makedirs(thumbnail_directory(video_id), exist_ok=True)
+            os.replace(legacy_path, path)
+        except FileNotFoundError:
+            continue
+        return path
+    return None
+
+def save(video_id, image):
+    path = thumbnail_path(video_id)
+    os.makedirs(thumbnail_directory(video_id), exist_ok=True)
+    temp_path = path + '.part'
+    with open(temp_path, 'wb') as f:
+        f.write(image)
+    os.replace(temp_path, path)
+    return path
+
+def download(video_ids):
+    '''Queues the thumbnails which aren't stored yet to be downloaded in the
+    background'''
+    for video_id in video_ids:
+        if not is_valid_video_id(video_id):
+            print('Not downloading thumbnail for invalid video id: '
+                  + video_id)
+        elif not os.path.exists(thumbnail_path(video_id)):
+            util.download_thumbnails(thumbnail_directory(video_id), [video_id])
+
+
+def has_reference(owner, video_id):
+    with open_database() as connection:
+        return connection.execute(
+            '''SELECT EXISTS(SELECT 1 FROM thumbnail_references
+                             WHERE video_id = ? AND owner = ?)''',
+            [video_id, owner]).fetchone()[0] == 1
+
+def add_references(owner, video_ids):
+    with open_database() as connection:
+        with connection as cursor:
+            cursor.executemany(
+                '''INSERT OR IGNORE INTO thumbnail_references (video_id, owner)
+                   VALUES (?, ?)''',
+                ((video_id, owner) for video_id in video_ids))
+
+def remove_references(owner, video_ids):
+    '''Removes owner's references to video_ids, and deletes the thumbnails
+    which are no longer referenced'''
+    global deleted_count
+    with open_database() as connection:
+        with connection as cursor:
+            cursor.executemany(
+                '''DELETE FROM thumbnail_references
+                   WHERE video_id = ? AND owner = ?''',
+                ((video_id, owner) for video_id in video_ids))
+            unreferenced = [video_id for video_id in video_ids
+                            if not cursor.execute(
+                                '''SELECT EXISTS(
+                                       SELECT 1 FROM thumbnail_references
+                                       WHERE video_id = ?)''',
+                                [video_id]).fetchone()[0]]
+
+    for video_id in unreferenced:
+        try:
+            os.remove(thumbnail_path(video_id))
+        except (FileNotFoundError, ValueError):
+            continue
+        except OSError:
+            print('Failed to delete thumbnail for ' + video_id)
+            continue
+        deleted_count += 1
+
+
+def report():
+    with open_database() as connection:
+        thumbnails, references = connection.execute(
+            '''SELECT COUNT(DISTINCT video_id), COUNT(*)
+               FROM thumbnail_references''').fetchone()
+    return [
+        ('Referenced thumbnails', 'References', 'Deleted'),
+        (thumbnails, references, deleted_count),
+    ]
+util.add_status_reporter('Thumbnail store', report)
+
+
+def thumbnail_response(path):
+    '''Response with the thumbnail at path, or 304 Not Modified if the
+    browser has it already. The file is sent with the server's
+    wsgi.file_wrapper, which the built-in server sends with sendfile'''
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        flask.abort(404)
+    stat = os.fstat(f.fileno())
+    etag = '%x-%x' % (stat.st_mtime_ns, stat.st_size)
+    headers = {
+        'ETag': '"' + etag + '"',
+        'Cache-Control': CACHE_CONTROL,
+    }
+    if request.if_none_match.contains_weak(etag):
+        f.close()
+        return flask.Response(status=304, headers=headers)
+    headers['Content-Length'] = str(stat.st_size)
+    return flask.Response(werkzeug.wsgi.wrap_file(request.environ, f),
+                          mimetype='image/jpeg', headers=headers,
+                          direct_passthrough=True)
+
+def send_thumbnail(video_id, legacy_paths=()):
+    path = find(video_id, legacy_paths)
+    if path is None:
+        flask.abort(404)
+    return thumbnail_response(path)
+
+
+@yt_app.route('/data/thumbnails/<thumbnail>')
+def serve_stored_thumbnail(thumbnail):
+    video_id, ext = os.path.splitext(thumbnail)
+    if ext != '.jpg':
+        flask.abort(404)
+    return send_thumbnail(video_id)
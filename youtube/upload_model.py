@@ -0,0 +1,119 @@
+'''Per-channel model of when a channel uploads, used to decide when to check
+it for new videos next
+
+The model is a histogram of upload times over the 168 hours of the week, in
+which older uploads count for less (half as much every HALF_LIFE seconds).
+Checks are spaced so that the chance of an upload between two consecutive
+checks is the same, which puts them close together around the hours a
+channel usually uploads and far apart elsewhere. The number of checks per
+week is a budget of checks_per_upload times the channel's estimated upload
+rate, within MIN_CHECKS_PER_WEEK and MAX_CHECKS_PER_WEEK.
+'''
+import json
+import math
+import secrets
+
+HOURS_PER_WEEK = 168
+WEEK = 7*24*3600
+HALF_LIFE = 90*24*3600
+# Weight of an imaginary upload spread evenly over the week, so hours in
+# which the channel never uploaded still get checked occasionally, and a
+# channel with no uploads is checked evenly
+PRIOR_WEIGHT = 1.0
+CHECKS_PER_UPLOAD = 6
+MIN_CHECKS_PER_WEEK = 2
+MAX_CHECKS_PER_WEEK = 336
+MIN_DELAY = 15*60
+# Up to this fraction of the delay is added at random, to make the pattern
+# of checks harder to analyze for Youtube
+MAX_JITTER = 0.1
+
+
+def hour_of_week(posix_time):
+    # Hour 0 is Thursday 00:00 UTC, since the epoch was a Thursday
+    return int(posix_time // 3600) % HOURS_PER_WEEK
+
+
+class UploadModel:
+    def __init__(self, histogram=None, reference_time=0, start_time=None):
+        self.histogram = histogram or [0.0]*HOURS_PER_WEEK
+        # Time the weights in the histogram are relative to
+        self.reference_time = reference_time
+        # Time of the earliest upload added
+        self.start_time = start_time
+
+    @classmethod
+    def from_json(cls, text):
+        info = json.loads(text)
+        return cls(info['h'], info['t'], info['s'])
+
+    def to_json(self):
+        return json.dumps({
+            't': self.reference_time,
+            's': self.start_time,
+            'h': [round(weight, 4) for weight in self.histogram],
+        }, separators=(',', ':'))
+
+    def _decay_factor(self, time):
+        return 0.5**((time - self.reference_time)/HALF_LIFE)
+
+    def add_upload(self, time_published):
+        if self.start_time is None or time_published < self.start_time:
+            self.start_time = time_published
+        if time_published > self.reference_time:
+            factor = self._decay_factor(time_published)
+            self.histogram = [weight*factor for weight in self.histogram]
+            self.reference_time = time_published
+        weight = 1/self._decay_factor(time_published)
+        self.histogram[hour_of_week(time_published)] += weight
+
+    def uploads_per_week(self, now):
+        if self.start_time is None:
+            return 0
+        total_weight = sum(self.histogram)*self._decay_factor(now)
+        # Length of time the uploads were counted over, weighted the same
+        # way as the uploads
+        span = max(now - self.start_time, 24*3600)
+        observed_time = HALF_LIFE/math.log(2)*(1 - 0.5**(span/HALF_LIFE))
+        return total_weight/observed_time*WEEK
+
+    def checks_per_week(self, now, checks_per_upload=CHECKS_PER_UPLOAD):
+        return min(MAX_CHECKS_PER_WEEK, max(
+            MIN_CHECKS_PER_WEEK,
+            checks_per_upload*self.uploads_per_week(now)))
+
+    def probabilities(self, now):
+        '''Chance of an upload being in each hour of the week. Weights are
+        spread to the neighbouring hours, since uploads at a regular time
+        are a bit early or late sometimes'''
+        factor = self._decay_factor(max(now, self.reference_time))
+        histogram = [weight*factor for weight in self.histogram]
+        total = sum(histogram) + PRIOR_WEIGHT
+        return [
+            (0.25*histogram[i - 1] + 0.5*histogram[i]
+             + 0.25*histogram[(i + 1) % HOURS_PER_WEEK]
+             + PRIOR_WEIGHT/HOURS_PER_WEEK)/total
+            for i in range(HOURS_PER_WEEK)
+        ]
+
+    def next_check_time(self, now, checks_per_upload=CHECKS_PER_UPLOAD,
+                        jitter=True):
+        '''Returns when to check next: once the chance of an upload since
+        now reaches the chance of one between two checks'''
+        remaining = 1/self.checks_per_week(now, checks_per_upload)
+        probabilities = self.probabilities(now)
+        check_time = now
+        while True:
+            probability = probabilities[hour_of_week(check_time)]
+            hour_end = (check_time//3600 + 1)*3600
+            hour_remaining = probability*(hour_end - check_time)/3600
+            if hour_remaining >= remaining:
+                check_time += remaining/probability*3600
+                break
+            remaining -= hour_remaining
+            check_time = hour_end
+
+        delay = max(MIN_DELAY, check_time - now)
+        if jitter:
+            delay *= 1 + MAX_JITTER*secrets.randbelow(1000)/1000
+        return int(now + delay)
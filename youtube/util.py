@@ -14,6 +14,7 @@ import json
 import gevent
 import gevent.queue
 import gevent.lock
+import gevent.event
 import collections
 import stem
 import stem.control
@@ -52,9 +53,113 @@ import traceback
 import urllib3
 import urllib3.contrib.socks
 
+from youtube.response_cache import response_cache
+
 URL_ORIGIN = "/https://www.youtube.com"
 
-connection_pool = urllib3.PoolManager(cert_reqs = 'CERT_REQUIRED')
+# Functions returning statistics to display on the /status page, as
+# a list of rows with the column names as the first row
+status_reporters = collections.OrderedDict()
+def add_status_reporter(name, func):
+    status_reporters[name] = func
+
+# Functions called with (url, status) for every response received by
+# fetch_url, including ones which are retried, such as 429s over Tor
+response_listeners = []
+def add_response_listener(func):
+    response_listeners.append(func)
+
+
+# --- Connection pools ---
+# Requests are split into separate pools for each kind of traffic so that
+# a page full of thumbnails doesn't use up the connections for video or for
+# the pages themselves. urllib3 keeps a pool of connections for each host
+# within these, of size settings.connection_pool_size_<traffic class>.
+# By default it only keeps 1 connection per host, so concurrent requests
+# caused new connections (new TLS handshakes, which are slow over Tor) that
+# were thrown away afterwards.
+TRAFFIC_CLASSES = ('api', 'image', 'video')
+IMAGE_DOMAINS = ('ytimg.com', 'ggpht.com', 'googleusercontent.com')
+
+def get_traffic_class(url):
+    host = urllib.parse.urlparse(url).hostname or ''
+    if host.endswith('googlevideo.com'):
+        return 'video'
+    if any(host == domain or host.endswith('.' + domain)
+           for domain in IMAGE_DOMAINS):
+        return 'image'
+    return 'api'
+
+# (pool name, host) -> counters
+connection_stats = collections.defaultdict(
+    lambda: {'created': 0, 'reused': 0, 'discarded': 0})
+
+def make_counting_pool_class(base_class, pool_name):
+    '''Subclass of a urllib3 connection pool class which counts the
+    connections created, reused, and discarded because the pool was full'''
+    class CountingConnectionPool(base_class):
+        def _new_conn(self):
+            connection_stats[(pool_name, self.host)]['created'] += 1
+            return base_class._new_conn(self)
+
+        def _get_conn(self, timeout=None):
+            stats = connection_stats[(pool_name, self.host)]
+            created_before = stats['created']
+            conn = base_class._get_conn(self, timeout=timeout)
+            if stats['created'] == created_before:
+                stats['reused'] += 1
+            return conn
+
+        def _put_conn(self, conn):
+            if self.pool is not None and self.pool.full():
+                connection_stats[(pool_name, self.host)]['discarded'] += 1
+            return base_class._put_conn(self, conn)
+    return CountingConnectionPool
+
+def make_pool_manager(traffic_class, use_tor):
+    maxsize = max(1, getattr(settings, 'connection_pool_size_'
+                                       + traffic_class))
+    if use_tor:
+        manager = urllib3.contrib.socks.SOCKSProxyManager(
+            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
+            cert_reqs = 'CERT_REQUIRED', maxsize=maxsize)
+        pool_name = 'tor_' + traffic_class
+    else:
+        manager = urllib3.PoolManager(cert_reqs = 'CERT_REQUIRED',
+                                      maxsize=maxsize)
+        pool_name = traffic_class
+    manager.pool_classes_by_scheme = {
+        scheme: make_counting_pool_class(base_class, pool_name)
+        for scheme, base_class in manager.pool_classes_by_scheme.items()
+    }
+    return manager
+
+connection_pools = {traffic_class: make_pool_manager(traffic_class, False)
+                    for traffic_class in TRAFFIC_CLASSES}
+connection_pool = connection_pools['api']
+
+def refresh_connection_pools(old_value=None, new_value=None):
+    '''Recreate pools after a pool size setting is changed'''
+    global connection_pool
+    for traffic_class in TRAFFIC_CLASSES:
+        connection_pools[traffic_class] = make_pool_manager(traffic_class,
+                                                            False)
+    connection_pool = connection_pools['api']
+    tor_manager.refresh_tor_connection_pool()
+
+for traffic_class in TRAFFIC_CLASSES:
+    settings.add_setting_changed_hook(
+        'connection_pool_size_' + traffic_class, refresh_connection_pools)
+
+def connection_stats_report():
+    rows = [('Pool', 'Host', 'Created', 'Reused', 'Discarded')]
+    for (pool_name, host), stats in sorted(connection_stats.items()):
+        rows.append((pool_name, host, stats['created'], stats['reused'],
+                     stats['discarded']))
+    return rows
+add_status_reporter('Connections', connection_stats_report)
+# ----------------------------
+
 
 class TorManager:
     MAX_TRIES = 3
@@ -62,10 +167,11 @@ class TorManager:
     # (otherwise it will retry forever if 429s never end)
     COOLDOWN_TIME = 14
     def __init__(self):
-        self.old_tor_connection_pool = None
-        self.tor_connection_pool = urllib3.contrib.socks.SOCKSProxyManager(
-            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
-            cert_reqs = 'CERT_REQUIRED')
+        self.old_tor_connection_pools = None
+        self.tor_connection_pools = {
+            traffic_class: make_pool_manager(traffic_class, True)
+            for traffic_class in TRAFFIC_CLASSES
+        }
         self.tor_pool_refresh_time = time.monotonic()
         settings.add_setting_changed_hook(
             'tor_port',
@@ -77,18 +183,20 @@ class TorManager:
         self.try_num = 1
 
     def refresh_tor_connection_pool(self):
-        self.tor_connection_pool.clear()
+        for pool in self.tor_connection_pools.values():
+            pool.clear()
 
         # Keep a reference for 5 min to avoid it getting garbage collected
         # while sockets still in use
-        self.old_tor_connection_pool = self.tor_connection_pool
+        self.old_tor_connection_pools = self.tor_connection_pools
 
-        self.tor_connection_pool = urllib3.contrib.socks.SOCKSProxyManager(
-            'socks5h://127.0.0.1:' + str(settings.tor_port) + '/',
-            cert_reqs = 'CERT_REQUIRED')
+        self.tor_connection_pools = {
+            traffic_class: make_pool_manager(traffic_class, True)
+            for traffic_class in TRAFFIC_CLASSES
+        }
         self.tor_pool_refresh_time = time.monotonic()
 
-    def get_tor_connection_pool(self):
+    def get_tor_connection_pool(self, traffic_class='api'):
         # Tor changes circuits after 10 minutes:
         # https://tor.stackexchange.com/questions/262/for-how-long-does-a-circuit-stay-alive
         current_time = time.monotonic()
@@ -97,7 +205,7 @@ class TorManager:
         if current_time - self.tor_pool_refresh_time > 300:
             self.refresh_tor_connection_pool()
 
-        return self.tor_connection_pool
+        return self.tor_connection_pools[traffic_class]
 
     def new_identity(self, time_failed_request_started):
         '''return error, or None if no error and the identity is fresh'''
@@ -160,10 +268,12 @@ class TorManager:
 tor_manager = TorManager()
 
 
-def get_pool(use_tor):
+def get_pool(use_tor, url=None):
+    '''Returns the connection pool manager for the kind of traffic url is'''
+    traffic_class = get_traffic_class(url) if url else 'api'
     if not use_tor:
-        return connection_pool
-    return tor_manager.get_tor_connection_pool()
+        return connection_pools[traffic_class]
+    return tor_manager.get_tor_connection_pool(traffic_class)
 
 
 class HTTPAsymmetricCookieProcessor(urllib.request.BaseHandler):
@@ -265,7 +375,7 @@ def fetch_url_response(url, headers=(), timeout=15, data=None,
             retries = urllib3.Retry(3+max_redirects, redirect=max_redirects, raise_on_redirect=False)
         else:
             retries = urllib3.Retry(3, raise_on_redirect=False)
-        pool = get_pool(use_tor and settings.route_tor)
+        pool = get_pool(use_tor and settings.route_tor, url)
         try:
             response = pool.request(method, url, headers=headers, body=data,
                                     timeout=timeout, preload_content=False,
@@ -292,9 +402,126 @@ def fetch_url_response(url, headers=(), timeout=15, data=None,
 
     return response, cleanup_func
 
+class SingleFlight:
+    '''Makes concurrent calls with the same key share one execution. The
+    first caller runs the function; callers arriving while it is running wait
+    for it and get its return value (or exception) instead of running it
+    again.
+
+    If the first caller is killed (GreenletExit or another BaseException),
+    that isn't passed on to the waiting callers, whose requests are still
+    wanted; one of them runs the function instead.'''
+    # Given to waiting callers when the caller running the function exited
+    # without a result
+    LEADER_EXITED = object()
+
+    def __init__(self):
+        self.in_flight = {}
+        self.executed_count = 0
+        self.coalesced_count = 0
+
+    def call(self, key, function, *args, **kwargs):
+        if key in self.in_flight:
+            self.coalesced_count += 1
+        while key in self.in_flight:
+            # raises the exception if the call failed
+            result = self.in_flight[key].get()
+            if result is not self.LEADER_EXITED:
+                return result
+
+        async_result = gevent.event.AsyncResult()
+        self.in_flight[key] = async_result
+        self.executed_count += 1
+        try:
+            result = function(*args, **kwargs)
+        except Exception as e:
+            async_result.set_exception(e)
+            raise
+        except BaseException:
+            async_result.set(self.LEADER_EXITED)
+            raise
+        else:
+            async_result.set(result)
+            return result
+        finally:
+            del self.in_flight[key]
+
+fetch_url_flights = SingleFlight()
+
+# How many seconds responses from each kind of endpoint may be reused for.
+# Call sites opt in by passing one of these as cache_ttl to fetch_url
+RESPONSE_CACHE_TTLS = {
+    'playlist': 10*60,
+    'channel_tab': 10*60,
+    'channel_about': 30*60,
+    'search': 10*60,
+}
+
+add_status_reporter('Response cache', lambda: [
+    ('Memory hits', 'Disk hits', 'Misses', 'MiB in memory', 'MiB on disk'),
+    (response_cache.memory_hits, response_cache.disk_hits,
+     response_cache.misses,
+     round(response_cache.memory_size/1024/1024, 1),
+     round(response_cache.disk_size/1024/1024, 1)),
+])
+add_status_reporter('Request coalescing', lambda: [
+    ('Requests sent', 'Requests combined with an identical one'),
+    (fetch_url_flights.executed_count, fetch_url_flights.coalesced_count),
+])
+
 def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
               cookiejar_send=None, cookiejar_receive=None, use_tor=True,
-              debug_name=None):
+              debug_name=None, cache_ttl=None, validators=None):
+    '''Identical concurrent requests (same method, url, body, headers and
+    routing) are sent only once, with the response shared between them.
+    Requests using cookiejars or validators are never combined.
+
+    When cache_ttl is given, the response is kept in the response cache and
+    reused for identical requests within cache_ttl seconds.
+
+    When validators is set to a dict, the request is conditional on the
+    'etag' and 'last_modified' in it, if any, from a previous response.
+    Returns None if the server says the content hasn't changed since then.
+    Otherwise the dict is updated with the validators of the new response.'''
+    if (cookiejar_send is not None or cookiejar_receive is not None
+            or validators is not None):
+        return _fetch_url(url, headers, timeout, report_text, data,
+                          cookiejar_send, cookiejar_receive, use_tor,
+                          debug_name, validators)
+
+    if isinstance(data, (str, bytes)) or data is None:
+        body_key = data
+    else:
+        body_key = urllib.parse.urlencode(data)
+    key = (
+        'GET' if data is None else 'POST',
+        url,
+        body_key,
+        tuple(sorted(dict(headers).items())),
+        bool(use_tor and settings.route_tor),
+    )
+    if cache_ttl:
+        content = response_cache.get(key)
+        if content is not None:
+            if report_text:
+                print(report_text, '    (cached)')
+            return content
+
+    content = fetch_url_flights.call(key, _fetch_url, url, headers, timeout,
+                                     report_text, data, None, None, use_tor,
+                                     debug_name)
+    if cache_ttl:
+        response_cache.put(key, content, cache_ttl)
+    return content
+
+def _fetch_url(url, headers, timeout, report_text, data, cookiejar_send,
+               cookiejar_receive, use_tor, debug_name, validators=None):
+    if validators is not None:
+        headers = dict(headers)
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
     while True:
         start_time = time.monotonic()
 
@@ -309,6 +536,8 @@ def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
         read_finish = time.monotonic()
 
         cleanup_func(response)  # release_connection for urllib3
+        for listener in response_listeners:
+            listener(url, response.status)
         content = decode_content(
             content,
             response.getheader('Content-Encoding', default='identity'))
@@ -363,12 +592,16 @@ def fetch_url(url, headers=(), timeout=15, report_text=None, data=None,
     if report_text:
         print(report_text, '    Latency:', round(response_time - start_time,3), '    Read time:', round(read_finish - response_time,3))
 
-
+    if validators is not None:
+        if response.status == 304:
+            return None
+        validators['etag'] = response.getheader('ETag')
+        validators['last_modified'] = response.getheader('Last-Modified')
 
     return content
 
 def head(url, use_tor=False, report_text=None, max_redirects=10):
-    pool = get_pool(use_tor and settings.route_tor)
+    pool = get_pool(use_tor and settings.route_tor, url)
     start_time = time.monotonic()
 
     # default: Retry.DEFAULT = Retry(3)
@@ -410,86 +643,270 @@ mobile_xhr_headers = (
 
 
 
-class RateLimitedQueue(gevent.queue.Queue):
-    ''' Does initial_burst (def. 30) at first, then alternates between waiting waiting_period (def. 5) seconds and doing subsequent_bursts (def. 10) queries. After 5 seconds with nothing left in the queue, resets rate limiting. '''
+class AdaptiveRateLimitedQueue(gevent.queue.Queue):
+    '''Queue which hands out items at a rate adapted to how the server
+    responds, as reported with record_response: additive increase while
+    responses are healthy, multiplicative decrease on 429 or 5xx.
 
-    def __init__(self, initial_burst=30, waiting_period=5, subsequent_bursts=10):
-        self.initial_burst = initial_burst
-        self.waiting_period = waiting_period
-        self.subsequent_bursts = subsequent_bursts
+    The rate is in items per second, with up to burst items at once after
+    being idle. It only adapts while the queue is in use, so it isn't
+    pushed around by other traffic while idle. When state_path is
+    given, the learned rate is saved there and loaded on the next start.'''
 
-        self.count_since_last_wait = 0
-        self.surpassed_initial = False
+    # At most one decrease per this many seconds, so a burst of errors from
+    # requests which were sent at the same time counts once
+    DECREASE_INTERVAL = 5
+    # Seconds since an item was taken out for the queue to count as in use
+    IN_USE_WINDOW = 30
+    SAVE_INTERVAL = 30
 
-        self.lock = gevent.lock.BoundedSemaphore(1)
-        self.currently_empty = False
-        self.empty_start = 0
+    def __init__(self, state_path=None, initial_rate=2, min_rate=0.05,
+                 max_rate=10, increase=0.1, decrease_factor=0.5, burst=10):
         gevent.queue.Queue.__init__(self)
+        self.state_path = state_path
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        # The rate grows by about this much per second of healthy responses
+        self.increase = increase
+        self.decrease_factor = decrease_factor
+        self.burst = burst
+
+        self.rate = self._load_rate(initial_rate)
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.last_get = None
+        self.last_decrease = None
+        self.last_save = time.monotonic()
+        self.increases = 0
+        self.decreases = 0
 
+        self.lock = gevent.lock.BoundedSemaphore(1)
 
-    def get(self):
-        self.lock.acquire()     # blocks if another greenlet currently has the lock
-        if self.count_since_last_wait >= self.subsequent_bursts and self.surpassed_initial:
-            gevent.sleep(self.waiting_period)
-            self.count_since_last_wait = 0
-
-        elif self.count_since_last_wait >= self.initial_burst and not self.surpassed_initial:
-            self.surpassed_initial = True
-            gevent.sleep(self.waiting_period)
-            self.count_since_last_wait = 0
-
-        self.count_since_last_wait += 1
-
-        if not self.currently_empty and self.empty():
-            self.currently_empty = True
-            self.empty_start = time.monotonic()
-
-        item = gevent.queue.Queue.get(self)     # blocks when nothing left
-
-        if self.currently_empty:
-            if time.monotonic() - self.empty_start >= self.waiting_period:
-                self.count_since_last_wait = 0
-                self.surpassed_initial = False
-
-            self.currently_empty = False
-
-        self.lock.release()
-
-        return item
+    def _load_rate(self, default):
+        if self.state_path is None:
+            return default
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                rate = float(json.load(f)['rate'])
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError, KeyError, TypeError):
+            print('Failed to load rate from ' + self.state_path)
+            traceback.print_exc()
+            return default
+        return min(self.max_rate, max(self.min_rate, rate))
+
+    def save(self):
+        if self.state_path is None:
+            return
+        self.last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'rate': self.rate}, f)
+            os.replace(temp_path, self.state_path)
+        except OSError:
+            print('Failed to save rate to ' + self.state_path)
+            traceback.print_exc()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill)*self.rate)
+        self.last_refill = now
+
+    def get(self, timeout=None):
+        '''Raises gevent.queue.Empty if no item came within timeout seconds.
+        The time spent waiting for the rate limit doesn't count towards it'''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # blocks if another greenlet currently has the lock
+        if not self.lock.acquire(timeout=timeout):
+            raise gevent.queue.Empty
+        try:
+            if deadline is None:
+                item = gevent.queue.Queue.get(self)  # blocks when nothing left
+            else:
+                item = gevent.queue.Queue.get(
+                    self, timeout=max(0, deadline - time.monotonic()))
+            self._refill()
+            while self.tokens < 1:
+                gevent.sleep((1 - self.tokens)/self.rate)
+                self._refill()
+            self.tokens -= 1
+            self.last_get = time.monotonic()
+            return item
+        finally:
+            self.lock.release()
+
+    def in_use(self):
+        return (self.last_get is not None
+                and time.monotonic() - self.last_get < self.IN_USE_WINDOW)
+
+    def record_response(self, status):
+        if not self.in_use():
+            return
+        now = time.monotonic()
+        if status == 429 or status >= 500:
+            if (self.last_decrease is not None
+                    and now - self.last_decrease < self.DECREASE_INTERVAL):
+                return
+            self._refill()
+            self.rate = max(self.min_rate, self.rate*self.decrease_factor)
+            # pause until the new rate has caught up
+            self.tokens = min(self.tokens, 0)
+            self.last_decrease = now
+            self.decreases += 1
+            self.save()
+        elif self.rate < self.max_rate:
+            self._refill()
+            # rate successes per second, so about self.increase per second
+            self.rate = min(self.max_rate,
+                            self.rate + self.increase/self.rate)
+            self.increases += 1
+            if now - self.last_save >= self.SAVE_INTERVAL:
+                self.save()
+
+    def report(self):
+        return [
+            ('Rate (per second)', 'Queued', 'Increases', 'Decreases'),
+            (round(self.rate, 2), self.qsize(), self.increases,
+             self.decreases),
+        ]
 
 
 
 def download_thumbnail(save_directory, video_id):
+    '''Saves the thumbnail, returning its size. It's written to a
+    temporary file first, so a thumbnail being served while it's downloaded
+    is never read half written'''
     url = "https://i.ytimg.com/vi/" + video_id + "/mqdefault.jpg"
     save_location = os.path.join(save_directory, video_id + ".jpg")
-    try:
-        thumbnail = fetch_url(url, report_text="Saved thumbnail: " + video_id)
-    except urllib.error.HTTPError as e:
-        print("Failed to download thumbnail for " + video_id + ": " + str(e))
-        return False
-    try:
-        f = open(save_location, 'wb')
-    except FileNotFoundError:
-        os.makedirs(save_directory, exist_ok = True)
-        f = open(save_location, 'wb')
-    f.write(thumbnail)
-    f.close()
-    return True
-
-def download_thumbnails(save_directory, ids):
-    if not isinstance(ids, (list, tuple)):
-        ids = list(ids)
-    # only do 5 at a time
-    # do the n where n is divisible by 5
-    i = -1
-    for i in range(0, int(len(ids)/5) - 1 ):
-        gevent.joinall([gevent.spawn(download_thumbnail, save_directory, ids[j]) for j in range(i*5, i*5 + 5)])
-    # do the remainders (< 5)
-    gevent.joinall([gevent.spawn(download_thumbnail, save_directory, ids[j]) for j in range(i*5 + 5, len(ids))])
-
+    thumbnail = fetch_url(url, report_text="Saved thumbnail: " + video_id)
+    os.makedirs(save_directory, exist_ok=True)
+    temp_location = save_location + '.part'
+    with open(temp_location, 'wb') as f:
+        f.write(thumbnail)
+    os.replace(temp_location, save_location)
+    return len(thumbnail)
+
+
+class ThumbnailDownloader:
+    '''Downloads thumbnails in the background for all callers, with at most
+    concurrency downloads at once (settings.connection_pool_size_image by
+    default, so they don't open connections which are thrown away).
+
+    A thumbnail which is already queued, downloading or waiting to be
+    retried for the same directory isn't queued again. Failures other than
+    404s are retried after RETRY_DELAY seconds, doubling each time, up to
+    MAX_ATTEMPTS attempts.'''
+
+    MAX_ATTEMPTS = 4
+    RETRY_DELAY = 5
+    # Seconds of completed downloads the throughput is measured over
+    THROUGHPUT_WINDOW = 60
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency
+        # ((directory, video id), attempt number)
+        self.queue = collections.deque()
+        # (directory, video id) queued, downloading or waiting to be retried
+        self.pending = set()
+        self.workers = 0
+        self.downloading = 0
+        # (time, number of bytes) of recent downloads
+        self.recent_downloads = collections.deque()
+        self.downloaded = 0
+        self.failed = 0
+        self.retries = 0
+        self.duplicates = 0
+
+    def max_workers(self):
+        return self.concurrency or settings.connection_pool_size_image
+
+    def add(self, save_directory, ids):
+        for video_id in ids:
+            key = (save_directory, video_id)
+            if key in self.pending:
+                self.duplicates += 1
+                continue
+            self.pending.add(key)
+            self._enqueue(key, 1)
+
+    def _enqueue(self, key, attempt):
+        self.queue.append((key, attempt))
+        if self.workers < self.max_workers():
+            self.workers += 1
+            gevent.spawn(self._work)
+
+    def _work(self):
+        try:
+            while self.queue:
+                key, attempt = self.queue.popleft()
+                self.downloading += 1
+                try:
+                    self._download(key, attempt)
+                finally:
+                    self.downloading -= 1
+        finally:
+            self.workers -= 1
 
+    def _download(self, key, attempt):
+        save_directory, video_id = key
+        try:
+            size = download_thumbnail(save_directory, video_id)
+        except (FetchError, urllib3.exceptions.HTTPError, OSError) as e:
+            not_found = isinstance(e, FetchError) and e.code == '404'
+            if attempt < self.MAX_ATTEMPTS and not not_found:
+                self.retries += 1
+                gevent.spawn_later(self.RETRY_DELAY*2**(attempt - 1),
+                                   self._enqueue, key, attempt + 1)
+                return
+            print('Failed to download thumbnail for ' + video_id + ': '
+                  + str(e))
+            self.failed += 1
+        except Exception:
+            print('Failed to download thumbnail for ' + video_id)
+            traceback.print_exc()
+            self.failed += 1
+        else:
+            self.downloaded += 1
+            self.recent_downloads.append((time.monotonic(), size))
+        self.pending.discard(key)
+
+    def throughput(self):
+        '''Returns (downloads, bytes) per second over the last
+        THROUGHPUT_WINDOW seconds'''
+        now = time.monotonic()
+        while (self.recent_downloads
+               and self.recent_downloads[0][0] < now - self.THROUGHPUT_WINDOW):
+            self.recent_downloads.popleft()
+        return (len(self.recent_downloads)/self.THROUGHPUT_WINDOW,
+                sum(size for _, size in self.recent_downloads)
+                / self.THROUGHPUT_WINDOW)
+
+    def report(self):
+        downloads_per_second, bytes_per_second = self.throughput()
+        return [
+            ('Queued', 'Downloading', 'Waiting to retry', 'Downloaded',
+             'Failed', 'Retries', 'Duplicates skipped', 'Per minute',
+             'KiB/s'),
+            (len(self.queue), self.downloading,
+             len(self.pending) - len(self.queue) - self.downloading,
+             self.downloaded, self.failed, self.retries, self.duplicates,
+             round(downloads_per_second*60, 1),
+             round(bytes_per_second/1024, 1)),
+        ]
+
+
+thumbnail_downloader = ThumbnailDownloader()
+add_status_reporter('Thumbnail downloads', thumbnail_downloader.report)
 
 
+def download_thumbnails(save_directory, ids):
+    '''Queues the thumbnails to be downloaded into save_directory in the
+    background'''
+    thumbnail_downloader.add(save_directory, ids)
 
 
 def dict_add(*dicts):
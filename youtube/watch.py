@@ -1,6 +1,8 @@
 import youtube
 from youtube import yt_app
 from youtube import util, comments, local_playlist, yt_data_extract
+from youtube import prefetch, offload
+from youtube.segment_cache import segment_cache
 import settings
 
 from flask import request
@@ -10,6 +12,9 @@ import json
 import html
 import gevent
 import os
+import copy
+import time
+import collections
 import math
 import traceback
 import urllib
@@ -420,7 +425,8 @@ def fetch_watch_page_info(video_id, playlist_id, index):
     watch_page = util.fetch_url(url, headers=headers,
                                 debug_name='watch')
     watch_page = watch_page.decode('utf-8')
-    return yt_data_extract.extract_watch_info_from_html(watch_page)
+    return offload.run(yt_data_extract.extract_watch_info_from_html,
+                       watch_page)
 
 def extract_info(video_id, use_invidious, playlist_id=None, index=None):
     tasks = (
@@ -511,6 +517,214 @@ def extract_info(video_id, use_invidious, playlist_id=None, index=None):
             print('Error: exceeded max redirects while checking video URL')
     return info
 
+
+def get_urls_expire_time(info):
+    '''Returns the earliest expire= time of the format urls, or None'''
+    expire_times = []
+    for fmt in info['formats']:
+        if not fmt['url']:
+            continue
+        query = parse_qs(urllib.parse.urlparse(fmt['url']).query)
+        if 'expire' in query:
+            try:
+                expire_times.append(int(query['expire'][0]))
+            except ValueError:
+                pass
+    return min(expire_times, default=None)
+
+
+class CachedInfo:
+    def __init__(self, info, expire_time):
+        self.info = info
+        self.expire_time = expire_time
+        self.watch_page_time = time.time()
+
+
+class VideoInfoCache:
+    '''Keeps the results of extract_info until the video urls in them
+    expire, so reloading a watch page or coming back to it from the comments
+    page doesn't repeat the embed page, player and url access requests.
+
+    The parts coming from the embed page which change over time (related
+    videos, counts) are refetched on their own once older than
+    WATCH_PAGE_TTL, reusing the urls.'''
+    MAX_ENTRIES = 64
+    # Urls are considered expired this long before their expire= time, so a
+    # video doesn't stop loading partway through
+    EXPIRY_MARGIN = 30*60
+    WATCH_PAGE_TTL = 10*60
+    WATCH_PAGE_KEYS = ('related_videos', 'playlist', 'view_count',
+                       'like_count', 'comment_count', 'comments_disabled')
+
+    def __init__(self):
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.watch_page_refreshes = 0
+
+    @staticmethod
+    def make_key(video_id, playlist_id, index):
+        return (video_id, playlist_id, index, settings.route_tor)
+
+    def get(self, video_id, playlist_id, index):
+        key = self.make_key(video_id, playlist_id, index)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() >= entry.expire_time:
+            del self.entries[key]
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def put(self, video_id, playlist_id, index, info):
+        '''Caches info unless it's an error, a livestream, or has no
+        expiring urls'''
+        if (info['error'] or info['playability_error'] or info['live']
+                or not info['urls_ready']):
+            return
+        urls_expire_time = get_urls_expire_time(info)
+        if urls_expire_time is None:
+            return
+        expire_time = urls_expire_time - self.EXPIRY_MARGIN
+        if expire_time <= time.time():
+            return
+        key = self.make_key(video_id, playlist_id, index)
+        self.entries[key] = CachedInfo(copy.deepcopy(info), expire_time)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.MAX_ENTRIES:
+            self.entries.popitem(last=False)
+
+    def refresh_watch_page(self, entry, video_id, playlist_id, index):
+        try:
+            watch_page_info = fetch_watch_page_info(video_id, playlist_id,
+                                                    index)
+        except (util.FetchError, urllib3.exceptions.HTTPError):
+            traceback.print_exc()
+            return
+        if watch_page_info['error']:
+            return
+        for key in self.WATCH_PAGE_KEYS:
+            entry.info[key] = watch_page_info[key]
+        entry.watch_page_time = time.time()
+        self.watch_page_refreshes += 1
+
+
+video_info_cache = VideoInfoCache()
+util.add_status_reporter('Video info cache', lambda: [
+    ('Videos cached', 'Hits', 'Misses', 'Watch page refreshes'),
+    (len(video_info_cache.entries), video_info_cache.hits,
+     video_info_cache.misses, video_info_cache.watch_page_refreshes),
+])
+
+
+def get_video_info(video_id, use_invidious, playlist_id=None, index=None,
+                   use_cache=True):
+    '''extract_info, using the video info cache. Returns a copy which the
+    caller may modify'''
+    entry = None
+    if use_cache:
+        video_prefetcher.wait(
+            video_info_cache.make_key(video_id, playlist_id, index))
+        entry = video_info_cache.get(video_id, playlist_id, index)
+    if entry is None:
+        video_info_cache.misses += 1
+        info = extract_info(video_id, use_invidious, playlist_id=playlist_id,
+                            index=index)
+        video_info_cache.put(video_id, playlist_id, index, info)
+        return info
+
+    video_info_cache.hits += 1
+    print('Using cached video info for ' + video_id)
+    if time.time() - entry.watch_page_time > video_info_cache.WATCH_PAGE_TTL:
+        video_info_cache.refresh_watch_page(entry, video_id, playlist_id,
+                                            index)
+    return copy.deepcopy(entry.info)
+
+
+def get_target_resolution(info):
+    if (settings.route_tor == 2) or info['tor_bypass_used']:
+        return 240
+    return settings.default_resolution
+
+
+video_prefetcher = prefetch.Prefetcher()
+util.add_status_reporter('Video prefetching', video_prefetcher.report)
+
+
+def prefetch_video_ranges(info):
+    '''Downloads the init and index ranges of the default pair of streams
+    into the video cache, so that starting playback doesn't wait for them'''
+    source_info = get_video_sources(info, get_target_resolution(info))
+    if source_info['pair_idx'] is None:
+        return
+    pair = source_info['pair_sources'][source_info['pair_idx']]
+    for fmt in (pair['videos'][0], pair['audios'][0]):
+        query_string = urllib.parse.urlparse(fmt['url']).query
+        cache_entry = segment_cache.get_entry(query_string)
+        if cache_entry is None:
+            return
+        end = min(fmt['index_range']['end'] + 1, cache_entry.content_length)
+        for start, piece_end, is_cached in cache_entry.split(0, end):
+            if is_cached:
+                continue
+            if not video_prefetcher.use_bandwidth(piece_end - start):
+                return
+            use_tor = (settings.route_tor == 2) or info['tor_bypass_used']
+            headers = {
+                'User-Agent': 'Mozilla/5.0 (Windows NT 6.1; Win64; x64)',
+                'Range': 'bytes=%d-%d' % (start, piece_end - 1),
+            }
+            response, cleanup_func = util.fetch_url_response(
+                fmt['url'], headers, use_tor=use_tor, max_redirects=10)
+            try:
+                if response.status != 206:
+                    print('Error: Youtube returned "%d %s" while prefetching'
+                          ' video range' % (response.status, response.reason))
+                    return
+                content = response.read(piece_end - start)
+            finally:
+                cleanup_func(response)
+            cache_entry.write(start, content)
+            segment_cache.commit(cache_entry)
+
+
+def prefetch_video(video_id, playlist_id, index):
+    if video_info_cache.get(video_id, playlist_id, index) is not None:
+        return
+    info = extract_info(video_id, True, playlist_id=playlist_id, index=index)
+    video_info_cache.put(video_id, playlist_id, index, info)
+    if (settings.prefetch_video_ranges and settings.proxy_images
+            and not info['error'] and not info['playability_error']):
+        prefetch_video_ranges(info)
+
+
+def schedule_prefetches(info):
+    '''Prefetches the next video of the playlist and the top related videos
+    in the background, with the urls the watch page links them with'''
+    if settings.prefetch_videos <= 0:
+        return
+    if info['playlist'] and info['playlist']['id']:
+        items = info['playlist']['items']
+        ids = [item.get('id') for item in items]
+        if info['id'] in ids:
+            position = ids.index(info['id'])
+            if position + 1 < len(items):
+                next_item = items[position + 1]
+                index = (str(next_item['index']) if next_item.get('index')
+                         else None)
+                key = video_info_cache.make_key(
+                    next_item['id'], info['playlist']['id'], index)
+                video_prefetcher.schedule(key, prefetch_video,
+                                          next_item['id'],
+                                          info['playlist']['id'], index)
+
+    related_videos = [item for item in info['related_videos']
+                      if item.get('type') == 'video' and item.get('id')]
+    for item in related_videos[0:settings.prefetch_videos]:
+        key = video_info_cache.make_key(item['id'], None, None)
+        video_prefetcher.schedule(key, prefetch_video, item['id'], None, None)
+
 def video_quality_string(format):
     if format['vcodec']:
         result =str(format['width'] or '?') + 'x' + str(format['height'] or '?')
@@ -648,18 +862,22 @@ def get_watch_page(video_id=None):
     playlist_id = request.args.get('list')
     index = request.args.get('index')
     use_invidious = bool(int(request.args.get('use_invidious', '1')))
+    # A forced reload (Ctrl+Shift+R) in the browser bypasses the cache
+    use_cache = not request.cache_control.no_cache
     if request.path.startswith('/embed') and settings.embed_page_mode:
         tasks = (
             gevent.spawn((lambda: {})),
-            gevent.spawn(extract_info, video_id, use_invidious,
-                         playlist_id=playlist_id, index=index),
+            gevent.spawn(get_video_info, video_id, use_invidious,
+                         playlist_id=playlist_id, index=index,
+                         use_cache=use_cache),
         )
     else:
         tasks = (
             gevent.spawn(comments.video_comments, video_id,
                          int(settings.default_comment_sorting), lc=lc),
-            gevent.spawn(extract_info, video_id, use_invidious,
-                         playlist_id=playlist_id, index=index),
+            gevent.spawn(get_video_info, video_id, use_invidious,
+                         playlist_id=playlist_id, index=index,
+                         use_cache=use_cache),
         )
     gevent.joinall(tasks)
     util.check_gevent_exceptions(tasks[1])
@@ -668,6 +886,8 @@ def get_watch_page(video_id=None):
     if info['error']:
         return flask.render_template('error.html', error_message = info['error'])
 
+    schedule_prefetches(info)
+
     video_info = {
         'duration':  util.seconds_to_timestamp(info['duration'] or 0),
         'id':        info['id'],
@@ -734,11 +954,7 @@ def get_watch_page(video_id=None):
             'codecs': codecs_string,
         })
 
-    if (settings.route_tor == 2) or info['tor_bypass_used']:
-        target_resolution = 240
-    else:
-        target_resolution = settings.default_resolution
-
+    target_resolution = get_target_resolution(info)
     source_info = get_video_sources(info, target_resolution)
     uni_sources = source_info['uni_sources']
     pair_sources = source_info['pair_sources']